@@ -29,7 +29,9 @@ class CLICmdHistory(background_task.BackgroundTask):
 
         # Autosave and other maint. periodically in case service dies
         self.__lock                 = Lock()
-        self.__autosaveRunner       = background_task.BackgroundRunner(self, CLICmdHistory.DEF_AUTOSAVE_INTERVAL_SECS)
+        self.__autosaveRunner       = background_task.BackgroundRunner(self, 
+                                                                       CLICmdHistory.DEF_AUTOSAVE_INTERVAL_SECS,
+                                                                       scheduler = background_task.BackgroundScheduler.GetShared())
 
         # Instruct readline to preserve up maxEntries commands
         readline.set_history_length(self.maxEntries)
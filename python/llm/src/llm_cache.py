@@ -0,0 +1,130 @@
+from dataclasses    import dataclass
+from pathlib        import Path
+from threading      import Lock
+from typing         import Optional, Tuple
+
+import hashlib
+import json
+import sqlite3
+import time
+
+# Local packages
+from core           import cache
+
+@dataclass
+class LLMCacheStats:
+    memoryHits: int = 0
+    diskHits:   int = 0
+    misses:     int = 0
+    expired:    int = 0
+    stores:     int = 0
+
+    @property
+    def hitRate(self) -> float:
+        lookups = self.memoryHits + self.diskHits + self.misses
+        return (self.memoryHits + self.diskHits) / lookups if lookups > 0 else 0.0
+
+# Caches response content for identical requests. Lookups go to an in-memory LRU
+# first and then to an optional SQLite file so results survive restarts.
+# Entries expire after ttlSecs. Thread safe.
+class LLMResponseCache:
+    DEFAULT_MAX_ENTRIES = 1024
+    DEFAULT_TTL_SECS    = 7 * 24 * 3600
+    NO_EXPIRY           = 0
+
+    def __init__(self,
+                 dbFilepath: Optional[Path] = None,
+                 maxEntries: int            = DEFAULT_MAX_ENTRIES,
+                 ttlSecs: float             = DEFAULT_TTL_SECS):
+
+        self.dbFilepath = dbFilepath
+        self.ttlSecs    = ttlSecs
+        self.stats      = LLMCacheStats()
+
+        # Value is (expiry time, content)
+        self._memory    = cache.LRUDict[str, Tuple[float, str]](maxEntries)
+        self._lock      = Lock()
+
+        self._db: Optional[sqlite3.Connection] = None
+        if dbFilepath is not None:
+            self._db = sqlite3.connect(str(dbFilepath), check_same_thread = False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT NOT NULL, expiresAt REAL NOT NULL)")
+            self._db.execute("DELETE FROM responses WHERE expiresAt > 0 AND expiresAt <= ?", (time.time(),))
+            self._db.commit()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    # Stable key from everything that affects the answer
+    @staticmethod
+    def GetKey(modelHandle: str, params: dict, messages: list, responseFormat: Optional[dict]) -> str:
+        keyJSON = json.dumps({
+            "model":    modelHandle,
+            "params":   params,
+            "messages": messages,
+            "format":   responseFormat
+        }, sort_keys = True, default = str)
+
+        return hashlib.sha256(keyJSON.encode("utf-8")).hexdigest()
+
+    def __isExpired(self, expiresAt: float) -> bool:
+        return expiresAt != LLMResponseCache.NO_EXPIRY and expiresAt <= time.time()
+
+    def __putMemory(self, key: str, value: Tuple[float, str]):
+        if self._memory.get(key) is None:
+            self._memory.put(key, value)
+            self._memory.prune()
+        else:
+            self._memory.dict[key] = value
+
+    def get(self, key: str) -> Optional[str]:
+        content: Optional[str] = None
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self.__isExpired(entry[0]):
+                content = entry[1]
+                self.stats.memoryHits += 1
+            else:
+                if entry is not None:
+                    del self._memory.dict[key]
+                    self.stats.expired += 1
+
+                if self._db is not None:
+                    row = self._db.execute("SELECT content, expiresAt FROM responses WHERE key = ?", (key,)).fetchone()
+                    if row is not None and not self.__isExpired(row[1]):
+                        content = row[0]
+                        self.stats.diskHits += 1
+                        self.__putMemory(key, (row[1], row[0])) # Promote to memory
+                    elif row is not None:
+                        self.stats.expired += 1
+
+                if content is None:
+                    self.stats.misses += 1
+
+        return content
+
+    def put(self, key: str, content: str):
+        expiresAt = (time.time() + self.ttlSecs) if self.ttlSecs != LLMResponseCache.NO_EXPIRY else LLMResponseCache.NO_EXPIRY
+
+        with self._lock:
+            self.__putMemory(key, (expiresAt, content))
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO responses (key, content, expiresAt) VALUES (?, ?, ?)",
+                                 (key, content, expiresAt))
+                self._db.commit()
+            self.stats.stores += 1
+
+    def clear(self):
+        with self._lock:
+            self._memory.dict.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
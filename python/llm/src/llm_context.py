@@ -0,0 +1,154 @@
+from dataclasses    import dataclass
+from typing         import Callable, Iterator, List, Optional
+
+import copy
+
+# This package
+from .llm_define    import LogLine, LLMMessage
+from .llm_model     import LLMModel
+
+@dataclass
+class LLMContextEntry:
+    message:    LLMMessage
+    numTokens:  int
+    pinned:     bool
+
+# Conversation history that stays within a token budget. Token counts are kept per
+# message so the running total is cheap to maintain. When the budget is exceeded the
+# oldest turns are summarised, if a summariser is set, or dropped. Pinned messages,
+# by default system messages, and the most recent turns are always kept.
+class LLMContext:
+    DEFAULT_RESPONSE_RESERVE_RATIO  = 0.25  # Share of the context left for the answer
+    DEFAULT_KEEP_RECENT_MESSAGES    = 2     # Latest prompt and answer
+    MESSAGE_OVERHEAD_TOKENS         = 4     # Role and separators added by chat templates
+    MIN_MESSAGES_TO_SUMMARIZE       = 2
+    SUMMARY_PREFIX                  = "Summary of the earlier conversation: "
+    NO_BUDGET                       = 0
+
+    def __init__(self,
+                 model: LLMModel,
+                 budgetTokens: Optional[int]                            = None,
+                 fnSummarize: Optional[Callable[[List[LLMMessage]], str]] = None,
+                 keepRecentMessages: int                                = DEFAULT_KEEP_RECENT_MESSAGES,
+                 logger                                                 = None):
+
+        self.model              = model
+        self.fnSummarize        = fnSummarize
+        self.keepRecentMessages = keepRecentMessages
+        self.logger             = logger if logger is not None else model.logger
+
+        # Models without a known context length aren't trimmed
+        if budgetTokens is None:
+            budgetTokens = LLMContext.GetDefaultBudget(model)
+        self.budgetTokens = budgetTokens
+
+        self.entries: List[LLMContextEntry] = []
+        self.numTokens              = 0
+        self.numTrimmed             = 0
+        self.numSummarized          = 0
+
+    @staticmethod
+    def GetDefaultBudget(model: LLMModel) -> int:
+        maxContextLen = model.getMaxContextLength()
+        return int(maxContextLen * (1.0 - LLMContext.DEFAULT_RESPONSE_RESERVE_RATIO)) if maxContextLen > 0 else LLMContext.NO_BUDGET
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[LLMMessage]:
+        return iter(self.getMessages())
+
+    # Independent copy that shares the model and summariser, e.g. for batch requests
+    def copy(self) -> "LLMContext":
+        contextCopy = copy.copy(self)
+        contextCopy.entries = list(self.entries)
+        return contextCopy
+
+    def __makeEntries(self, messages: List[LLMMessage], pinned: Optional[bool]) -> List[LLMContextEntry]:
+        counts = self.model.countTokens([message.content for message in messages])
+        return [LLMContextEntry(message,
+                                numTokens + LLMContext.MESSAGE_OVERHEAD_TOKENS,
+                                pinned if pinned is not None else message.role == "system")
+                for message, numTokens in zip(messages, counts)]
+
+    # Pinned defaults to True for system messages and False otherwise
+    def append(self, message: LLMMessage, pinned: Optional[bool] = None):
+        self.extend([message], pinned)
+
+    def extend(self, messages: List[LLMMessage], pinned: Optional[bool] = None):
+        newEntries = self.__makeEntries(messages, pinned)
+        self.entries.extend(newEntries)
+        self.numTokens += sum(entry.numTokens for entry in newEntries)
+
+    def clear(self, keepPinned: bool = True):
+        self.entries = [entry for entry in self.entries if keepPinned and entry.pinned]
+        self.numTokens = sum(entry.numTokens for entry in self.entries)
+
+    def isOverBudget(self) -> bool:
+        return self.budgetTokens != LLMContext.NO_BUDGET and self.numTokens > self.budgetTokens
+
+    # Messages that may be summarised or dropped, oldest first
+    def __getEvictable(self) -> List[int]:
+        lastEvictable = len(self.entries) - max(1, self.keepRecentMessages)
+        return [idx for idx in range(lastEvictable) if not self.entries[idx].pinned]
+
+    def __summarize(self):
+        evictable = self.__getEvictable()
+        overflow = self.numTokens - self.budgetTokens
+
+        # Oldest turns until enough would be freed
+        toSummarize: List[int] = []
+        freed = 0
+        for idx in evictable:
+            if freed >= overflow and len(toSummarize) >= LLMContext.MIN_MESSAGES_TO_SUMMARIZE:
+                break
+            toSummarize.append(idx)
+            freed += self.entries[idx].numTokens
+
+        if len(toSummarize) >= LLMContext.MIN_MESSAGES_TO_SUMMARIZE and self.fnSummarize is not None:
+            try:
+                summary = self.fnSummarize([self.entries[idx].message for idx in toSummarize])
+                if summary:
+                    summaryEntry = self.__makeEntries([LLMMessage("system", LLMContext.SUMMARY_PREFIX + summary)], False)[0]
+                    # Only worth it if the summary is smaller than what it replaces
+                    if summaryEntry.numTokens < freed:
+                        removed = set(toSummarize)
+                        entries = [entry for idx, entry in enumerate(self.entries) if not idx in removed]
+                        entries.insert(toSummarize[0], summaryEntry)
+                        self.entries = entries
+                        self.numTokens += summaryEntry.numTokens - freed
+                        self.numSummarized += len(toSummarize)
+            except Exception as e:
+                self.logger.exception("Unable to summarise context. Falling back to trimming.")
+
+    def __trim(self):
+        # Indices shift when removing so collect first
+        removed = set()
+        for idx in self.__getEvictable():
+            if not self.isOverBudget():
+                break
+            removed.add(idx)
+            self.numTokens -= self.entries[idx].numTokens
+
+        if len(removed) > 0:
+            self.entries = [entry for idx, entry in enumerate(self.entries) if not idx in removed]
+            self.numTrimmed += len(removed)
+
+    # Summarise then trim the oldest turns until within budget. Can still be over
+    # budget if the pinned and most recent messages alone don't fit.
+    def fit(self) -> bool:
+        if self.isOverBudget():
+            if self.fnSummarize is not None:
+                self.__summarize()
+            if self.isOverBudget():
+                self.__trim()
+            if self.isOverBudget():
+                self.logger.warning(LogLine("Context is over budget after trimming: ",
+                                            self.numTokens, " > ", self.budgetTokens))
+
+        return not self.isOverBudget()
+
+    # Fits the budget and returns the messages to send
+    def getMessages(self) -> List[LLMMessage]:
+        self.fit()
+        return [entry.message for entry in self.entries]
@@ -1,6 +1,10 @@
 from dataclasses    import dataclass
 from enum           import Enum
-from typing         import cast, List
+from typing         import AsyncIterator, Callable, cast, Iterator, List, Optional
+
+import asyncio
+import httpx
+import io
 
 # Local packages
 from core           import logs
@@ -15,6 +19,23 @@ class LLMClientType(Enum):
     OLLAMA = "OLLAMA"
     OPENAI = "OPENAI"
 
+# Connection pooling for the HTTP clients talking to the LLM backend. 
+# Size the pool for the number of requests expected to be in flight at once.
+@dataclass
+class LLMConnectionParams:
+    maxConnections: int             = 100
+    maxKeepAliveConnections: int    = 20
+    keepAliveExpirySecs: float      = 30.0
+    timeoutSecs: float              = 600.0     # Long generations can take minutes
+    http2: bool                     = True      # Only used if the server supports it
+
+    def getLimits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections             = self.maxConnections,
+            max_keepalive_connections   = self.maxKeepAliveConnections,
+            keepalive_expiry            = self.keepAliveExpirySecs
+        )
+
 # A few key parameters for tweaking LLM performance.
 @dataclass
 class LLMParams:
@@ -30,20 +51,24 @@ class LLMParams:
     # Setting all options through they may not be relavent for a specific model
     # and especially for the deterministic mode.
     def setConservative(self):
-        self = LLMParams()
+        self.__init__() # Reset to defaults
         self.temperature    = 0.1
         self.top_p          = 0.9
         self.top_k          = 20
         self.repeat_penalty = 1.2
 
     def setDeterministic(self):
-        self = LLMParams()
+        self.__init__() # Reset to defaults
         self.temperature    = 0.0
         self.top_p          = 1
         self.top_k          = 1
         self.repeat_penalty = 1.2
         self.seed           = 3457 # Hard-coded seed used to stabilize output for testing or if user prefer consistent results.
 
+    # Greedy sampling always picks the same token so the same prompt gives the same answer.
+    def isDeterministic(self) -> bool:
+        return self.temperature == 0.0 or self.top_k == 1
+
 @dataclass
 class LLMInfo:
     name: str
@@ -101,8 +126,145 @@ class LLMResponseStatus(Enum):
     FAILED      = 1
     SUCCEEDED   = 2
     
+# Token counts and timings for one request. Server side timings are only known
+# for backends that report them, e.g. Ollama, otherwise they're left at 0.
+# Queue time is what the client waited beyond the server's own total, i.e.
+# waiting for a slot on the server plus the network.
+@dataclass
+class LLMUsage:
+    model: str                  = ""
+    promptTokens: int           = 0
+    completionTokens: int       = 0
+    elapsedSecs: float          = 0.0   # Measured by the client
+    firstTokenSecs: float       = 0.0   # Streaming only
+    serverTotalSecs: float      = 0.0
+    loadSecs: float             = 0.0
+    promptEvalSecs: float       = 0.0
+    evalSecs: float             = 0.0
+    queueSecs: float            = 0.0
+    cached: bool                = False
+
+    @property
+    def totalTokens(self) -> int:
+        return self.promptTokens + self.completionTokens
+
+    # Generation speed. Falls back to wall time if the backend doesn't report eval time.
+    @property
+    def tokensPerSec(self) -> float:
+        generationSecs = self.evalSecs if self.evalSecs > 0 else self.elapsedSecs - self.firstTokenSecs
+        return self.completionTokens / generationSecs if generationSecs > 0 else 0.0
+
+    # Call once the client side elapsed time is known
+    def setElapsed(self, elapsedSecs: float, firstTokenSecs: float = 0.0):
+        self.elapsedSecs    = elapsedSecs
+        self.firstTokenSecs = firstTokenSecs
+        if self.serverTotalSecs > 0:
+            self.queueSecs  = max(0.0, elapsedSecs - self.serverTotalSecs)
+
 class LLMResponse:
     def __init__(self):
         self.model: str                     = ""
         self.messages: List[LLMMessage]     = []
-        self.status                         = LLMResponseStatus.UNKNOWN
\ No newline at end of file
+        self.status                         = LLMResponseStatus.UNKNOWN
+        self.usage: Optional[LLMUsage]      = None
+
+# Outcome of a single prompt in a batch. Failed items keep the error
+# rather than failing the whole batch.
+@dataclass
+class LLMBatchItem:
+    prompt: str
+    answer: object              = ""
+    error: Optional[Exception]  = None
+    elapsedSecs: float          = 0.0
+    inputTokens: int            = 0
+    outputTokens: int           = 0
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None
+
+# Items are in the same order as the prompts submitted.
+@dataclass
+class LLMBatchResult:
+    items: List[LLMBatchItem]
+    elapsedSecs: float = 0.0
+
+    @property
+    def numSucceeded(self) -> int:
+        return sum(1 for item in self.items if item.succeeded)
+
+    @property
+    def numFailed(self) -> int:
+        return len(self.items) - self.numSucceeded
+
+    @property
+    def requestsPerSec(self) -> float:
+        return self.numSucceeded / self.elapsedSecs if self.elapsedSecs > 0 else 0.0
+
+    # Generated tokens per second across the batch
+    @property
+    def tokensPerSec(self) -> float:
+        outputTokens = sum(item.outputTokens for item in self.items if item.succeeded)
+        return outputTokens / self.elapsedSecs if self.elapsedSecs > 0 else 0.0
+
+    def answers(self) -> List[object]:
+        return [item.answer for item in self.items]
+
+# Incremental piece of a streamed response. The last delta has done set
+# and carries the final usage and other metadata reported by the backend.
+@dataclass
+class LLMStreamDelta:
+    content: str                = ""
+    role: str                   = "assistant"
+    done: bool                  = False
+    metadata: Optional[dict]    = None
+    usage: Optional[LLMUsage]   = None
+
+# Streamed response that can be consumed either with "for" or "async for".
+# Content and final metadata are accumulated as the stream is consumed.
+# The complete handler, if any, is called once the stream has been fully consumed.
+class LLMStream:
+    def __init__(self, 
+                 syncFactory: Callable[[], Iterator[LLMStreamDelta]], 
+                 asyncFactory: Optional[Callable[[], AsyncIterator[LLMStreamDelta]]] = None):
+        self.__syncFactory  = syncFactory
+        self.__asyncFactory = asyncFactory
+        self.__content      = io.StringIO()
+        self.metadata: Optional[dict] = None
+        self.usage: Optional[LLMUsage] = None
+        self.__completeHandler: Optional[Callable[["LLMStream"], None]] = None
+
+    @property
+    def content(self) -> str:
+        return self.__content.getvalue()
+
+    def setCompleteHandler(self, handler: Callable[["LLMStream"], None]):
+        self.__completeHandler = handler
+
+    def __complete(self):
+        if self.__completeHandler is not None:
+            self.__completeHandler(self)
+
+    def __track(self, delta: LLMStreamDelta) -> LLMStreamDelta:
+        self.__content.write(delta.content)
+        if delta.done:
+            self.metadata   = delta.metadata
+            self.usage      = delta.usage
+        return delta
+
+    def __iter__(self) -> Iterator[LLMStreamDelta]:
+        for delta in self.__syncFactory():
+            yield self.__track(delta)
+        self.__complete()
+
+    async def __aiter__(self) -> AsyncIterator[LLMStreamDelta]:
+        if self.__asyncFactory is not None:
+            async for delta in self.__asyncFactory():
+                yield self.__track(delta)
+        else:
+            # No native async support so pull from the blocking stream on a worker thread
+            iterator = self.__syncFactory()
+            done = object()
+            while (delta := await asyncio.to_thread(next, iterator, done)) is not done:
+                yield self.__track(cast(LLMStreamDelta, delta))
+        self.__complete()
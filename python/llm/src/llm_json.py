@@ -0,0 +1,236 @@
+import json
+import re
+
+from pydantic       import BaseModel, TypeAdapter, ValidationError
+from threading      import Lock
+from typing         import Any, Callable, Dict, List, Optional, Type
+
+class LLMStructuredOutputError(Exception):
+    def __init__(self, message: str, text: str = ""):
+        super().__init__(message)
+        self.text = text # What was received before the error
+
+# Parses a JSON object as it streams in so a response that can't match the schema is
+# rejected after the offending field rather than after the whole answer. Each top level
+# field is decoded and validated against its type in the model as soon as its value
+# ends and then handed to onField. Nested values are only checked once complete.
+class LLMJSONStreamParser:
+    # States while scanning the top level object
+    EXPECT_START    = 0
+    EXPECT_KEY      = 1     # Key or end of object
+    IN_KEY          = 2
+    EXPECT_COLON    = 3
+    EXPECT_VALUE    = 4
+    IN_VALUE        = 5
+    EXPECT_NEXT     = 6     # Comma or end of object
+    DONE            = 7
+
+    CODE_FENCE      = "```"
+    WHITESPACE      = " \t\r\n"
+
+    # Jump over string contents instead of scanning a character at a time
+    StringSpecialPattern = re.compile(r'["\\]')
+    ValueSpecialPattern  = re.compile(r'[\s"{}\[\],]')
+
+    # Cache list of field validators by model
+    Lookup: Dict[Type[BaseModel], Dict[str, TypeAdapter]] = {}
+    lock: Lock = Lock()
+
+    def __init__(self, outputFormat: Type[BaseModel], onField: Optional[Callable[[str, Any], None]] = None):
+        self.outputFormat   = outputFormat
+        self.onField        = onField
+        self.fields: Dict[str, Any] = {}
+
+        self._validators    = LLMJSONStreamParser.GetFieldValidators(outputFormat)
+        self._forbidExtra   = outputFormat.model_config.get("extra") == "forbid"
+
+        # Each chunk is scanned once. The key or value in progress is kept in
+        # parts so long responses aren't copied on every chunk.
+        self._chunks: List[str] = []
+        self._parts: List[str]  = []
+        self._pending       = ""    # Start of a code fence waiting for the rest of the line
+        self._numReceived   = 0
+        self._state         = LLMJSONStreamParser.EXPECT_START
+        self._start         = 0     # Start of the current key or value within the chunk
+        self._key           = ""
+        self._depth         = 0     # Nesting within the current value
+        self._inString      = False
+        self._escaped       = False
+        self._objectStart   = 0     # In the whole response
+        self._objectEnd     = -1
+
+    @staticmethod
+    def GetFieldValidators(outputFormat: Type[BaseModel]) -> Dict[str, TypeAdapter]:
+        with LLMJSONStreamParser.lock:
+            if not outputFormat in LLMJSONStreamParser.Lookup:
+                # Keys in the JSON are the aliases if set
+                LLMJSONStreamParser.Lookup[outputFormat] = {
+                    (field.alias or name): TypeAdapter(field.annotation)
+                    for name, field in outputFormat.model_fields.items()
+                }
+
+            return LLMJSONStreamParser.Lookup[outputFormat]
+
+    # Everything received so far
+    def getReceived(self) -> str:
+        return "".join(self._chunks)
+
+    # Just the JSON object
+    def getText(self) -> str:
+        received = self.getReceived()
+        return received[self._objectStart:self._objectEnd + 1] if self._objectEnd >= 0 else received[self._objectStart:]
+
+    def isDone(self) -> bool:
+        return self._state == LLMJSONStreamParser.DONE
+
+    def __fail(self, message: str):
+        raise LLMStructuredOutputError(message, self.getReceived())
+
+    def __takeRaw(self, text: str, end: int) -> str:
+        raw = "".join(self._parts) + text[self._start:end]
+        self._parts = []
+        return raw
+
+    def __endValue(self, text: str, end: int):
+        try:
+            value = json.loads(self.__takeRaw(text, end))
+        except json.JSONDecodeError as e:
+            self.__fail(f"Invalid JSON for field '{self._key}': {e}")
+
+        if self._key in self._validators:
+            try:
+                value = self._validators[self._key].validate_python(value)
+            except ValidationError as e:
+                self.__fail(f"Field '{self._key}' doesn't match schema: {e}")
+        elif self._forbidExtra:
+            self.__fail(f"Unexpected field '{self._key}'.")
+
+        self.fields[self._key] = value
+        if self.onField is not None:
+            self.onField(self._key, value)
+
+        self._state = LLMJSONStreamParser.EXPECT_NEXT
+
+    def feed(self, chunk: str):
+        self._chunks.append(chunk)
+        text = self._pending + chunk
+        offset = self._numReceived - len(self._pending) # Of text in the whole response
+        self._pending = ""
+        self._numReceived += len(chunk)
+
+        self._start = 0 # Continues from the previous chunk, if in a key or value
+        self.__scan(text, offset)
+
+        if self._state == LLMJSONStreamParser.IN_KEY or self._state == LLMJSONStreamParser.IN_VALUE:
+            self._parts.append(text[self._start:])
+
+    def __scan(self, text: str, offset: int):
+        pos = 0
+        while pos < len(text):
+            state = self._state
+
+            if (state == LLMJSONStreamParser.IN_VALUE or state == LLMJSONStreamParser.IN_KEY) and not self._escaped:
+                pattern = (LLMJSONStreamParser.StringSpecialPattern if self._inString or state == LLMJSONStreamParser.IN_KEY
+                           else LLMJSONStreamParser.ValueSpecialPattern)
+                match = pattern.search(text, pos)
+                if match is None:
+                    return
+                pos = match.start()
+
+            char = text[pos]
+
+            if state == LLMJSONStreamParser.IN_VALUE:
+                # Scan to the end of the value tracking strings and nesting
+                if self._inString:
+                    if self._escaped:
+                        self._escaped = False
+                    elif char == "\\":
+                        self._escaped = True
+                    elif char == '"':
+                        self._inString = False
+                        if self._depth == 0:
+                            self.__endValue(text, pos + 1)
+                elif char == '"':
+                    self._inString = True
+                elif char in "{[":
+                    self._depth += 1
+                elif char in "}]":
+                    if self._depth == 0:
+                        # End of a number or literal at the end of the object
+                        self.__endValue(text, pos)
+                        continue # Let EXPECT_NEXT handle the brace
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self.__endValue(text, pos + 1)
+                elif self._depth == 0:
+                    # Comma or whitespace after a number or literal
+                    self.__endValue(text, pos)
+                    continue
+            elif state == LLMJSONStreamParser.IN_KEY:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._key = json.loads(self.__takeRaw(text, pos + 1))
+                    self._state = LLMJSONStreamParser.EXPECT_COLON
+            elif char in LLMJSONStreamParser.WHITESPACE:
+                pass
+            elif state == LLMJSONStreamParser.EXPECT_START:
+                if char == "{":
+                    self._objectStart = offset + pos
+                    self._state = LLMJSONStreamParser.EXPECT_KEY
+                elif text.startswith(LLMJSONStreamParser.CODE_FENCE, pos):
+                    # Skip a markdown fence, e.g. ```json
+                    lineEnd = text.find("\n", pos)
+                    if lineEnd < 0:
+                        self._pending = text[pos:] # Wait for the rest of the line
+                        return
+                    pos = lineEnd
+                elif LLMJSONStreamParser.CODE_FENCE.startswith(text[pos:]):
+                    self._pending = text[pos:] # Could be the start of a fence
+                    return
+                else:
+                    self.__fail(f"Expected a JSON object but got '{text[pos:pos + 20]}'.")
+            elif state == LLMJSONStreamParser.EXPECT_KEY:
+                if char == '"':
+                    self._start = pos
+                    self._state = LLMJSONStreamParser.IN_KEY
+                elif char == "}" and len(self.fields) == 0:
+                    self._objectEnd = offset + pos
+                    self._state = LLMJSONStreamParser.DONE
+                else:
+                    self.__fail(f"Expected a field name but got '{char}'.")
+            elif state == LLMJSONStreamParser.EXPECT_COLON:
+                if char == ":":
+                    self._state = LLMJSONStreamParser.EXPECT_VALUE
+                else:
+                    self.__fail(f"Expected ':' after '{self._key}' but got '{char}'.")
+            elif state == LLMJSONStreamParser.EXPECT_VALUE:
+                self._start = pos
+                self._depth = 1 if char in "{[" else 0
+                self._inString = char == '"'
+                self._state = LLMJSONStreamParser.IN_VALUE
+            elif state == LLMJSONStreamParser.EXPECT_NEXT:
+                if char == ",":
+                    self._state = LLMJSONStreamParser.EXPECT_KEY
+                elif char == "}":
+                    self._objectEnd = offset + pos
+                    self._state = LLMJSONStreamParser.DONE
+                else:
+                    self.__fail(f"Expected ',' or '}}' after '{self._key}' but got '{char}'.")
+            elif state == LLMJSONStreamParser.DONE:
+                return # Ignore anything after the object, e.g. a closing fence
+
+            pos += 1
+
+    # Call once the stream ends. Validates the whole object and returns it.
+    def close(self) -> BaseModel:
+        if not self.isDone():
+            self.__fail("Response ended before the JSON object was complete.")
+
+        try:
+            return self.outputFormat.model_validate_json(self.getText())
+        except ValidationError as e:
+            self.__fail(f"Response doesn't match schema: {e}")
+            raise # Not reached
@@ -1,43 +1,117 @@
+import asyncio
 import json
+import time
 
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib        import Path
-from typing         import Optional
+from typing         import Any, Dict, Optional
 
 # Local packages
 from core           import user_module, logs
 from my_secrets     import secrets_mgr
 
 # This package
+from .llm_cache     import LLMResponseCache
+from .llm_context   import LLMContext
 from .llm_define    import *
 from .llm_model     import LLMModel
 from .llm_openai    import OpenAIModel
+from .llm_queue     import LLMRequestQueue, Priority
 from .llm_ollama    import OllamaModel
+from .llm_router    import LLMBackend, LLMRouter, LLMRoutingPolicy
+from .llm_usage     import LLMUsageStats, LLMUsageTracker
         
 class LLMManager(user_module.UserModule):
+    DEFAULT_BATCH_CONCURRENCY   = 4
+    BATCH_POLL_INTERVAL_SECS    = 0.1   # How often to check item timeouts while workers are busy
+    SUMMARIZE_PROMPT            = ("Summarise the conversation below in a few sentences. Keep names, facts, " +
+                                   "decisions and open questions. Reply with the summary only.")
+
     def __init__(self, 
                  clientType: LLMClientType, 
                  model: str, 
                  variant: str,
                  customLLMParamsFilepath: Path = Path(), 
                  verboseOutput: bool = False, 
-                 logMgr = logs.ConfigureConsoleOnlyLogging("LLMManagerLogger")
+                 logMgr = logs.ConfigureConsoleOnlyLogging("LLMManagerLogger"),
+                 connectionParams: LLMConnectionParams = LLMConnectionParams()
                 ):
         
         super().__init__(logMgr)
         
         self.llmInfoLookup: dict[str, LLMInfo] = {}
 
-        self.clientType     = clientType
-        self.verboseOutput  = verboseOutput
+        self.clientType         = clientType
+        self.verboseOutput      = verboseOutput
+        self.connectionParams   = connectionParams
+        self.usageTracker       = LLMUsageTracker()
+
+        self.__loadLLMInfo(customLLMParamsFilepath)
+        self.llmModel: Optional[LLMModel] = self.__createModel(clientType, model, variant)
+
+    def __createModel(self, 
+                      clientType: LLMClientType, 
+                      model: str, 
+                      variant: str, 
+                      host: Optional[str] = None, 
+                      port: Optional[int] = None) -> Optional[LLMModel]:
+        if model in self.llmInfoLookup:
+            info = self.llmInfoLookup[model]
+        else:
+            raise ValueError(f"Unknown LLM model '{model}'. Add it to the custom LLM parameters file.")
         
-        self.llmModel: Optional[LLMModel] = None
+        llmModel: Optional[LLMModel] = None
         if clientType == LLMClientType.OLLAMA:
-            self.llmModel = OllamaModel(info, self.logger, tag, verboseOutput)
+            llmModel = OllamaModel(info, self.logger, variant, self.verboseOutput, self.connectionParams, 
+                                   host = host, port = port)
         elif clientType == LLMClientType.OPENAI:
-            self.llmModel = OpenAIModel(info, self.logger, tag, verboseOutput)
+            llmModel = OpenAIModel(info, self.logger, variant, self.verboseOutput, self.connectionParams)
         else:
             self.logger.error(LogLine("Unknown client type: ", clientType))
 
+        if llmModel is not None:
+            llmModel.setUsageTracker(self.usageTracker)
+
+        return llmModel
+
+    # Route requests across several models, e.g. more Ollama servers or OpenAI as a
+    # fallback. The model passed to the constructor becomes the first backend.
+    # Add backends before calling connectToClient.
+    def addBackend(self, 
+                   clientType: LLMClientType, 
+                   model: str, 
+                   variant: str = "",
+                   host: Optional[str] = None,
+                   port: Optional[int] = None,
+                   costPer1KTokens: float = 0.0,
+                   name: str = "") -> LLMBackend:
+        llmModel = self.__createModel(clientType, model, variant, host, port)
+        if llmModel is None:
+            raise ValueError(f"Unable to create LLM backend for client type {clientType}.")
+
+        return self.__getRouter().addBackend(llmModel, name, costPer1KTokens)
+
+    def setRoutingPolicy(self, 
+                         policy: LLMRoutingPolicy, 
+                         requestTimeoutSecs: Optional[float] = None,
+                         maxAttempts: int = LLMRouter.DEFAULT_MAX_ATTEMPTS):
+        router = self.__getRouter()
+        router.policy               = policy
+        router.requestTimeoutSecs   = requestTimeoutSecs
+        router.maxAttempts          = maxAttempts
+
+    def __getRouter(self) -> LLMRouter:
+        if not isinstance(self.llmModel, LLMRouter):
+            router = LLMRouter(self.logger, verboseOutput = self.verboseOutput)
+            router.setUsageTracker(self.usageTracker)
+            if self.llmModel is not None:
+                router.setRequestQueue(self.llmModel.requestQueue)
+                router.setResponseCache(self.llmModel.responseCache, self.llmModel.cacheNonDeterministic)
+                router.addBackend(self.llmModel)
+            self.llmModel = router
+
+        return self.llmModel
+
     # Override settings if user passes in a configuration file
     # User only needs to specify what to override. All fields optional.
     # {
@@ -52,27 +126,36 @@ class LLMManager(user_module.UserModule):
     #    }
     # }
 
-    def __loadLLMInfo(self, info: LLMInfo, customLLMParamsFilepath: Path):
+    def __loadLLMInfo(self, customLLMParamsFilepath: Path):
 
         # Load defaults first
         for llmInfo in LLMInfo.GetDefaultsLLMInfo():
-            self.
+            self.llmInfoLookup[llmInfo.name] = llmInfo
 
         # The format should match LLMInfo
-        if customLLMParamsFilepath.exists():
+        if customLLMParamsFilepath != Path() and customLLMParamsFilepath.exists():
             with open(customLLMParamsFilepath) as paramsFile:
                 params = json.load(paramsFile)
 
                 if "models" in params:
                     # If user specified overrides for this info
-                    if info.name in params["models"]:
-                        modelOverride = params["models"][info.name]
+                    for name, modelOverride in params["models"].items():
+                        if name in self.llmInfoLookup:
+                            info = self.llmInfoLookup[name]
+                        else:
+                            info = LLMInfo(name, modelOverride.get("tokenizer", ""), 
+                                           modelOverride.get("context", 0), LLMParams())
+                            self.llmInfoLookup[name] = info
                         # Context set?
                         if "context" in modelOverride:
-                            info.value.context = modelOverride["context"]
+                            info.context = modelOverride["context"]
                         # Params set?
-                        if "param" in modelOverride:
-                            info.value.params.from_dict(modelOverride["param"])
+                        if "params" in modelOverride:
+                            for key, value in modelOverride["params"].items():
+                                if hasattr(info.params, key):
+                                    setattr(info.params, key, value)
+                                else:
+                                    raise Exception(f"Unknown LLM param '{key}' for model {name}.")
                 else:
                     raise Exception(f"LLM model param file {customLLMParamsFilepath} not properly formatted.")
                 
@@ -82,6 +165,29 @@ class LLMManager(user_module.UserModule):
     def __del__(self):
         del self.llmModel
     
+    # Serve repeated requests from the cache. See LLMModel.setResponseCache.
+    def setResponseCache(self, responseCache: Optional[LLMResponseCache], cacheNonDeterministic: bool = False):
+        if self.llmModel is not None:
+            self.llmModel.setResponseCache(responseCache, cacheNonDeterministic)
+        else:
+            self.logger.error("LLM model is not defined or initialized.")
+
+    # Admission control for a shared backend. Batches default to low priority so
+    # interactive chats go first. Pass LLMRequestQueue.GetShared(host) to share
+    # the limits with other managers talking to the same server.
+    def setRequestQueue(self, requestQueue: Optional[LLMRequestQueue]):
+        if self.llmModel is not None:
+            self.llmModel.setRequestQueue(requestQueue)
+        else:
+            self.logger.error("LLM model is not defined or initialized.")
+
+    # Token counts and timings per model for every request made through this manager
+    def getUsageStats(self) -> Dict[str, LLMUsageStats]:
+        return self.usageTracker.getStats()
+
+    def exportUsageMetrics(self) -> Dict[str, float]:
+        return self.usageTracker.exportMetrics()
+
     # TODO: replace secrets with apiKey to restrict access
     def connectToClient(self, secretsMgr: secrets_mgr.SecretsMgr) -> bool:
         success = False
@@ -96,23 +202,68 @@ class LLMManager(user_module.UserModule):
     
         return success
 
-    def chat(self, prompt, context: Optional[List[LLMMessage]] = None, role = "user", responseFormat = None) -> str:
-        answer = ""
-        
+    # Conversation history that is trimmed, and optionally summarised, to fit the model's context.
+    # Pass it as the context to chat which then also records the answer.
+    def createContext(self, 
+                      budgetTokens: Optional[int] = None, 
+                      summarize: bool = False,
+                      keepRecentMessages: int = LLMContext.DEFAULT_KEEP_RECENT_MESSAGES) -> LLMContext:
+        if self.llmModel is None:
+            raise ValueError("LLM model is not defined or initialized.")
+
+        return LLMContext(self.llmModel, 
+                          budgetTokens, 
+                          self.summarizeMessages if summarize else None,
+                          keepRecentMessages,
+                          self.logger)
+
+    def summarizeMessages(self, messages: List[LLMMessage]) -> str:
+        transcript = "\n".join(f"{message.role}: {message.content}" for message in messages)
+        return self.chat(f"{LLMManager.SUMMARIZE_PROMPT}\n\n{transcript}")
+
+    def __buildMessages(self, prompt, context: Optional[List[LLMMessage] | LLMContext], role: str) -> List[LLMMessage]:
         # Capture earlier conversations
         messagesToSend: List[LLMMessage] = []
-        if context is not None:
+        if isinstance(context, LLMContext):
+            context.append(LLMMessage(role, prompt))
+            return context.getMessages()
+        elif context is not None:
             messagesToSend = context
     
         # Append new prompt
         messagesToSend.append(LLMMessage(role, prompt))
 
+        return messagesToSend
+
+    def __recordAnswer(self, context: Optional[List[LLMMessage] | LLMContext], answer):
+        if isinstance(context, LLMContext) and answer:
+            if isinstance(answer, str):
+                content = answer
+            elif hasattr(answer, "model_dump_json"):
+                content = answer.model_dump_json()
+            else:
+                content = json.dumps(answer, default = str)
+            context.append(LLMMessage("assistant", content))
+
+    # Priority and deadlineSecs only apply with a request queue, see setRequestQueue.
+    def chat(self, 
+             prompt, 
+             context: Optional[List[LLMMessage] | LLMContext]   = None, 
+             role                                               = "user", 
+             responseFormat                                     = None,
+             priority: Priority                                 = Priority.P3_Medium,
+             deadlineSecs: Optional[float]                      = None) -> str:
+        answer = ""
+        
+        messagesToSend = self.__buildMessages(prompt, context, role)
+
         if self.llmModel is not None:
             if self.verboseOutput:
                 self.logger.debug(LogLine("Estimated input token count: ", 
                                         self.llmModel.getTokenCountFromMessages(messagesToSend)))
 
-            answer = self.llmModel.chat(messagesToSend, responseFormat)
+            answer = self.llmModel.chat(messagesToSend, responseFormat, priority = priority, deadlineSecs = deadlineSecs)
+            self.__recordAnswer(context, answer)
 
             # TODO: clean this up
             if self.verboseOutput and answer is not None:
@@ -121,4 +272,212 @@ class LLMManager(user_module.UserModule):
         else:
             self.logger.error("LLM model is not defined or initialized.")
 
-        return answer
\ No newline at end of file
+        return answer
+    
+    # Async version of chat. Many calls can be awaited concurrently from one
+    # event loop, limited only by the connection pool size.
+    async def achat(self, 
+                    prompt, 
+                    context: Optional[List[LLMMessage] | LLMContext]    = None, 
+                    role                                                = "user", 
+                    responseFormat                                      = None,
+                    priority: Priority                                  = Priority.P3_Medium,
+                    deadlineSecs: Optional[float]                       = None) -> str:
+        answer = ""
+        
+        messagesToSend = self.__buildMessages(prompt, context, role)
+
+        if self.llmModel is not None:
+            answer = await self.llmModel.achat(messagesToSend, responseFormat, priority = priority, deadlineSecs = deadlineSecs)
+            self.__recordAnswer(context, answer)
+        else:
+            self.logger.error("LLM model is not defined or initialized.")
+
+        return answer
+
+    # Like chat with a response format but fields are handed to onField as they
+    # arrive and an answer that breaks the schema is retried with a repair prompt
+    def chatStructured(self,
+                       prompt,
+                       responseFormat,
+                       context: Optional[List[LLMMessage] | LLMContext] = None,
+                       role = "user",
+                       onField: Optional[Callable[[str, Any], None]] = None,
+                       maxRepairAttempts: int = LLMModel.DEFAULT_MAX_REPAIR_ATTEMPTS,
+                       priority: Priority = Priority.P3_Medium,
+                       deadlineSecs: Optional[float] = None):
+        answer = None
+
+        messagesToSend = self.__buildMessages(prompt, context, role)
+
+        if self.llmModel is not None:
+            answer = self.llmModel.chatStructured(messagesToSend, responseFormat, onField, maxRepairAttempts,
+                                                  priority = priority, deadlineSecs = deadlineSecs)
+            self.__recordAnswer(context, answer)
+        else:
+            self.logger.error("LLM model is not defined or initialized.")
+
+        return answer
+
+    def __countBatchTokens(self, item: LLMBatchItem, messages: List[LLMMessage]):
+        if self.llmModel is not None:
+            answer = item.answer if isinstance(item.answer, str) else json.dumps(item.answer, default = str)
+            item.inputTokens  = self.llmModel.getTokenCountFromMessages(messages)
+            item.outputTokens = self.llmModel.getTokenCountFromMessages([LLMMessage("assistant", answer)])
+
+    # Runs on a worker thread. Returns the result rather than updating the shared
+    # item so an item that already timed out isn't overwritten.
+    def __runBatchItem(self, prompt, context, role, responseFormat, countTokens: bool, priority: Priority) -> LLMBatchItem:
+        if self.llmModel is None:
+            raise ValueError("LLM model is not defined or initialized.")
+
+        item = LLMBatchItem(prompt)
+        # Each prompt gets its own copy of the context since chat appends to it
+        messagesToSend = self.__buildMessages(prompt, list(context) if context is not None else None, role)
+
+        start = time.monotonic()
+        item.answer = self.llmModel.chat(messagesToSend, responseFormat, raiseOnError = True, priority = priority)
+        item.elapsedSecs = time.monotonic() - start
+
+        if countTokens:
+            self.__countBatchTokens(item, messagesToSend)
+
+        return item
+
+    # Send many prompts concurrently with at most maxConcurrency in flight. Results are 
+    # in the same order as the prompts and a failed or timed out item doesn't fail the batch.
+    # Timed out requests can't be interrupted so they finish in the background and are discarded.
+    def chatBatch(self, 
+                  prompts: List[str], 
+                  maxConcurrency: int = DEFAULT_BATCH_CONCURRENCY,
+                  context: Optional[List[LLMMessage]] = None, 
+                  role = "user", 
+                  responseFormat = None,
+                  itemTimeoutSecs: Optional[float] = None,
+                  countTokens: bool = True,
+                  priority: Priority = Priority.P4_Low) -> LLMBatchResult:
+        
+        result = LLMBatchResult([LLMBatchItem(prompt) for prompt in prompts])
+        startTimes: List[Optional[float]] = [None] * len(prompts)
+        batchStart = time.monotonic()
+
+        def fnRun(idx: int) -> LLMBatchItem:
+            startTimes[idx] = time.monotonic()
+            return self.__runBatchItem(prompts[idx], context, role, responseFormat, countTokens, priority)
+
+        executor = ThreadPoolExecutor(max_workers = max(1, maxConcurrency), thread_name_prefix = "LLMBatch")
+        try:
+            futures: Dict[Future, int] = { executor.submit(fnRun, idx): idx for idx in range(len(prompts)) }
+            pending = set(futures.keys())
+
+            while len(pending) > 0:
+                waitSecs: Optional[float] = None
+
+                # Expire items that have been running for too long
+                if itemTimeoutSecs is not None:
+                    now = time.monotonic()
+                    waitSecs = LLMManager.BATCH_POLL_INTERVAL_SECS
+                    for future in list(pending):
+                        startTime = startTimes[futures[future]]
+                        if startTime is not None and not future.done():
+                            remainingSecs = itemTimeoutSecs - (now - startTime)
+                            if remainingSecs <= 0:
+                                item = result.items[futures[future]]
+                                item.error = TimeoutError(f"LLM request timed out after {itemTimeoutSecs}s")
+                                item.elapsedSecs = now - startTime
+                                pending.discard(future)
+                            else:
+                                waitSecs = min(waitSecs, remainingSecs)
+
+                done, pending = wait(pending, timeout = waitSecs, return_when = FIRST_COMPLETED)
+                for future in done:
+                    idx = futures[future]
+                    exception = future.exception()
+                    if exception is not None:
+                        result.items[idx].error = exception
+                        result.items[idx].elapsedSecs = time.monotonic() - (startTimes[idx] or batchStart)
+                    else:
+                        result.items[idx] = future.result()
+        finally:
+            # Don't wait on requests that timed out
+            executor.shutdown(wait = False, cancel_futures = True)
+
+        result.elapsedSecs = time.monotonic() - batchStart
+        self.__logBatchResult(result)
+
+        return result
+
+    # Async version of chatBatch. Timed out requests are cancelled.
+    async def achatBatch(self, 
+                         prompts: List[str], 
+                         maxConcurrency: int = DEFAULT_BATCH_CONCURRENCY,
+                         context: Optional[List[LLMMessage]] = None, 
+                         role = "user", 
+                         responseFormat = None,
+                         itemTimeoutSecs: Optional[float] = None,
+                         countTokens: bool = True,
+                         priority: Priority = Priority.P4_Low) -> LLMBatchResult:
+        
+        result = LLMBatchResult([LLMBatchItem(prompt) for prompt in prompts])
+        semaphore = asyncio.Semaphore(max(1, maxConcurrency))
+        batchStart = time.monotonic()
+
+        async def fnRun(item: LLMBatchItem):
+            async with semaphore:
+                start = time.monotonic()
+                try:
+                    if self.llmModel is None:
+                        raise ValueError("LLM model is not defined or initialized.")
+                    
+                    messagesToSend = self.__buildMessages(item.prompt, list(context) if context is not None else None, role)
+                    item.answer = await asyncio.wait_for(
+                        self.llmModel.achat(messagesToSend, responseFormat, raiseOnError = True, priority = priority), 
+                        itemTimeoutSecs
+                    )
+                    if countTokens:
+                        self.__countBatchTokens(item, messagesToSend)
+                except Exception as e:
+                    item.error = e
+                item.elapsedSecs = time.monotonic() - start
+
+        await asyncio.gather(*(fnRun(item) for item in result.items))
+
+        result.elapsedSecs = time.monotonic() - batchStart
+        self.__logBatchResult(result)
+
+        return result
+    
+    def __logBatchResult(self, result: LLMBatchResult):
+        if self.verboseOutput:
+            self.logger.debug(f"Batch of {len(result.items)} took {result.elapsedSecs:.2f}s, " +
+                              f"{result.numFailed} failed, {result.requestsPerSec:.2f} requests/s, " +
+                              f"{result.tokensPerSec:.1f} tokens/s")
+
+    # Close pooled async connections. Must be awaited on the loop that used them.
+    async def aclose(self):
+        if self.llmModel is not None:
+            await self.llmModel.aclose()
+
+    # Same as chat but returns deltas as they are generated. Iterate with either
+    # "for" or "async for". The final delta carries usage and other metadata.
+    def chatStream(self, 
+                   prompt, 
+                   context: Optional[List[LLMMessage] | LLMContext] = None, 
+                   role                                             = "user", 
+                   responseFormat                                   = None,
+                   priority: Priority                               = Priority.P3_Medium,
+                   deadlineSecs: Optional[float]                    = None) -> LLMStream:
+        messagesToSend = self.__buildMessages(prompt, context, role)
+
+        if self.llmModel is None:
+            raise ValueError("LLM model is not defined or initialized.")
+        
+        if self.verboseOutput:
+            self.logger.debug(LogLine("Estimated input token count: ", 
+                                    self.llmModel.getTokenCountFromMessages(messagesToSend)))
+
+        # Answer is only known once the caller has read the whole stream
+        stream = self.llmModel.chatStream(messagesToSend, responseFormat, priority, deadlineSecs)
+        stream.setCompleteHandler(lambda stream: self.__recordAnswer(context, stream.content))
+
+        return stream
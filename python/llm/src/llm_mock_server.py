@@ -0,0 +1,218 @@
+import asyncio
+import json
+import random
+import time
+import uuid
+import uvicorn
+
+from dataclasses        import dataclass
+from fastapi            import FastAPI, Request
+from fastapi.responses  import JSONResponse, StreamingResponse
+from threading          import Thread
+from typing             import AsyncIterator, List, Optional
+
+@dataclass
+class MockLLMParams:
+    tokensPerSec: float             = 50.0
+    firstTokenLatencySecs: float    = 0.2   # Time to first token, includes prompt processing
+    responseTokens: int             = 64    # Unless the request sets num_predict or max_tokens
+    failureRate: float              = 0.0   # Share of requests rejected with errorStatusCode
+    midStreamFailureRate: float     = 0.0   # Share of requests where the connection drops part way
+    errorStatusCode: int            = 500
+    seed: Optional[int]             = None
+
+    # What the server spends per request, used to tell client overhead apart
+    def getExpectedDurationSecs(self, numTokens: int) -> float:
+        return self.firstTokenLatencySecs + (numTokens / self.tokensPerSec if self.tokensPerSec > 0 else 0.0)
+
+# Stand-in for Ollama's /api/chat and OpenAI's chat completions for benchmarks and
+# tests without a live model. Tokens are words of filler text streamed at a fixed
+# rate. Failures can be injected before or part way through a response.
+class MockLLMServer:
+    FILLER_WORDS = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit")
+    STARTUP_TIMEOUT_SECS = 10
+
+    def __init__(self, params: MockLLMParams = MockLLMParams(), host: str = "127.0.0.1", port: int = 11500):
+        self.params         = params
+        self.host           = host
+        self.port           = port
+        self.numRequests    = 0
+        self.numFailures    = 0
+
+        self._random    = random.Random(params.seed)
+        self._server: Optional[uvicorn.Server]  = None
+        self._thread: Optional[Thread]          = None
+
+        self.app = FastAPI()
+        self.app.add_api_route("/api/version", self.__ollamaVersion, methods = ["GET"])
+        self.app.add_api_route("/api/chat", self.__ollamaChat, methods = ["POST"])
+        self.app.add_api_route("/v1/models/{model}", self.__openAIModel, methods = ["GET"])
+        self.app.add_api_route("/v1/chat/completions", self.__openAIChat, methods = ["POST"])
+
+    def getURL(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> bool:
+        config = uvicorn.Config(self.app, host = self.host, port = self.port, log_level = "warning")
+        self._server = uvicorn.Server(config)
+        self._thread = Thread(name = "MockLLMServer_Thread", target = self._run, daemon = True)
+        self._thread.start()
+
+        # Wait until it's accepting connections
+        deadline = time.monotonic() + MockLLMServer.STARTUP_TIMEOUT_SECS
+        while not self._server.started and self._thread.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        return self._server.started
+
+    def _run(self):
+        if self._server is not None:
+            asyncio.run(self._server.serve())
+
+    def stop(self):
+        if self._server is not None:
+            self._server.should_exit = True
+            if self._thread is not None:
+                self._thread.join()
+            self._server = None
+            self._thread = None
+
+    def __getTokens(self, requested: Optional[int]) -> List[str]:
+        numTokens = requested if requested is not None and requested > 0 else self.params.responseTokens
+        return [MockLLMServer.FILLER_WORDS[idx % len(MockLLMServer.FILLER_WORDS)] + " " for idx in range(numTokens)]
+
+    @staticmethod
+    def __countPromptTokens(messages: List[dict]) -> int:
+        return sum(len(str(message.get("content", "")).split()) for message in messages)
+
+    # Decide up front so the outcome doesn't depend on how far the client reads
+    def __rollFailures(self):
+        self.numRequests += 1
+        fail = self._random.random() < self.params.failureRate
+        failMidStream = self._random.random() < self.params.midStreamFailureRate
+        if fail or failMidStream:
+            self.numFailures += 1
+
+        return fail, failMidStream
+
+    # Paced against the start time so sleep overshoot doesn't accumulate
+    async def __generate(self, tokens: List[str], failMidStream: bool) -> AsyncIterator[str]:
+        await asyncio.sleep(self.params.firstTokenLatencySecs)
+        start = time.monotonic()
+        failAt = len(tokens) // 2 if failMidStream else -1
+
+        for idx, token in enumerate(tokens):
+            if idx == failAt:
+                raise ConnectionAbortedError("Injected mid stream failure.")
+            if self.params.tokensPerSec > 0:
+                delay = start + idx / self.params.tokensPerSec - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield token
+
+    def __errorResponse(self) -> JSONResponse:
+        return JSONResponse({"error": "Injected failure."}, status_code = self.params.errorStatusCode)
+
+    async def __ollamaVersion(self):
+        return {"version": "mock"}
+
+    async def __ollamaChat(self, request: Request):
+        body = await request.json()
+        fail, failMidStream = self.__rollFailures()
+        if fail:
+            return self.__errorResponse()
+
+        model       = body.get("model", "")
+        messages    = body.get("messages", [])
+        tokens      = self.__getTokens(body.get("options", {}).get("num_predict"))
+        start       = time.monotonic_ns()
+
+        def fnChunk(content: str, done: bool) -> dict:
+            return {
+                "model":        model,
+                "created_at":   time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "message":      {"role": "assistant", "content": content},
+                "done":         done
+            }
+
+        async def fnStream():
+            async for token in self.__generate(tokens, failMidStream):
+                yield json.dumps(fnChunk(token, False)) + "\n"
+
+            totalDuration = time.monotonic_ns() - start
+            final = fnChunk("", True)
+            final.update({
+                "done_reason":          "stop",
+                "total_duration":       totalDuration,
+                "load_duration":        0,
+                "prompt_eval_count":    MockLLMServer.__countPromptTokens(messages),
+                "prompt_eval_duration": int(self.params.firstTokenLatencySecs * 1e9),
+                "eval_count":           len(tokens),
+                "eval_duration":        totalDuration - int(self.params.firstTokenLatencySecs * 1e9)
+            })
+            yield json.dumps(final) + "\n"
+
+        if body.get("stream", True):
+            return StreamingResponse(fnStream(), media_type = "application/x-ndjson")
+        else:
+            chunks = [json.loads(line) async for line in fnStream()]
+            response = chunks[-1]
+            response["message"]["content"] = "".join(chunk["message"]["content"] for chunk in chunks)
+            return response
+
+    async def __openAIModel(self, model: str):
+        return {"id": model, "object": "model", "created": 0, "owned_by": "mock"}
+
+    async def __openAIChat(self, request: Request):
+        body = await request.json()
+        fail, failMidStream = self.__rollFailures()
+        if fail:
+            return self.__errorResponse()
+
+        completionID    = f"chatcmpl-{uuid.uuid4().hex}"
+        created         = int(time.time())
+        model           = body.get("model", "")
+        tokens          = self.__getTokens(body.get("max_completion_tokens", body.get("max_tokens")))
+        promptTokens    = MockLLMServer.__countPromptTokens(body.get("messages", []))
+        usage           = {
+            "prompt_tokens":        promptTokens,
+            "completion_tokens":    len(tokens),
+            "total_tokens":         promptTokens + len(tokens)
+        }
+
+        def fnChunk(delta: dict, finishReason: Optional[str]) -> dict:
+            return {
+                "id":       completionID,
+                "object":   "chat.completion.chunk",
+                "created":  created,
+                "model":    model,
+                "choices":  [{"index": 0, "delta": delta, "finish_reason": finishReason}]
+            }
+
+        async def fnStream():
+            first = True
+            async for token in self.__generate(tokens, failMidStream):
+                delta = {"role": "assistant", "content": token} if first else {"content": token}
+                first = False
+                yield f"data: {json.dumps(fnChunk(delta, None))}\n\n"
+
+            yield f"data: {json.dumps(fnChunk({}, 'stop'))}\n\n"
+            if body.get("stream_options", {}).get("include_usage"):
+                usageChunk = fnChunk({}, None)
+                usageChunk["choices"] = []
+                usageChunk["usage"] = usage
+                yield f"data: {json.dumps(usageChunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        if body.get("stream", False):
+            return StreamingResponse(fnStream(), media_type = "text/event-stream")
+        else:
+            content = "".join([token async for token in self.__generate(tokens, failMidStream)])
+            return {
+                "id":       completionID,
+                "object":   "chat.completion",
+                "created":  created,
+                "model":    model,
+                "choices":  [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage":    usage
+            }
@@ -1,64 +1,424 @@
-import json
+import asyncio
+import dataclasses
 import time
 
 # Local packages
 from abc            import ABC, abstractmethod
+from contextlib     import closing, nullcontext
+from typing         import Any, AsyncIterator, Callable, Iterator
 from core           import user_module, logs
 from my_secrets     import secrets_mgr
 
 # This package
+from .llm_cache     import LLMResponseCache
 from .llm_define    import *
+from .llm_json      import LLMJSONStreamParser, LLMStructuredOutputError
+from .llm_queue     import LLMRequestQueue, LLMRequestTicket, Priority
+from .llm_tokenizer import TokenCountCache
+from .llm_usage     import LLMUsageTracker
 
 class LLMModel(ABC):
-    def __init__(self, info: LLMInfo, logger, variant: str = "", verboseOutput: bool = False):
-        self.info          = info
-        self.logger        = logger
-        self.variant       = variant
-        self.verboseOutput = verboseOutput
+    DEFAULT_HEALTH_CHECK_TIMEOUT_SECS   = 5
+    DEFAULT_MAX_REPAIR_ATTEMPTS         = 1
+    REPAIR_PROMPT                       = ("Your previous reply is not valid JSON for the requested schema: {error} " +
+                                           "Reply again with only the complete JSON object.")
+
+    def __init__(self, info: LLMInfo, logger, variant: str = "", verboseOutput: bool = False,
+                 connectionParams: LLMConnectionParams = LLMConnectionParams()):
+        self.info               = info
+        self.logger             = logger
+        self.variant            = variant
+        self.verboseOutput      = verboseOutput
+        self.connectionParams   = connectionParams
+
+        self.responseCache: Optional[LLMResponseCache]  = None
+        self.cacheNonDeterministic                      = False
+
+        # Context messages are resent every turn so remember their token counts
+        self.tokenCountCache                            = TokenCountCache()
+
+        self.usageTracker: Optional[LLMUsageTracker]    = None
+        self.requestQueue: Optional[LLMRequestQueue]    = None
+
+        # Closes of replaced async clients still running on the caller's event loop
+        self.pendingCloses: set[asyncio.Task]           = set()
 
     def connectToClient(self, secretsMgr: secrets_mgr.SecretsMgr) -> bool:
         raise Exception("LLMModel's connectToClient must be overriden in child class.")
+    
+    # Opt in to caching responses. By default only requests with deterministic params
+    # are cached since otherwise the same prompt is expected to give different answers.
+    def setResponseCache(self, responseCache: Optional[LLMResponseCache], cacheNonDeterministic: bool = False):
+        self.responseCache          = responseCache
+        self.cacheNonDeterministic  = cacheNonDeterministic
+
+    # Record token counts and timings of every request
+    def setUsageTracker(self, usageTracker: Optional[LLMUsageTracker]):
+        self.usageTracker = usageTracker
+
+    def __recordUsage(self, 
+                      usage: Optional[LLMUsage], 
+                      start: float, 
+                      firstTokenSecs: float                 = 0.0, 
+                      cached: bool                          = False, 
+                      ticket: Optional[LLMRequestTicket]    = None):
+        if ticket is not None and usage is not None and usage.totalTokens > 0:
+            ticket.usedTokens = usage.totalTokens
+
+        if self.usageTracker is not None:
+            if usage is None:
+                usage = LLMUsage()
+            usage.model     = self._getModelHandle() # Backends may report a different name
+            usage.cached    = cached
+            usage.setElapsed(time.time() - start, firstTokenSecs)
+            if ticket is not None:
+                usage.queueSecs = max(usage.queueSecs, ticket.waitSecs)
+            self.usageTracker.record(usage)
+
+    # Requests wait their turn here before being sent. Share one queue between
+    # models using the same server, see LLMRequestQueue.GetShared.
+    def setRequestQueue(self, requestQueue: Optional[LLMRequestQueue]):
+        self.requestQueue = requestQueue
+
+    def __getEstimatedTokens(self, messages: List[LLMMessage]) -> int:
+        return self.getTokenCountFromMessages(messages) if self.requestQueue is not None and self.requestQueue.isRateLimited() else 0
+
+    # Context managers yield the ticket, or None without a queue
+    def __admit(self, messages: List[LLMMessage], priority: Priority, deadlineSecs: Optional[float]):
+        if self.requestQueue is None:
+            return nullcontext(None)
+
+        return self.requestQueue.admit(priority, self.__getEstimatedTokens(messages), deadlineSecs)
+
+    def __aadmit(self, messages: List[LLMMessage], priority: Priority, deadlineSecs: Optional[float]):
+        if self.requestQueue is None:
+            return nullcontext(None)
+
+        return self.requestQueue.aadmit(priority, self.__getEstimatedTokens(messages), deadlineSecs)
+
+    def __getCacheKey(self, messages: List[LLMMessage], outputFormatJSON) -> Optional[str]:
+        cacheKey: Optional[str] = None
+
+        if (self.responseCache is not None 
+            and (self.cacheNonDeterministic or self.info.params.isDeterministic())):
+            cacheKey = LLMResponseCache.GetKey(
+                self._getModelHandle(),
+                dataclasses.asdict(self.info.params),
+                [message.to_dict() for message in messages],
+                outputFormatJSON
+            )
+
+        return cacheKey
+
+    # Release pooled connections held by the async client, if any.
+    async def aclose(self):
+        pass
+
+    # connectToClient is sync, so close a replaced async client on the running loop
+    # when there is one, otherwise on a loop of its own.
+    def _closeReplacedAsyncClient(self, closeCoro):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        try:
+            if loop is None:
+                asyncio.run(closeCoro)
+            else:
+                task = loop.create_task(closeCoro)
+                self.pendingCloses.add(task)
+                task.add_done_callback(self.pendingCloses.discard)
+        except Exception as e:
+            self.logger.warning(f"Unable to close replaced async client: {e}")
+
+    def __prepareChat(self, messages: List[LLMMessage], outputFormat):
+        outputFormatJSON = None
+        if outputFormat is not None:
+            outputFormatJSON = outputFormat.model_json_schema()
+
+        if self.verboseOutput:
+            self.logger.debug("Messages sent: ")
+            for message in messages:
+                self.logger.debug(f"Role: message.role")
+                self.logger.debug(f"Content: message.content")
+
+        return outputFormatJSON
+
+    def __processResponse(self, response, cacheKey: Optional[str], start: float, ticket: Optional[LLMRequestTicket]) -> str:
+        if self.verboseOutput:
+            self.logger.debug(LogLine("Response: ", response))
+        parsedResponse = self._parseResponse(response)
+        self.__recordUsage(parsedResponse.usage, start, ticket = ticket)
+        
+        # TODO: revisit how to handle multiple responses. Not to be confused with streaming.
+        firstMessage = parsedResponse.messages[0]
+
+        # Only cache complete answers
+        if (cacheKey is not None and self.responseCache is not None 
+            and parsedResponse.status == LLMResponseStatus.SUCCEEDED):
+            self.responseCache.put(cacheKey, firstMessage.content)
+
+        return firstMessage.content
+
+    def __logElapsed(self, start: float):
+        elapsed = time.time() - start
+        if self.verboseOutput:
+            self.logger.debug(f"Query took: {elapsed}s")
+
+    # Errors are logged and an empty answer returned unless raiseOnError is set.
+    # With an outputFormat the answer is an instance of it, see chatStructured.
+    # Priority and deadlineSecs only apply if a request queue is set: the request
+    # is dropped if it can't start within deadlineSecs.
+    def chat(self, 
+             messages: List[LLMMessage], 
+             outputFormat                   = None, 
+             raiseOnError: bool             = False,
+             priority: Priority             = Priority.P3_Medium,
+             deadlineSecs: Optional[float]  = None) -> str:
+        if outputFormat is not None:
+            return self.chatStructured(messages, outputFormat, raiseOnError = raiseOnError, 
+                                       priority = priority, deadlineSecs = deadlineSecs)
 
-    def chat(self, messages: List[LLMMessage], outputFormat = None) -> str:
         answer = ""
         
         try:
             start = time.time()
+            outputFormatJSON = self.__prepareChat(messages, outputFormat)
+            
+            cacheKey = self.__getCacheKey(messages, outputFormatJSON)
+            content = self.responseCache.get(cacheKey) if cacheKey is not None and self.responseCache is not None else None
+            if content is None:
+                with self.__admit(messages, priority, deadlineSecs) as ticket:
+                    response = self._doChat(messages, outputFormatJSON) # Actually send the request and get response
+                    content = self.__processResponse(response, cacheKey, start, ticket)
+            else:
+                self.__recordUsage(None, start, cached = True)
 
-            outputFormatJSON = None
-            if outputFormat is not None:
-                outputFormatJSON = outputFormat.model_json_schema()
+            answer = content
+            self.__logElapsed(start)
+        except Exception as e:
+            self.logger.exception("Enable to send message to client.")
+            if raiseOnError:
+                raise
 
-            if self.verboseOutput:
-                self.logger.debug("Messages sent: ")
-                for message in messages:
-                    self.logger.debug(f"Role: message.role")
-                    self.logger.debug(f"Content: message.content")
-    
-            response = self._doChat(messages, outputFormatJSON) # Actually send the request and get response
-            if self.verboseOutput:
-                self.logger.debug(LogLine("Response: ", response))
-            parsedResponse = self._parseResponse(response)
-            
-            # TODO: revisit how to handle multiple responses. Not to be confused with streaming.
-            firstMessage = parsedResponse.messages[0]
+        return answer
 
-            if outputFormatJSON is not None:
-                if self.verboseOutput:
-                    self.logger.debug(LogLine("Response content: ", json.dumps(firstMessage.content, indent = 4)))
-                answer = outputFormatJSON.model_validate_json(firstMessage.content)
-            else:
-                answer = firstMessage.content
+    # Same as chat but doesn't tie up a thread while waiting on the backend.
+    async def achat(self, 
+                    messages: List[LLMMessage], 
+                    outputFormat                    = None, 
+                    raiseOnError: bool              = False,
+                    priority: Priority              = Priority.P3_Medium,
+                    deadlineSecs: Optional[float]   = None) -> str:
+        if outputFormat is not None:
+            return await self.achatStructured(messages, outputFormat, raiseOnError = raiseOnError,
+                                              priority = priority, deadlineSecs = deadlineSecs)
 
-            elapsed = time.time() - start
-            if self.verboseOutput:
-                self.logger.debug(f"Query took: {elapsed}s")
+        answer = ""
+        
+        try:
+            start = time.time()
+            outputFormatJSON = self.__prepareChat(messages, outputFormat)
+
+            cacheKey = self.__getCacheKey(messages, outputFormatJSON)
+            content = self.responseCache.get(cacheKey) if cacheKey is not None and self.responseCache is not None else None
+            if content is None:
+                async with self.__aadmit(messages, priority, deadlineSecs) as ticket:
+                    response = await self._doChatAsync(messages, outputFormatJSON)
+                    content = self.__processResponse(response, cacheKey, start, ticket)
+            else:
+                self.__recordUsage(None, start, cached = True)
 
+            answer = content
+            self.__logElapsed(start)
         except Exception as e:
             self.logger.exception("Enable to send message to client.")
+            if raiseOnError:
+                raise
+
+        return answer
+
+    # Ask again showing the model what it sent and what was wrong with it
+    def __getRepairMessages(self, messages: List[LLMMessage], error: LLMStructuredOutputError) -> List[LLMMessage]:
+        self.logger.warning(LogLine("Structured response rejected, asking model to repair it: ", error))
+        return list(messages) + [LLMMessage("assistant", error.text),
+                                 LLMMessage("user", LLMModel.REPAIR_PROMPT.format(error = error))]
+
+    def __finishStructured(self, parser: LLMJSONStreamParser, cacheKey: Optional[str], start: float):
+        answer = parser.close()
+        if cacheKey is not None and self.responseCache is not None:
+            self.responseCache.put(cacheKey, parser.getText())
+
+        if self.verboseOutput:
+            self.logger.debug(LogLine("Response content: ", parser.getText()))
+        self.__logElapsed(start)
+
+        return answer
+
+    # Structured answers are streamed and parsed as they arrive so a response that can't
+    # match the schema is cut off early. The model is then asked to repair it, up to 
+    # maxRepairAttempts times. Each top level field is passed to onField as soon as it's
+    # complete, a field may be passed again after a repair. Returns an outputFormat instance.
+    def chatStructured(self, 
+                       messages: List[LLMMessage], 
+                       outputFormat, 
+                       onField: Optional[Callable[[str, Any], None]] = None,
+                       maxRepairAttempts: int = DEFAULT_MAX_REPAIR_ATTEMPTS,
+                       raiseOnError: bool = False,
+                       priority: Priority = Priority.P3_Medium,
+                       deadlineSecs: Optional[float] = None):
+        answer = None
+
+        try:
+            start = time.time()
+            outputFormatJSON = self.__prepareChat(messages, outputFormat)
+
+            cacheKey = self.__getCacheKey(messages, outputFormatJSON)
+            content = self.responseCache.get(cacheKey) if cacheKey is not None and self.responseCache is not None else None
+            if content is not None:
+                parser = LLMJSONStreamParser(outputFormat, onField)
+                parser.feed(content)
+                answer = parser.close()
+                self.__recordUsage(None, start, cached = True)
+            else:
+                attemptMessages = messages
+                for attempt in range(maxRepairAttempts + 1):
+                    parser = LLMJSONStreamParser(outputFormat, onField)
+                    attemptStart = time.time()
+                    try:
+                        # Closing the stream drops the connection so the backend stops generating
+                        with (self.__admit(attemptMessages, priority, deadlineSecs) as ticket, 
+                              closing(self._doChatStream(attemptMessages, outputFormatJSON)) as stream):
+                            for delta in stream:
+                                if delta.done:
+                                    self.__recordUsage(delta.usage, attemptStart, ticket = ticket)
+                                parser.feed(delta.content)
+
+                        answer = self.__finishStructured(parser, cacheKey, start)
+                        break
+                    except LLMStructuredOutputError as e:
+                        if attempt == maxRepairAttempts:
+                            raise
+                        attemptMessages = self.__getRepairMessages(messages, e)
+        except Exception as e:
+            self.logger.exception("Unable to get structured response from client.")
+            if raiseOnError:
+                raise
 
         return answer
 
+    async def achatStructured(self, 
+                              messages: List[LLMMessage], 
+                              outputFormat, 
+                              onField: Optional[Callable[[str, Any], None]] = None,
+                              maxRepairAttempts: int = DEFAULT_MAX_REPAIR_ATTEMPTS,
+                              raiseOnError: bool = False,
+                              priority: Priority = Priority.P3_Medium,
+                              deadlineSecs: Optional[float] = None):
+        if not self._hasAsyncClient():
+            return await asyncio.to_thread(self.chatStructured, messages, outputFormat, onField, maxRepairAttempts, raiseOnError,
+                                           priority, deadlineSecs)
+
+        answer = None
+
+        try:
+            start = time.time()
+            outputFormatJSON = self.__prepareChat(messages, outputFormat)
+
+            cacheKey = self.__getCacheKey(messages, outputFormatJSON)
+            content = self.responseCache.get(cacheKey) if cacheKey is not None and self.responseCache is not None else None
+            if content is not None:
+                parser = LLMJSONStreamParser(outputFormat, onField)
+                parser.feed(content)
+                answer = parser.close()
+                self.__recordUsage(None, start, cached = True)
+            else:
+                attemptMessages = messages
+                for attempt in range(maxRepairAttempts + 1):
+                    parser = LLMJSONStreamParser(outputFormat, onField)
+                    attemptStart = time.time()
+                    try:
+                        async with self.__aadmit(attemptMessages, priority, deadlineSecs) as ticket:
+                            stream = self._doChatStreamAsync(attemptMessages, outputFormatJSON)
+                            try:
+                                async for delta in stream:
+                                    if delta.done:
+                                        self.__recordUsage(delta.usage, attemptStart, ticket = ticket)
+                                    parser.feed(delta.content)
+                            finally:
+                                await stream.aclose()
+
+                        answer = self.__finishStructured(parser, cacheKey, start)
+                        break
+                    except LLMStructuredOutputError as e:
+                        if attempt == maxRepairAttempts:
+                            raise
+                        attemptMessages = self.__getRepairMessages(messages, e)
+        except Exception as e:
+            self.logger.exception("Unable to get structured response from client.")
+            if raiseOnError:
+                raise
+
+        return answer
+
+    # Returns as soon as the request is prepared. The request is only sent once the 
+    # caller starts iterating and deltas are yielded as they arrive from the backend.
+    # The queue slot, if any, is held until the stream is consumed or closed.
+    def chatStream(self, 
+                   messages: List[LLMMessage], 
+                   outputFormat                     = None,
+                   priority: Priority               = Priority.P3_Medium,
+                   deadlineSecs: Optional[float]    = None) -> LLMStream:
+        outputFormatJSON = None
+        if outputFormat is not None:
+            outputFormatJSON = outputFormat.model_json_schema()
+
+        def fnStream() -> Iterator[LLMStreamDelta]:
+            start = time.time()
+            firstTokenElapsed = None
+
+            try:
+                with self.__admit(messages, priority, deadlineSecs) as ticket:
+                    for delta in self._doChatStream(messages, outputFormatJSON):
+                        if firstTokenElapsed is None and delta.content != "":
+                            firstTokenElapsed = time.time() - start
+                        if delta.done:
+                            self.__recordUsage(delta.usage, start, firstTokenElapsed or 0.0, ticket = ticket)
+                        yield delta
+            except Exception as e:
+                self.logger.exception("Unable to stream messages from client.")
+                raise
+
+            if self.verboseOutput:
+                self.logger.debug(f"Streamed query took: {time.time() - start}s, first token after: {firstTokenElapsed}s")
+
+        async def fnStreamAsync() -> AsyncIterator[LLMStreamDelta]:
+            start = time.time()
+            firstTokenElapsed = None
+
+            try:
+                async with self.__aadmit(messages, priority, deadlineSecs) as ticket:
+                    async for delta in self._doChatStreamAsync(messages, outputFormatJSON):
+                        if firstTokenElapsed is None and delta.content != "":
+                            firstTokenElapsed = time.time() - start
+                        if delta.done:
+                            self.__recordUsage(delta.usage, start, firstTokenElapsed or 0.0, ticket = ticket)
+                        yield delta
+            except Exception as e:
+                self.logger.exception("Unable to stream messages from client.")
+                raise
+
+        return LLMStream(fnStream, fnStreamAsync if self._hasAsyncClient() else None)
+
+    # Cheap probe that the backend is reachable. Backends that can't be probed are assumed healthy.
+    def checkHealth(self, timeoutSecs: float = DEFAULT_HEALTH_CHECK_TIMEOUT_SECS) -> bool:
+        return True
+
+    # Largest context worth sending. 0 if unknown.
+    def getMaxContextLength(self) -> int:
+        return self.info.context
+
     def _getModelHandle(self) -> str:
         modelHandle: str = self.info.name
         if self.variant != "":
@@ -74,17 +434,34 @@ class LLMModel(ABC):
     def _doChat(self, messages: List[LLMMessage], responseFormatJson = None) -> dict:
         pass
 
+    # Yield deltas as they arrive. The last one must have done set.
     @abstractmethod
-    def _countTokens(self, content) -> int:
+    def _doChatStream(self, messages: List[LLMMessage], responseFormatJson = None) -> Iterator[LLMStreamDelta]:
         pass
 
-    def getTokenCountFromMessages(self, messages: List[LLMMessage]) -> int:
-        totalTokenCount = 0
+    # Override along with the async methods below when the backend has a native async client.
+    def _hasAsyncClient(self) -> bool:
+        return False
+
+    # By default fall back to the blocking client on a worker thread.
+    async def _doChatAsync(self, messages: List[LLMMessage], responseFormatJson = None) -> dict:
+        return await asyncio.to_thread(self._doChat, messages, responseFormatJson)
+
+    async def _doChatStreamAsync(self, messages: List[LLMMessage], responseFormatJson = None) -> AsyncIterator[LLMStreamDelta]:
+        raise NotImplementedError("Async streaming not supported by this model.")
+        yield # Makes this an async generator
 
+    # Count tokens for many strings in one call. Implementations should use the
+    # tokenizer's batch API rather than encoding strings one at a time.
+    @abstractmethod
+    def _countTokensBatch(self, contents: List[str]) -> List[int]:
+        pass
+
+    def countTokens(self, contents: List[str]) -> List[int]:
+        return self.tokenCountCache.count(contents, self._countTokensBatch)
+
+    def getTokenCountFromMessages(self, messages: List[LLMMessage]) -> int:
         if self.verboseOutput:
             self.logger.debug(LogLine("Count tokens for num messages: ", len(messages)))
 
-        for message in messages:
-            totalTokenCount += self._countTokens(message.content)
-
-        return totalTokenCount
\ No newline at end of file
+        return sum(self.countTokens([message.content for message in messages]))
@@ -1,172 +1,328 @@
+import asyncio
+import dataclasses
+import httpx
 import json
-import io
-import os
-import numpy as np
 
 from dataclasses    import dataclass
 from requests       import Request, Response, Session
-from transformers   import AutoTokenizer
-from typing         import List, Optional
+from requests.adapters import HTTPAdapter
+from threading      import Lock
+from typing         import AsyncIterator, cast, Dict, Iterator, List, Optional, Tuple
 
 # Local packages
 from my_secrets     import secrets_mgr
 
 # This package
-from .llm_define    import LogLine, LLMInfo, LLMMessage, LLMResponse, LLMResponseStatus
+from .llm_define    import LogLine, LLMConnectionParams, LLMInfo, LLMMessage, LLMParams_Option_Disabled, LLMResponse, LLMResponseStatus, LLMStreamDelta, LLMUsage
 from .llm_model     import LLMModel, LLMParams
+from .llm_tokenizer import TokenizerRegistry
 
 @dataclass
 class OllamaParams:
     # Some confusion in docs on the default value. 
     # To avoid issues with truncated responses set this to -1 (unlimited) explicitly.
-    num_predict = -1
+    num_predict: int = -1
     # Maximum context allowed via API. 0 indicates no limit.
-    num_ctx = 0
+    num_ctx: int = 0
 
 # While using Ollama python package, I ran into inconsistent results
 # when compared to calling APIs directly using Postman or curl. 
 # Sometimes output is significantly different, unusable or there is a
-# significant increase in memory usage. 
-class OllamaClient:
-    def __init__(self, host: str, port: int, logger, api_key: secrets_mgr.Secret, verboseOutput: bool = False):
+# significant increase in memory usage. So the API is called directly.
+# The base class shares request building and response parsing between 
+# the sync and async clients.
+class OllamaClientBase:
+    # Keep the model loaded between turns so its KV cache, and with it the
+    # already processed prompt prefix, can be reused by the next request.
+    DEFAULT_KEEP_ALIVE = "30m"
+
+    def __init__(self, host: str, port: int, logger, api_key: secrets_mgr.Secret, verboseOutput: bool = False,
+                 keepAlive: str = DEFAULT_KEEP_ALIVE):
         self.host           = host
         self.port           = port
         self.logger         = logger
         self.api_key        = api_key
-        self.session        = Session()
         self.verboseOutput  = verboseOutput
+        self.keepAlive      = keepAlive
 
-    def __del__(self):
-        self.session.close()
+    def _getURL(self, endpoint: str = "chat") -> str:
+        return f"{self.host}:{self.port}/api/{endpoint}"
 
-    def __sendRequest(self, model: str, messages: List[dict], options: dict) -> Response:
+    def _getHeaders(self) -> dict:
         headers = {}
         if not self.api_key.isEmpty():
             headers["Authorization"] = f"Bearer {self.api_key.expose()}"
         headers["Content-Type"] = "application/json"
 
-        # TODO: remove this
-        options["context"] = 32768
+        return headers
 
+    def _getBody(self, model: str, messages: List[dict], options: dict, responseFormat: Optional[dict] = None) -> dict:
         # Zero-shot, client is responsible for managing chat history.
-        url = f"{self.host}:{self.port}/api/chat"
-        ollamaRequest = Request("POST", url, headers, json = {
+        body = {
             "model":        model,
             "messages":     messages,
             "stream":       True,
-            #"format":       "json",
-            "keep_alive":   "5m",
+            "keep_alive":   self.keepAlive,
             "options":      options
-        })
+        }
 
-        preparedRequest = ollamaRequest.prepare()
+        # JSON schema constrains generation to structured output
+        if responseFormat is not None:
+            body["format"] = responseFormat
+
+        return body
 
+    def _logRequest(self, method: str, url: str, headers, body):
         if self.verboseOutput:
             self.logger.debug("Sending request to Ollama:")
-            self.logger.debug(f"URL: {preparedRequest.url}")
-            self.logger.debug(f"Method: {preparedRequest.method}")
+            self.logger.debug(f"URL: {url}")
+            self.logger.debug(f"Method: {method}")
             self.logger.debug("Headers:")
-            for header, value in preparedRequest.headers.items():
+            for header, value in headers.items():
                 self.logger.debug(f"  {header}: {value}")
-            self.logger.debug(f"Body: {preparedRequest.body}")
+            self.logger.debug(f"Body: {body}")
             self.logger.debug("")
 
-        response = self.session.send(preparedRequest, stream=True)
+    # Validate a streamed line. Returns the parsed chunk, the role of
+    # the message being streamed and whether this is the last chunk.
+    @staticmethod
+    def _parseChunk(rawLine: str, role: Optional[str]) -> Tuple[dict, str, bool]:
+        chunk = json.loads(rawLine)
 
-        return response
+        if "message" in chunk:
+            chunkedMessage = chunk["message"]
 
-    def sendMessages(self, model: str, messages: List[dict], options: dict) -> dict:
+            if role is None:
+                role = chunkedMessage["role"]
+            elif chunkedMessage["role"] != role:
+                raise Exception("Unexpected change in 'role' while streaming messages from ollama.")
+            
+            # Is chunking complete?
+            if not "done" in chunk:
+                raise Exception("Chunked message from Ollama missing 'done' field.")
+        else:
+            raise Exception("Chunked response from Ollama missing 'message'.")
         
-        response = self.__sendRequest(model, messages, options)
+        return chunk, cast(str, role), bool(chunk.get("done"))
+
+    # Fold the streamed chunks into a single response like the non streaming API.
+    def _mergeChunks(self, chunks: List[dict]) -> dict:
+        if len(chunks) == 0 or not chunks[-1].get("done"):
+            raise Exception("Incomplete JSON response received from Ollama API.")
 
-        responseJSON = None
-        role = None
-        contentBuffer = io.StringIO()
+        responseJSON = chunks[-1] # Last response should be complete
+        responseJSON["message"]["content"] = "".join(chunk["message"]["content"] for chunk in chunks) # Copy the full msg contents
 
-        for rawLine in response.iter_lines(decode_unicode=True):
-            if not rawLine:
-                continue
+        if self.verboseOutput:
+            self.logger.debug("Response from Ollama: ")
+            self.logger.debug(LogLine(responseJSON))
+            
+        return responseJSON
 
-            chunk = json.loads(rawLine)
+class OllamaClient(OllamaClientBase):
+    def __init__(self, host: str, port: int, logger, api_key: secrets_mgr.Secret, verboseOutput: bool = False,
+                 connectionParams: LLMConnectionParams = LLMConnectionParams(),
+                 keepAlive: str = OllamaClientBase.DEFAULT_KEEP_ALIVE):
+        super().__init__(host, port, logger, api_key, verboseOutput, keepAlive)
 
-            if "message" in chunk:
-                chunkedMessage = chunk["message"]
+        # Keep enough pooled connections for concurrent callers sharing this client
+        self.session        = Session()
+        adapter             = HTTPAdapter(pool_connections = 1, pool_maxsize = connectionParams.maxConnections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.timeoutSecs    = connectionParams.timeoutSecs
 
-                if role is None:
-                    role = chunkedMessage["role"]
-                    contentBuffer.write(chunkedMessage["content"])
-                elif chunkedMessage["role"] == role:
-                    contentBuffer.write(chunkedMessage["content"])
-                else:
-                    raise Exception("Unexpected change in 'role' while streaming messages from ollama.")
-                
-                # Is chunking complete?
-                if "done" in chunk:
-                    if chunk.get("done"):
-                        responseJSON = chunk # Last response should be complete
-                        responseJSON["message"]["content"] = contentBuffer.getvalue() # Copy the full msg contents
-                        break
-                else:
-                    raise Exception("Chunked message from Ollama missing 'done' field.")
-            else:
-                raise Exception("Chunked response from Ollama missing 'message'.")
+    def __del__(self):
+        self.session.close()
+
+    # Cheap request to check the server is up
+    def ping(self, timeoutSecs: float) -> bool:
+        response = self.session.get(self._getURL("version"), headers = self._getHeaders(), timeout = timeoutSecs)
+        return response.ok
+
+    def __sendRequest(self, model: str, messages: List[dict], options: dict, responseFormat: Optional[dict]) -> Response:
+        ollamaRequest = Request("POST", self._getURL(), self._getHeaders(), json = self._getBody(model, messages, options, responseFormat))
+        preparedRequest = ollamaRequest.prepare()
+        self._logRequest(cast(str, preparedRequest.method), cast(str, preparedRequest.url), 
+                         preparedRequest.headers, preparedRequest.body)
+
+        response = self.session.send(preparedRequest, stream=True, timeout = self.timeoutSecs)
 
-        contentBuffer.close()
+        return response
+
+    # Yield each chunk as soon as it arrives. The last chunk has 'done' set
+    # and carries the timings and token counts for the whole response.
+    def streamMessages(self, model: str, messages: List[dict], options: dict, responseFormat: Optional[dict] = None) -> Iterator[dict]:
         
-        if responseJSON is None:
+        response = self.__sendRequest(model, messages, options, responseFormat)
+
+        try:
+            response.raise_for_status()
+            role = None
+
+            for rawLine in response.iter_lines(decode_unicode=True):
+                if not rawLine:
+                    continue
+
+                chunk, role, done = OllamaClientBase._parseChunk(rawLine, role)
+                yield chunk
+                if done:
+                    return
+
             raise Exception("Incomplete JSON response received from Ollama API.")
+        finally:
+            # Release the connection even if the caller stops iterating early
+            response.close()
+
+    def sendMessages(self, model: str, messages: List[dict], options: dict, responseFormat: Optional[dict] = None) -> dict:
+        return self._mergeChunks(list(self.streamMessages(model, messages, options, responseFormat)))
+
+# Many requests can be in flight on one event loop without holding a thread each.
+# Connections are pooled and kept alive, using HTTP/2 when the server supports it.
+class OllamaAsyncClient(OllamaClientBase):
+    def __init__(self, host: str, port: int, logger, api_key: secrets_mgr.Secret, verboseOutput: bool = False,
+                 connectionParams: LLMConnectionParams = LLMConnectionParams(),
+                 keepAlive: str = OllamaClientBase.DEFAULT_KEEP_ALIVE):
+        super().__init__(host, port, logger, api_key, verboseOutput, keepAlive)
+
+        self.client = httpx.AsyncClient(
+            limits  = connectionParams.getLimits(),
+            timeout = connectionParams.timeoutSecs,
+            http2   = connectionParams.http2
+        )
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def streamMessages(self, model: str, messages: List[dict], options: dict, responseFormat: Optional[dict] = None) -> AsyncIterator[dict]:
+        url     = self._getURL()
+        headers = self._getHeaders()
+        body    = self._getBody(model, messages, options, responseFormat)
+        self._logRequest("POST", url, headers, body)
+
+        async with self.client.stream("POST", url, headers = headers, json = body) as response:
+            response.raise_for_status()
+            role = None
+
+            async for rawLine in response.aiter_lines():
+                if not rawLine:
+                    continue
+
+                chunk, role, done = OllamaClientBase._parseChunk(rawLine, role)
+                yield chunk
+                if done:
+                    return
 
-        if isinstance(responseJSON, dict):
-            if self.verboseOutput:
-                self.logger.debug("Response from Ollama: ")
-                self.logger.debug(LogLine("Type of Ollama: ", type(responseJSON)))
-                self.logger.debug(LogLine(responseJSON))
-        else:
-            raise Exception("Expected the Ollama response type to be dictionary.")
-            
-        return responseJSON
+            raise Exception("Incomplete JSON response received from Ollama API.")
+
+    async def sendMessages(self, model: str, messages: List[dict], options: dict, responseFormat: Optional[dict] = None) -> dict:
+        return self._mergeChunks([chunk async for chunk in self.streamMessages(model, messages, options, responseFormat)])
         
+@dataclass
+class OllamaContextStats:
+    numRequests:    int = 0
+    numResizes:     int = 0     # Changes to num_ctx, each forces Ollama to reload the model
+    numLoads:       int = 0     # Responses where Ollama reported loading the model
+    contextLen:     int = 0
+
+# Ollama reloads the model whenever num_ctx changes, which throws away the KV cache
+# and with it any prompt prefix shared with the previous request. So rather than
+# sizing each request the context only grows, before it is full, to the next power
+# of 2 and stays there. Shared by all sessions of a model since the server holds a
+# single loaded instance per model. Thread safe.
+class OllamaContextPolicy:
+    DEFAULT_GROW_THRESHOLD  = 0.75  # Grow once a request fills this share of the context
+    LOAD_THRESHOLD_SECS     = 0.5   # Load durations above this indicate the model was (re)loaded
+
+    # Cache list of policies by model handle
+    Lookup: Dict[str, "OllamaContextPolicy"] = {}
+    lookupLock: Lock = Lock()
+
+    def __init__(self, minContextLen: int, maxContextLen: int, growThreshold: float = DEFAULT_GROW_THRESHOLD):
+        self.minContextLen  = minContextLen
+        self.maxContextLen  = max(minContextLen, maxContextLen)
+        self.growThreshold  = growThreshold
+        self.stats          = OllamaContextStats()
+        self._lock          = Lock()
+
+    @staticmethod
+    def GetShared(modelHandle: str, minContextLen: int, maxContextLen: int) -> "OllamaContextPolicy":
+        with OllamaContextPolicy.lookupLock:
+            if not modelHandle in OllamaContextPolicy.Lookup:
+                OllamaContextPolicy.Lookup[modelHandle] = OllamaContextPolicy(minContextLen, maxContextLen)
+
+            return OllamaContextPolicy.Lookup[modelHandle]
+
+    def getContextLen(self, numTokens: int) -> int:
+        with self._lock:
+            self.stats.numRequests += 1
+
+            # Leave room for the answer. Grow to the next power of 2 so the following turns fit as well.
+            neededLen = int(numTokens / self.growThreshold) + 1
+            if neededLen > self.stats.contextLen and self.stats.contextLen < self.maxContextLen:
+                contextLen = min(max(1 << (neededLen - 1).bit_length(), self.minContextLen), self.maxContextLen)
+                if self.stats.contextLen != 0:
+                    self.stats.numResizes += 1
+                self.stats.contextLen = contextLen
+
+            return self.stats.contextLen
+
+    # Drop back to the smallest context on the next request, e.g. when a long session ends
+    def reset(self):
+        with self._lock:
+            self.stats.contextLen = 0
+
+    # Final chunk of a response includes the time spent loading the model in ns
+    def recordResponse(self, response: dict):
+        loadDurationSecs = response.get("load_duration", 0) / 1e9
+        if loadDurationSecs > OllamaContextPolicy.LOAD_THRESHOLD_SECS:
+            with self._lock:
+                self.stats.numLoads += 1
+
 class OllamaModel(LLMModel):
-    DEFAULT_OLLAMA_CONTEXT_LEN: int = 2048
+    DEFAULT_OLLAMA_CONTEXT_LEN: int         = 2048
+    DEFAULT_MAX_RECOMMENDED_CONTEXT_LEN     = 32768 # Larger contexts get expensive in memory
+    NANOSECS_PER_SEC                        = 1e9
     
-    def __init__(self, info: LLMInfo, logger, variant: str, verboseOutput: bool = False):
-        super().__init__(info, logger, variant, verboseOutput)
+    # Host and port default to OLLAMA_API_HOST and OLLAMA_API_PORT, set them
+    # to talk to a specific server, e.g. when routing across several.
+    def __init__(self, info: LLMInfo, logger, variant: str, verboseOutput: bool = False,
+                 connectionParams: LLMConnectionParams = LLMConnectionParams(),
+                 keepAlive: str = OllamaClientBase.DEFAULT_KEEP_ALIVE,
+                 host: Optional[str] = None,
+                 port: Optional[int] = None):
+        super().__init__(info, logger, variant, verboseOutput, connectionParams)
+
+        self.keepAlive  = keepAlive
+        self.host       = host
+        self.port       = port
 
         self.ollamaParams = OllamaParams()
-        self.client: Optional[OllamaClient] = None
-
-        # TODO: configure this via param
-        self.maxContextLength = self.info 
-        
-        # Ollama API defaults to 4K context length default 
-        # but many models support much larger context.
-        # For all supported models set the highest supported
-        # context. But the actual context will be determined
-        # dynamically based on content.
-        if self.info == LLMInfo.COMMAND_R:
-            self.maxModelContextLength = 131072 # 128K model
-        elif self.info == LLMInfo.GEMMA2:
-            self.maxModelContextLength = 8192
-        elif self.info == LLMInfo.GEMMA3:
-            self.maxModelContextLength = 8192
-        elif self.info == LLMInfo.LLAMA31:
-            self.maxModelContextLength = 131072
-        else:
-            self.maxModelContextLength = OllamaModel.DEFAULT_OLLAMA_CONTEXT_LEN # Ollama's default
-            raise Exception(f"Error: unknown model: {self.info}. Context window may be incorrect")
+        self.client: Optional[OllamaClient]             = None
+        self.asyncClient: Optional[OllamaAsyncClient]   = None
+
+        # Ollama API defaults to a small context length but many models support
+        # much larger context. The actual context will be determined dynamically
+        # based on content but no larger than what the model supports.
+        # TODO: configure max recommended via param
+        self.maxModelContextLength          = self.info.context
+        self.maxRecommendedContextLength    = OllamaModel.DEFAULT_MAX_RECOMMENDED_CONTEXT_LEN
+        # Each server holds its own loaded instance
+        policyKey = self._getModelHandle() if self.host is None else f"{self.host}:{self.port}/{self._getModelHandle()}"
+        self.contextPolicy                  = OllamaContextPolicy.GetShared(policyKey,
+                                                                            OllamaModel.DEFAULT_OLLAMA_CONTEXT_LEN,
+                                                                            self.getMaxContextLength())
             
-    def __init_tokenizer(self, hfToken: secrets_mgr.Secret):
-        modelName = self.info["name"]
-        saveDir = os.path.expanduser(f"~/models/{modelName}-tokenizer")
-        if not os.path.isdir(saveDir):
-            if self.verboseOutput:
-                self.logger.debug(LogLine("Downloading tokenizer model: ", self.info["tokenizer"]))
-            self.tokenizer = AutoTokenizer.from_pretrained(self.info["tokenizer"], token=hfToken.expose())
-            self.tokenizer.save_pretrained(os.path.expanduser(saveDir))
-        else:
-            if self.verboseOutput:
-                self.logger.debug(LogLine("Tokenizer model on disk: ", self.info["tokenizer"]))
-            self.tokenizer = AutoTokenizer.from_pretrained(saveDir)
+        self.hfToken: Optional[secrets_mgr.Secret]     = None
+
+    # Loaded on first use and shared with other instances using the same tokenizer
+    def __getTokenizer(self):
+        if self.verboseOutput and not self.info.tokenizer in TokenizerRegistry.HFLookup:
+            self.logger.debug(LogLine("Loading tokenizer model: ", self.info.tokenizer))
+
+        return TokenizerRegistry.GetHFTokenizer(self.info.tokenizer,
+                                                self.hfToken,
+                                                TokenizerRegistry.GetDefaultCacheDir(self.info.name))
         
     def connectToClient(self, secretsMgr: secrets_mgr.SecretsMgr) -> bool:
         success = False
@@ -183,19 +339,36 @@ class OllamaModel(LLMModel):
             ollamaKey   = secretsMgr.getSecret("OLLAMA_API_KEY")
             hfToken     = secretsMgr.getSecret("HUGGING_FACE_TOKEN")
 
-            if (ollamaHost is not None 
-                and ollamaPort is not None 
+            if ((self.host is not None or ollamaHost is not None)
+                and (self.port is not None or ollamaPort is not None)
                 and ollamaKey is not None 
                 and hfToken is not None):
 
+                host = self.host if self.host is not None else cast(secrets_mgr.Secret, ollamaHost).expose()
+                port = self.port if self.port is not None else int(cast(secrets_mgr.Secret, ollamaPort).expose())
+
                 self.client = OllamaClient(
-                    ollamaHost.expose(), 
-                    int(ollamaPort.expose()),
+                    host, 
+                    port,
+                    self.logger, 
+                    ollamaKey, 
+                    self.verboseOutput,
+                    self.connectionParams,
+                    self.keepAlive)
+                
+                if self.asyncClient is not None:
+                    self._closeReplacedAsyncClient(self.asyncClient.aclose())
+
+                self.asyncClient = OllamaAsyncClient(
+                    host, 
+                    port,
                     self.logger, 
                     ollamaKey, 
-                    self.verboseOutput)
+                    self.verboseOutput,
+                    self.connectionParams,
+                    self.keepAlive)
                 
-                self.__init_tokenizer(hfToken)
+                self.hfToken = hfToken
 
                 success = True # If not exception assume it worked
             else:
@@ -206,8 +379,30 @@ class OllamaModel(LLMModel):
 
         return success
 
-    def _countTokens(self, contents) -> int:
-        return len(self.tokenizer.tokenize(contents))
+    # Fast tokenizers encode the whole batch in parallel
+    def _countTokensBatch(self, contents: List[str]) -> List[int]:
+        counts: List[int] = []
+        if len(contents) > 0:
+            encoded = self.__getTokenizer()(contents, 
+                                            add_special_tokens      = False,
+                                            return_attention_mask   = False)
+            counts = [len(inputIds) for inputIds in encoded["input_ids"]]
+
+        return counts
+
+    def checkHealth(self, timeoutSecs: float = LLMModel.DEFAULT_HEALTH_CHECK_TIMEOUT_SECS) -> bool:
+        healthy = False
+
+        try:
+            healthy = self.client is not None and self.client.ping(timeoutSecs)
+        except Exception as e:
+            self.logger.warning(LogLine("Ollama health check failed: ", e))
+
+        return healthy
+
+    # Larger contexts are supported but expensive in memory
+    def getMaxContextLength(self) -> int:
+        return min(self.maxModelContextLength, self.maxRecommendedContextLength)
 
     def __calculateContextLen(self, messages):
         numTokens = self.getTokenCountFromMessages(messages)
@@ -216,17 +411,22 @@ class OllamaModel(LLMModel):
         if numTokens > self.maxRecommendedContextLength:
             self.logger.warning("Content lenght is greater than recommended context.")
 
-        # Nearest power of 2 that is greater than actual number of tokens.
-        # However no greater than max recommended or model context length and no less
-        # than Ollama default to avoid unpredictable behavior or running out of memory.
-        contextLen = 2 ** (int(np.emath.logn(2, numTokens)) + 1)
-        if contextLen >= self.maxRecommendedContextLength or contextLen >= self.maxModelContextLength:
-            contextLen = min(self.maxRecommendedContextLength, self.maxModelContextLength)
-        elif contextLen < self.DEFAULT_OLLAMA_CONTEXT_LEN:
-            contextLen = self.DEFAULT_OLLAMA_CONTEXT_LEN
-
-        return contextLen
-        
+        # Sticky so the model isn't reloaded every time the size changes. No less than
+        # the Ollama default and no greater than the recommended or model context length.
+        return self.contextPolicy.getContextLen(numTokens)
+
+    # Durations are reported in nanoseconds
+    @staticmethod
+    def _parseUsage(response: dict) -> LLMUsage:
+        return LLMUsage(
+            model               = response.get("model", ""),
+            promptTokens        = response.get("prompt_eval_count", 0),
+            completionTokens    = response.get("eval_count", 0),
+            serverTotalSecs     = response.get("total_duration", 0) / OllamaModel.NANOSECS_PER_SEC,
+            loadSecs            = response.get("load_duration", 0) / OllamaModel.NANOSECS_PER_SEC,
+            promptEvalSecs      = response.get("prompt_eval_duration", 0) / OllamaModel.NANOSECS_PER_SEC,
+            evalSecs            = response.get("eval_duration", 0) / OllamaModel.NANOSECS_PER_SEC
+        )
 
     def _parseResponse(self, response: dict) -> LLMResponse:
         parsedResponse = LLMResponse()
@@ -239,6 +439,9 @@ class OllamaModel(LLMModel):
             else:
                 parsedResponse.status = LLMResponseStatus.FAILED
                 
+            self.contextPolicy.recordResponse(response)
+            parsedResponse.usage = OllamaModel._parseUsage(response)
+
             # TODO: revisit this. Ollama returns a single response
             message = response["message"]
             parsedResponse.messages = [ LLMMessage(message["role"], message["content"]) ]
@@ -248,25 +451,97 @@ class OllamaModel(LLMModel):
 
         return parsedResponse
         
-    def _doChat(self, messages: List[LLMMessage], responseFormatJson = None) -> dict:
-        response = {}
-
+    def __prepareOptions(self, messages: List[LLMMessage]) -> dict:
         if self.verboseOutput:
             self.logger.debug(LogLine("Chatting with Ollama model " + self._getModelHandle()))
 
-        # Ollama specific option not supported with OpenAI API.
-        self.options.num_ctx = self.__calculateContextLen(messages)                
+        # Sampling params are sent so the server samples the way the response cache
+        # assumes. Disabled ones are left to the model's defaults.
+        options = { key: value for key, value in dataclasses.asdict(self.info.params).items()
+                    if value != LLMParams_Option_Disabled }
+
+        # Ollama specific option not supported with OpenAI API. Set on a copy since
+        # concurrent requests share the params.
+        options.update(dataclasses.asdict(self.ollamaParams))
+        options["num_ctx"] = self.__calculateContextLen(messages)
         if self.verboseOutput:
-            self.logger.debug(f"Context length set to {self.options.num_ctx}")
-            self.logger.debug(f"Options: {self.options.__dict__}")
+            self.logger.debug(f"Context length set to {options['num_ctx']}")
+            self.logger.debug(f"Options: {options}")
+
+        return options
+        
+    def _doChat(self, messages: List[LLMMessage], responseFormatJson = None) -> dict:
+        response = {}
 
+        options = self.__prepareOptions(messages)
         if self.client is not None:
             response = self.client.sendMessages(
                 model = self._getModelHandle(), 
                 messages = list(map(lambda obj: obj.__dict__, messages)), # Array of dict, 
-                options = self.options.__dict__ # Convert to dict
+                options = options,
+                responseFormat = responseFormatJson
             )
         else:
             self.logger.error("LLM client is not defined or initialized.")
 
-        return response
\ No newline at end of file
+        return response
+
+    def __toDelta(self, chunk: dict) -> LLMStreamDelta:
+        message = chunk["message"]
+        done = bool(chunk.get("done"))
+        if done:
+            self.contextPolicy.recordResponse(chunk)
+
+        return LLMStreamDelta(
+            content     = message.get("content", ""),
+            role        = message["role"],
+            done        = done,
+            # Final chunk carries done_reason, token counts and timings
+            metadata    = { key: value for key, value in chunk.items() if key != "message" } if done else None,
+            usage       = OllamaModel._parseUsage(chunk) if done else None
+        )
+
+    def _doChatStream(self, messages: List[LLMMessage], responseFormatJson = None) -> Iterator[LLMStreamDelta]:
+        options = self.__prepareOptions(messages)
+        if self.client is None:
+            raise Exception("LLM client is not defined or initialized.")
+        
+        for chunk in self.client.streamMessages(
+                model = self._getModelHandle(), 
+                messages = list(map(lambda obj: obj.__dict__, messages)), # Array of dict, 
+                options = options,
+                responseFormat = responseFormatJson):
+            yield self.__toDelta(chunk)
+
+    def _hasAsyncClient(self) -> bool:
+        return self.asyncClient is not None
+    
+    async def aclose(self):
+        if self.asyncClient is not None:
+            await self.asyncClient.aclose()
+            self.asyncClient = None
+
+    async def _doChatAsync(self, messages: List[LLMMessage], responseFormatJson = None) -> dict:
+        # Counting the context tokenizes the whole conversation, keep it off the event loop
+        options = await asyncio.to_thread(self.__prepareOptions, messages)
+        if self.asyncClient is None:
+            raise Exception("LLM async client is not defined or initialized.")
+        
+        return await self.asyncClient.sendMessages(
+            model = self._getModelHandle(), 
+            messages = list(map(lambda obj: obj.__dict__, messages)), # Array of dict, 
+            options = options,
+            responseFormat = responseFormatJson
+        )
+
+    async def _doChatStreamAsync(self, messages: List[LLMMessage], responseFormatJson = None) -> AsyncIterator[LLMStreamDelta]:
+        options = await asyncio.to_thread(self.__prepareOptions, messages)
+        if self.asyncClient is None:
+            raise Exception("LLM async client is not defined or initialized.")
+        
+        async for chunk in self.asyncClient.streamMessages(
+                model = self._getModelHandle(), 
+                messages = list(map(lambda obj: obj.__dict__, messages)), # Array of dict, 
+                options = options,
+                responseFormat = responseFormatJson):
+            yield self.__toDelta(chunk)
\ No newline at end of file
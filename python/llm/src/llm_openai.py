@@ -1,22 +1,28 @@
-from openai             import OpenAI
+from openai             import AsyncOpenAI, OpenAI
 from openai.types.chat  import ChatCompletionUserMessageParam
-from typing             import cast, List, Optional
+from typing             import AsyncIterator, cast, Iterator, List, Optional
 
-import tiktoken
+import httpx
 
 # Local packages
 from my_secrets         import secrets_mgr
 
 # This package
-from .llm_define        import LogLine, LLMMessage, LLMResponse, LLMResponseStatus
+from .llm_define        import LogLine, LLMConnectionParams, LLMMessage, LLMResponse, LLMResponseStatus, LLMStreamDelta, LLMUsage
 from .llm_model         import LLMModel
+from .llm_tokenizer     import TokenizerRegistry
 
 class OpenAIModel(LLMModel):
-    def __init__(self, info, logger, variant = "", verboseOutput = False):
-        super().__init__(info, logger, variant, verboseOutput)
+    # Set baseURL for OpenAI compatible servers, e.g. vLLM or a local mock
+    def __init__(self, info, logger, variant = "", verboseOutput = False, 
+                 connectionParams: LLMConnectionParams = LLMConnectionParams(),
+                 baseURL: Optional[str] = None):
+        super().__init__(info, logger, variant, verboseOutput, connectionParams)
 
-        self.client: Optional[OpenAI] = None
-        self.encoding = tiktoken.encoding_for_model(info.name)
+        self.baseURL = baseURL
+
+        self.client: Optional[OpenAI]               = None
+        self.asyncClient: Optional[AsyncOpenAI]     = None
 
     def connectToClient(self, secretsMgr: secrets_mgr.SecretsMgr) -> bool:
         success = False
@@ -27,7 +33,24 @@ class OpenAIModel(LLMModel):
                 
             openAIAPIKey=secretsMgr.getSecret("OPENAI_API_KEY")
             if openAIAPIKey is not None:
-                self.client = OpenAI(api_key=openAIAPIKey.expose())
+                # Share pool sizing with the async client. HTTP/2 lets many requests share a connection.
+                self.client = OpenAI(api_key=openAIAPIKey.expose(), 
+                                     base_url = self.baseURL,
+                                     timeout = self.connectionParams.timeoutSecs,
+                                     http_client = httpx.Client(
+                                         limits = self.connectionParams.getLimits(),
+                                         http2  = self.connectionParams.http2
+                                     ))
+                if self.asyncClient is not None:
+                    self._closeReplacedAsyncClient(self.asyncClient.close())
+
+                self.asyncClient = AsyncOpenAI(api_key=openAIAPIKey.expose(), 
+                                               base_url = self.baseURL,
+                                               timeout = self.connectionParams.timeoutSecs,
+                                               http_client = httpx.AsyncClient(
+                                                   limits = self.connectionParams.getLimits(),
+                                                   http2  = self.connectionParams.http2
+                                               ))
                 success = True
             else:
                 self.logger.error("Unable to connect to OpenAI API due to missing 'OPENAI_API_KEY'.")
@@ -37,16 +60,40 @@ class OpenAIModel(LLMModel):
 
         return success
 
-    def _countTokens(self, contents) -> int:
-        return len(self.encoding.encode(contents))
+    def checkHealth(self, timeoutSecs: float = LLMModel.DEFAULT_HEALTH_CHECK_TIMEOUT_SECS) -> bool:
+        healthy = False
+
+        try:
+            if self.client is not None:
+                self.client.with_options(timeout = timeoutSecs, max_retries = 0).models.retrieve(self.info.name)
+                healthy = True
+        except Exception as e:
+            self.logger.warning(LogLine("OpenAI health check failed: ", e))
+
+        return healthy
+
+    # Encoding is shared across instances and only loaded on first count
+    def _countTokensBatch(self, contents: List[str]) -> List[int]:
+        encoding = TokenizerRegistry.GetTiktokenEncoding(self.info.name)
+        return [len(tokens) for tokens in encoding.encode_ordinary_batch(contents)]
+
+    # Only token counts are reported, timings are measured by the client
+    @staticmethod
+    def _parseUsage(model: str, usage: Optional[dict]) -> LLMUsage:
+        usage = usage if usage is not None else {}
+        return LLMUsage(
+            model               = model,
+            promptTokens        = usage.get("prompt_tokens") or 0,
+            completionTokens    = usage.get("completion_tokens") or 0
+        )
 
     def _parseResponse(self, response:dict) -> LLMResponse:
         parsedResponse = LLMResponse()
 
         try:
-            parsedResponse.model = response["model"]    
+            parsedResponse.model = response.model
             # TODO: revisit this. OpenAI may return multiple messages
-            choices = response["choices"]
+            choices = response.choices
             firstChoice = choices[0]
             # Simplifying status since this is non-streaming and synchronous.
             if firstChoice.finish_reason == "stop":
@@ -56,6 +103,8 @@ class OpenAIModel(LLMModel):
                 
             message = firstChoice.message
             parsedResponse.messages = [ LLMMessage(message.role, message.content) ]
+            parsedResponse.usage = OpenAIModel._parseUsage(response.model, 
+                                                           response.usage.model_dump() if response.usage is not None else None)
             
         except Exception as e:
             parsedResponse.status = LLMResponseStatus.FAILED
@@ -63,23 +112,112 @@ class OpenAIModel(LLMModel):
 
         return parsedResponse
 
-    def _doChat(self, messages: List[LLMMessage], responseFormatJson = None) -> str:
-        if responseFormatJson is not None:
-            raise Exception("JSON response not currently supported with Open AI LLM")
-
+    def _getCompletionArgs(self, messages: List[LLMMessage], responseFormatJson = None) -> dict:
         if self.verboseOutput:
             self.logger.debug(LogLine("Chatting with OpenAI model " + self._getModelHandle()))
 
+        completionArgs = {
+            "model":             self._getModelHandle(),
+            "messages":          [ cast(ChatCompletionUserMessageParam, message.to_dict()) for message in messages],
+            "seed":              self.info.params.seed,  
+            "temperature":       self.info.params.temperature,
+            "top_p":             self.info.params.top_p,
+            "frequency_penalty": self.info.params.repeat_penalty
+        }
+
+        # Not strict since pydantic schemas don't always meet strict mode's requirements
+        if responseFormatJson is not None:
+            completionArgs["response_format"] = {
+                "type":         "json_schema",
+                "json_schema":  {
+                    "name":     responseFormatJson.get("title", "response"),
+                    "schema":   responseFormatJson
+                }
+            }
+
+        return completionArgs
+
+    def _doChat(self, messages: List[LLMMessage], responseFormatJson = None) -> str:
+        completionArgs = self._getCompletionArgs(messages, responseFormatJson)
+
         if self.client is not None: 
-            response = self.client.chat.completions.create(
-                model             = self._getModelHandle(),
-                messages          = [ cast(ChatCompletionUserMessageParam, message.to_dict()) for message in messages],
-                seed              = self.info.params.seed,  
-                temperature       = self.info.params.temperature,
-                top_p             = self.info.params.top_p,
-                frequency_penalty = self.info.params.repeat_penalty
-            )
+            response = self.client.chat.completions.create(**completionArgs)
         else:
             self.logger.error("LLM client is not defined or initialized.")
 
-        return response
\ No newline at end of file
+        return response
+
+    # Usage is only reported on a final chunk without choices when requested via stream options.
+    def _doChatStream(self, messages: List[LLMMessage], responseFormatJson = None) -> Iterator[LLMStreamDelta]:
+        completionArgs = self._getCompletionArgs(messages, responseFormatJson)
+        if self.client is None:
+            raise Exception("LLM client is not defined or initialized.")
+
+        stream = self.client.chat.completions.create(**completionArgs, 
+                                                     stream = True, 
+                                                     stream_options = {"include_usage": True})
+        
+        metadata = {}
+        for chunk in stream:
+            delta = self._parseStreamChunk(chunk, metadata)
+            if delta is not None:
+                yield delta
+
+        yield LLMStreamDelta(role       = metadata.get("role", "assistant"), 
+                             done       = True, 
+                             metadata   = metadata, 
+                             usage      = OpenAIModel._parseUsage(metadata.get("model", ""), metadata.get("usage")))
+
+    # Returns a delta if the chunk has content. Usage and finish reason are collected in metadata.
+    def _parseStreamChunk(self, chunk, metadata: dict) -> Optional[LLMStreamDelta]:
+        delta: Optional[LLMStreamDelta] = None
+
+        metadata["model"] = chunk.model
+        if chunk.usage is not None:
+            metadata["usage"] = chunk.usage.model_dump()
+
+        if len(chunk.choices) > 0:
+            choice = chunk.choices[0]
+            if choice.delta.role is not None:
+                metadata["role"] = choice.delta.role
+            if choice.finish_reason is not None:
+                metadata["finish_reason"] = choice.finish_reason
+            if choice.delta.content:
+                delta = LLMStreamDelta(content = choice.delta.content, role = metadata.get("role", "assistant"))
+
+        return delta
+
+    def _hasAsyncClient(self) -> bool:
+        return self.asyncClient is not None
+    
+    async def aclose(self):
+        if self.asyncClient is not None:
+            await self.asyncClient.close()
+            self.asyncClient = None
+
+    async def _doChatAsync(self, messages: List[LLMMessage], responseFormatJson = None):
+        completionArgs = self._getCompletionArgs(messages, responseFormatJson)
+        if self.asyncClient is None:
+            raise Exception("LLM async client is not defined or initialized.")
+        
+        return await self.asyncClient.chat.completions.create(**completionArgs)
+
+    async def _doChatStreamAsync(self, messages: List[LLMMessage], responseFormatJson = None) -> AsyncIterator[LLMStreamDelta]:
+        completionArgs = self._getCompletionArgs(messages, responseFormatJson)
+        if self.asyncClient is None:
+            raise Exception("LLM async client is not defined or initialized.")
+
+        stream = await self.asyncClient.chat.completions.create(**completionArgs, 
+                                                                stream = True, 
+                                                                stream_options = {"include_usage": True})
+        
+        metadata = {}
+        async for chunk in stream:
+            delta = self._parseStreamChunk(chunk, metadata)
+            if delta is not None:
+                yield delta
+
+        yield LLMStreamDelta(role       = metadata.get("role", "assistant"), 
+                             done       = True, 
+                             metadata   = metadata, 
+                             usage      = OpenAIModel._parseUsage(metadata.get("model", ""), metadata.get("usage")))
\ No newline at end of file
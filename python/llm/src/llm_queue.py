@@ -0,0 +1,326 @@
+import asyncio
+import bisect
+import time
+
+from contextlib     import asynccontextmanager, contextmanager
+from dataclasses    import dataclass
+from enum           import Enum
+from threading      import Event, Lock
+from typing         import AsyncIterator, Dict, Iterator, List, Optional
+
+# Local packages
+from web_service    import requests as service_requests
+
+# Same levels as web service requests so a request's priority carries through
+Priority = service_requests.Priority
+
+class LLMRequestDropped(Exception):
+    pass
+
+class LLMTicketState(Enum):
+    WAITING     = "WAITING"
+    GRANTED     = "GRANTED"
+    DROPPED     = "DROPPED"
+    RELEASED    = "RELEASED"
+
+# A request's place in the queue. Set usedTokens once the response reports usage
+# so the rate limit is charged what the request actually cost.
+class LLMRequestTicket:
+    def __init__(self, priority: Priority, rank: int, seq: int, estimatedTokens: int, deadline: Optional[float]):
+        self.priority           = priority
+        self.rank               = rank
+        self.seq                = seq
+        self.estimatedTokens    = estimatedTokens
+        self.deadline           = deadline  # Monotonic, None to wait indefinitely
+        self.enqueueTime        = time.monotonic()
+        self.waitSecs           = 0.0
+        self.usedTokens: Optional[int] = None
+        self.state              = LLMTicketState.WAITING
+
+        # Sync waiters block on the event, async ones await a future on their loop
+        self._event             = Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._future: Optional[asyncio.Future]          = None
+
+    # Highest priority first then first come first served
+    def __lt__(self, other: "LLMRequestTicket") -> bool:
+        return (self.rank, self.seq) < (other.rank, other.seq)
+
+    def _signal(self):
+        self._event.set()
+        if self._loop is not None and self._future is not None:
+            future = self._future
+            def fnWake():
+                if not future.done():
+                    future.set_result(None)
+            try:
+                self._loop.call_soon_threadsafe(fnWake)
+            except RuntimeError:
+                pass # Loop already closed, nobody is waiting
+
+@dataclass
+class LLMQueueStats:
+    numGranted:     int     = 0
+    numDropped:     int     = 0
+    numWaiting:     int     = 0
+    numInFlight:    int     = 0
+    totalWaitSecs:  float   = 0.0
+    maxWaitSecs:    float   = 0.0
+
+    @property
+    def avgWaitSecs(self) -> float:
+        return self.totalWaitSecs / self.numGranted if self.numGranted > 0 else 0.0
+
+# Admission control in front of a shared backend so batch jobs don't starve interactive
+# chats. Requests start in priority order subject to:
+#   - maxConcurrency requests in flight overall,
+#   - an optional limit per priority, by default low priorities can't take every slot,
+#   - an optional tokens per minute budget, charged an estimate up front and corrected
+#     by actual usage on release.
+# A request still queued when its deadline passes is dropped with LLMRequestDropped.
+# Thread safe and usable from both threads and event loops.
+class LLMRequestQueue:
+    DEFAULT_MAX_CONCURRENCY = 4
+    NO_LIMIT                = 0
+    MAX_RECHECK_SECS        = 0.5   # Waiters recheck deadlines and the token budget at least this often
+    SECS_PER_MIN            = 60.0
+
+    PriorityOrder: List[Priority] = [Priority.P1_Critical,
+                                     Priority.P2_High,
+                                     Priority.P3_Medium,
+                                     Priority.P4_Low,
+                                     Priority.P5_Lowest]
+
+    # Share a queue between models talking to the same server, e.g. keyed by host
+    Lookup: Dict[str, "LLMRequestQueue"] = {}
+    lookupLock: Lock = Lock()
+
+    def __init__(self,
+                 maxConcurrency: int                                = DEFAULT_MAX_CONCURRENCY,
+                 priorityConcurrency: Optional[Dict[Priority, int]] = None,
+                 tokensPerMin: int                                  = NO_LIMIT):
+
+        self.maxConcurrency = maxConcurrency
+        self.tokensPerMin   = tokensPerMin
+
+        # Leave room for higher priority requests unless told otherwise
+        if priorityConcurrency is None:
+            priorityConcurrency = {
+                Priority.P4_Low:    max(1, maxConcurrency // 2),
+                Priority.P5_Lowest: 1
+            }
+        self.priorityConcurrency = priorityConcurrency
+
+        self._waiting: List[LLMRequestTicket]   = []    # Sorted
+        self._inFlight: Dict[Priority, int]     = { priority: 0 for priority in LLMRequestQueue.PriorityOrder }
+        self._numInFlight                       = 0
+        self._nextSeq                           = 0
+        self._tokens                            = float(tokensPerMin)
+        self._lastRefill                        = time.monotonic()
+        self._stats                             = LLMQueueStats()
+        self._lock                              = Lock()
+
+    @staticmethod
+    def GetShared(key: str,
+                  maxConcurrency: int                                   = DEFAULT_MAX_CONCURRENCY,
+                  priorityConcurrency: Optional[Dict[Priority, int]]    = None,
+                  tokensPerMin: int                                     = NO_LIMIT) -> "LLMRequestQueue":
+        with LLMRequestQueue.lookupLock:
+            if not key in LLMRequestQueue.Lookup:
+                LLMRequestQueue.Lookup[key] = LLMRequestQueue(maxConcurrency, priorityConcurrency, tokensPerMin)
+
+            return LLMRequestQueue.Lookup[key]
+
+    # Undefined is treated as medium
+    @staticmethod
+    def GetRank(priority: Priority) -> int:
+        if priority in LLMRequestQueue.PriorityOrder:
+            return LLMRequestQueue.PriorityOrder.index(priority)
+        else:
+            return LLMRequestQueue.PriorityOrder.index(Priority.P3_Medium)
+
+    def isRateLimited(self) -> bool:
+        return self.tokensPerMin != LLMRequestQueue.NO_LIMIT
+
+    def getStats(self) -> LLMQueueStats:
+        with self._lock:
+            stats = LLMQueueStats(**self._stats.__dict__)
+            stats.numWaiting    = len(self._waiting)
+            stats.numInFlight   = self._numInFlight
+
+            return stats
+
+    def __getPriority(self, ticket: LLMRequestTicket) -> Priority:
+        return LLMRequestQueue.PriorityOrder[ticket.rank]
+
+    def __refill(self, now: float):
+        if self.isRateLimited():
+            self._tokens = min(float(self.tokensPerMin),
+                               self._tokens + (now - self._lastRefill) * self.tokensPerMin / LLMRequestQueue.SECS_PER_MIN)
+        self._lastRefill = now
+
+    def __grant(self, ticket: LLMRequestTicket, now: float):
+        priority = self.__getPriority(ticket)
+        self._inFlight[priority] += 1
+        self._numInFlight += 1
+        if self.isRateLimited():
+            self._tokens -= ticket.estimatedTokens
+
+        ticket.state    = LLMTicketState.GRANTED
+        ticket.waitSecs = now - ticket.enqueueTime
+        self._stats.numGranted      += 1
+        self._stats.totalWaitSecs   += ticket.waitSecs
+        self._stats.maxWaitSecs     = max(self._stats.maxWaitSecs, ticket.waitSecs)
+        ticket._signal()
+
+    # Start whatever can start. Called with the lock held whenever a slot or
+    # tokens may have freed up. A request blocked on the overall limit or on
+    # tokens holds back lower priorities so it isn't starved by smaller ones.
+    def __dispatch(self):
+        now = time.monotonic()
+        self.__refill(now)
+
+        remaining: List[LLMRequestTicket] = []
+        blocked = False
+        for ticket in self._waiting:
+            if ticket.deadline is not None and now >= ticket.deadline:
+                ticket.state = LLMTicketState.DROPPED
+                self._stats.numDropped += 1
+                ticket._signal()
+                continue
+
+            priorityLimit = self.priorityConcurrency.get(self.__getPriority(ticket))
+            if blocked:
+                remaining.append(ticket)
+            elif self._numInFlight >= self.maxConcurrency:
+                blocked = True
+                remaining.append(ticket)
+            elif priorityLimit is not None and self._inFlight[self.__getPriority(ticket)] >= priorityLimit:
+                remaining.append(ticket) # Others may still go
+            elif self.isRateLimited() and self._tokens < min(ticket.estimatedTokens, self.tokensPerMin):
+                blocked = True
+                remaining.append(ticket)
+            else:
+                self.__grant(ticket, now)
+
+        self._waiting = remaining
+
+    def __enqueue(self, priority: Priority, estimatedTokens: int, deadlineSecs: Optional[float]) -> LLMRequestTicket:
+        with self._lock:
+            deadline = time.monotonic() + deadlineSecs if deadlineSecs is not None else None
+            ticket = LLMRequestTicket(priority, LLMRequestQueue.GetRank(priority), self._nextSeq, estimatedTokens, deadline)
+            self._nextSeq += 1
+            bisect.insort(self._waiting, ticket)
+
+            return ticket
+
+    # How long a waiter sleeps before checking again if not woken
+    def __getRecheckSecs(self, ticket: LLMRequestTicket) -> float:
+        recheckSecs = LLMRequestQueue.MAX_RECHECK_SECS
+        if ticket.deadline is not None:
+            recheckSecs = min(recheckSecs, max(0.0, ticket.deadline - time.monotonic()))
+
+        return recheckSecs
+
+    def __checkTicket(self, ticket: LLMRequestTicket) -> bool:
+        if ticket.state == LLMTicketState.DROPPED:
+            raise LLMRequestDropped(f"LLM request dropped after waiting {time.monotonic() - ticket.enqueueTime:.2f}s in queue.")
+
+        return ticket.state == LLMTicketState.GRANTED
+
+    # Caller gave up, e.g. cancelled
+    def __abandon(self, ticket: LLMRequestTicket):
+        with self._lock:
+            if ticket.state == LLMTicketState.WAITING:
+                self._waiting.remove(ticket)
+                ticket.state = LLMTicketState.RELEASED
+                self.__dispatch()
+
+        self.release(ticket) # In case it was granted meanwhile
+
+    # Blocks until the request may start. Raises LLMRequestDropped if the deadline passes first.
+    def acquire(self,
+                priority: Priority              = Priority.P3_Medium,
+                estimatedTokens: int            = 0,
+                deadlineSecs: Optional[float]   = None) -> LLMRequestTicket:
+        ticket = self.__enqueue(priority, estimatedTokens, deadlineSecs)
+
+        try:
+            while True:
+                with self._lock:
+                    if ticket.state == LLMTicketState.WAITING:
+                        self.__dispatch()
+                    ticket._event.clear()
+                if self.__checkTicket(ticket):
+                    return ticket
+
+                ticket._event.wait(self.__getRecheckSecs(ticket))
+        except LLMRequestDropped:
+            raise
+        except BaseException:
+            self.__abandon(ticket)
+            raise
+
+    async def aacquire(self,
+                       priority: Priority               = Priority.P3_Medium,
+                       estimatedTokens: int             = 0,
+                       deadlineSecs: Optional[float]    = None) -> LLMRequestTicket:
+        loop = asyncio.get_running_loop()
+        ticket = self.__enqueue(priority, estimatedTokens, deadlineSecs)
+
+        try:
+            while True:
+                with self._lock:
+                    if ticket.state == LLMTicketState.WAITING:
+                        self.__dispatch()
+                    ticket._loop    = loop
+                    ticket._future  = loop.create_future()
+                if self.__checkTicket(ticket):
+                    return ticket
+
+                try:
+                    await asyncio.wait_for(ticket._future, self.__getRecheckSecs(ticket))
+                except asyncio.TimeoutError:
+                    pass
+        except LLMRequestDropped:
+            raise
+        except BaseException:
+            self.__abandon(ticket)
+            raise
+
+    def release(self, ticket: LLMRequestTicket):
+        with self._lock:
+            if ticket.state != LLMTicketState.GRANTED:
+                return
+
+            ticket.state = LLMTicketState.RELEASED
+            self._inFlight[self.__getPriority(ticket)] -= 1
+            self._numInFlight -= 1
+
+            # Charge what was actually used
+            if self.isRateLimited() and ticket.usedTokens is not None:
+                self._tokens = min(float(self.tokensPerMin), self._tokens - (ticket.usedTokens - ticket.estimatedTokens))
+
+            self.__dispatch()
+
+    @contextmanager
+    def admit(self,
+              priority: Priority                = Priority.P3_Medium,
+              estimatedTokens: int              = 0,
+              deadlineSecs: Optional[float]     = None) -> Iterator[LLMRequestTicket]:
+        ticket = self.acquire(priority, estimatedTokens, deadlineSecs)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
+
+    @asynccontextmanager
+    async def aadmit(self,
+                     priority: Priority             = Priority.P3_Medium,
+                     estimatedTokens: int           = 0,
+                     deadlineSecs: Optional[float]  = None) -> AsyncIterator[LLMRequestTicket]:
+        ticket = await self.aacquire(priority, estimatedTokens, deadlineSecs)
+        try:
+            yield ticket
+        finally:
+            self.release(ticket)
@@ -0,0 +1,442 @@
+import asyncio
+import concurrent.futures
+import copy
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses    import dataclass
+from enum           import Enum
+from threading      import Lock
+from typing         import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator
+
+# Local packages
+from my_secrets     import secrets_mgr
+from utilities      import background_task
+
+# This package
+from .llm_cache     import LLMResponseCache
+from .llm_define    import *
+from .llm_model     import LLMModel
+from .llm_queue     import LLMRequestQueue, Priority
+from .llm_usage     import LLMUsageTracker
+
+class LLMRoutingPolicy(Enum):
+    LEAST_OUTSTANDING   = "LEAST_OUTSTANDING"   # Fewest requests in flight
+    LATENCY_EWMA        = "LATENCY_EWMA"        # Lowest expected wait given recent latency and load
+    COST                = "COST"                # Cheapest, e.g. local models before hosted ones
+
+@dataclass
+class LLMBackendStats:
+    numRequests:            int             = 0
+    numFailures:            int             = 0
+    numTimeouts:            int             = 0
+    consecutiveFailures:    int             = 0
+    outstanding:            int             = 0
+    latencyEWMASecs:        Optional[float] = None
+    healthy:                bool            = True
+    lastFailureTime:        float           = 0.0
+
+class LLMBackend:
+    def __init__(self, model: LLMModel, name: str = "", costPer1KTokens: float = 0.0):
+        self.model              = model
+        self.name               = name if name != "" else model._getModelHandle()
+        self.costPer1KTokens    = costPer1KTokens
+        self.stats              = LLMBackendStats()
+
+# Spreads requests over a pool of models, e.g. several Ollama servers and OpenAI.
+# Backends are ranked by policy and a failed or timed out request is retried on
+# the next one. Backends that keep failing are taken out of rotation until a
+# health check passes or, if they can't be probed, retryAfterSecs has passed.
+# Behaves like any other LLMModel so it can back an LLMManager.
+class LLMRouter(LLMModel, background_task.BackgroundTask):
+    DEFAULT_MAX_ATTEMPTS                = 3
+    DEFAULT_FAILURE_THRESHOLD           = 3     # Consecutive failures before a backend is taken out of rotation
+    DEFAULT_RETRY_AFTER_SECS            = 30
+    DEFAULT_HEALTH_CHECK_INTERVAL_SECS  = 30
+    EWMA_ALPHA                          = 0.2
+
+    def __init__(self,
+                 logger,
+                 policy: LLMRoutingPolicy                   = LLMRoutingPolicy.LEAST_OUTSTANDING,
+                 requestTimeoutSecs: Optional[float]        = None,
+                 maxAttempts: int                           = DEFAULT_MAX_ATTEMPTS,
+                 failureThreshold: int                      = DEFAULT_FAILURE_THRESHOLD,
+                 retryAfterSecs: float                      = DEFAULT_RETRY_AFTER_SECS,
+                 healthCheckIntervalSecs: int               = DEFAULT_HEALTH_CHECK_INTERVAL_SECS,
+                 verboseOutput: bool                        = False):
+
+        super().__init__(LLMInfo("router", "", 0, LLMParams()), logger, "", verboseOutput)
+
+        self.policy             = policy
+        self.requestTimeoutSecs = requestTimeoutSecs
+        self.maxAttempts        = maxAttempts
+        self.failureThreshold   = failureThreshold
+        self.retryAfterSecs     = retryAfterSecs
+
+        self.backends: List[LLMBackend] = []
+        self._lock = Lock()
+
+        # Only needed to enforce timeouts on the blocking clients
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+        self._healthRunner = background_task.BackgroundRunner(self,
+                                                              healthCheckIntervalSecs,
+                                                              runTaskOnStop = False,
+                                                              scheduler = background_task.BackgroundScheduler.GetShared())
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        self._healthRunner.stop()
+        if self._executor is not None:
+            self._executor.shutdown(wait = False, cancel_futures = True)
+            self._executor = None
+
+    def addBackend(self, model: LLMModel, name: str = "", costPer1KTokens: float = 0.0) -> LLMBackend:
+        backend = LLMBackend(model, name, costPer1KTokens)
+        if self.usageTracker is not None:
+            model.setUsageTracker(self.usageTracker)
+        if self.requestQueue is not None:
+            model.setRequestQueue(self.requestQueue)
+        if self.responseCache is not None:
+            model.setResponseCache(self.responseCache, self.cacheNonDeterministic)
+        with self._lock:
+            self.backends.append(backend)
+
+        return backend
+
+    def getStats(self) -> Dict[str, LLMBackendStats]:
+        with self._lock:
+            return { backend.name: copy.copy(backend.stats) for backend in self.backends }
+
+    # Connects every backend. Succeeds if at least one is usable.
+    def connectToClient(self, secretsMgr: secrets_mgr.SecretsMgr) -> bool:
+        success = False
+
+        for backend in self.backends:
+            connected = backend.model.connectToClient(secretsMgr)
+            with self._lock:
+                backend.stats.healthy = connected
+                if not connected:
+                    backend.stats.lastFailureTime = time.monotonic()
+                    self.logger.warning(LogLine("Unable to connect LLM backend: ", backend.name))
+            success = success or connected
+
+        if success and not self._healthRunner.isRunning():
+            self._healthRunner.start()
+
+        return success
+
+    async def aclose(self):
+        for backend in self.backends:
+            await backend.model.aclose()
+
+    def setResponseCache(self, responseCache: Optional[LLMResponseCache], cacheNonDeterministic: bool = False):
+        super().setResponseCache(responseCache, cacheNonDeterministic)
+        for backend in self.backends:
+            backend.model.setResponseCache(responseCache, cacheNonDeterministic)
+
+    # Applies to every backend. To queue per server set a queue on each backend's model instead.
+    def setRequestQueue(self, requestQueue: Optional[LLMRequestQueue]):
+        super().setRequestQueue(requestQueue)
+        for backend in self.backends:
+            backend.model.setRequestQueue(requestQueue)
+
+    # Usage is recorded by each backend under its own model name
+    def setUsageTracker(self, usageTracker: Optional[LLMUsageTracker]):
+        super().setUsageTracker(usageTracker)
+        for backend in self.backends:
+            backend.model.setUsageTracker(usageTracker)
+
+    # Smallest context so messages fit whichever backend is picked
+    def getMaxContextLength(self) -> int:
+        contextLens = [backend.model.getMaxContextLength() for backend in self.backends]
+        contextLens = [contextLen for contextLen in contextLens if contextLen > 0]
+        return min(contextLens) if len(contextLens) > 0 else 0
+
+    # Health checks run in the background
+    def doTask(self):
+        for backend in self.backends:
+            healthy = backend.model.checkHealth()
+            with self._lock:
+                if healthy and not backend.stats.healthy:
+                    self.logger.info(LogLine("LLM backend is healthy again: ", backend.name))
+                    backend.stats.consecutiveFailures = 0
+                elif not healthy:
+                    if backend.stats.healthy:
+                        self.logger.warning(LogLine("LLM backend failed health check: ", backend.name))
+                    backend.stats.lastFailureTime = time.monotonic()
+                backend.stats.healthy = healthy
+
+    def onTaskException(self, exception: Exception):
+        self.logger.exception("Unexpected exception while checking LLM backend health.")
+
+    def __getRankKey(self, backend: LLMBackend):
+        stats = backend.stats
+        latency = stats.latencyEWMASecs if stats.latencyEWMASecs is not None else 0.0 # Try unmeasured backends first
+
+        if self.policy == LLMRoutingPolicy.LATENCY_EWMA:
+            return (latency * (stats.outstanding + 1), stats.outstanding)
+        elif self.policy == LLMRoutingPolicy.COST:
+            return (backend.costPer1KTokens, stats.outstanding, latency)
+        else:
+            return (stats.outstanding, latency)
+
+    # Healthy backends by policy followed by unhealthy ones due for a retry.
+    # If none are left try them all rather than fail outright.
+    def __rankBackends(self) -> List[LLMBackend]:
+        with self._lock:
+            if len(self.backends) == 0:
+                raise Exception("No LLM backends added to router.")
+
+            now = time.monotonic()
+            healthy = sorted([backend for backend in self.backends if backend.stats.healthy], key = self.__getRankKey)
+            retry = sorted([backend for backend in self.backends
+                            if not backend.stats.healthy and now - backend.stats.lastFailureTime >= self.retryAfterSecs],
+                           key = lambda backend: backend.stats.lastFailureTime)
+
+            ranked = healthy + retry
+            if len(ranked) == 0:
+                ranked = sorted(self.backends, key = lambda backend: backend.stats.lastFailureTime)
+
+            return ranked[:self.maxAttempts]
+
+    def __begin(self, backend: LLMBackend) -> float:
+        with self._lock:
+            backend.stats.numRequests += 1
+            backend.stats.outstanding += 1
+
+        return time.monotonic()
+
+    def __release(self, backend: LLMBackend):
+        with self._lock:
+            backend.stats.outstanding -= 1
+
+    def __end(self, backend: LLMBackend, start: float, error: Optional[Exception]):
+        elapsed = time.monotonic() - start
+
+        with self._lock:
+            stats = backend.stats
+            if error is None:
+                stats.latencyEWMASecs = (elapsed if stats.latencyEWMASecs is None
+                                         else LLMRouter.EWMA_ALPHA * elapsed + (1.0 - LLMRouter.EWMA_ALPHA) * stats.latencyEWMASecs)
+                stats.consecutiveFailures = 0
+                stats.healthy = True
+            else:
+                stats.numFailures += 1
+                stats.consecutiveFailures += 1
+                stats.lastFailureTime = time.monotonic()
+                if isinstance(error, TimeoutError):
+                    stats.numTimeouts += 1
+                if stats.healthy and stats.consecutiveFailures >= self.failureThreshold:
+                    stats.healthy = False
+                    self.logger.warning(LogLine("Taking LLM backend out of rotation: ", backend.name))
+
+        if error is not None:
+            self.logger.warning(LogLine("LLM backend ", backend.name, " failed, trying next backend: ", error))
+
+    def __getExecutor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(thread_name_prefix = "LLMRouter")
+            return self._executor
+
+    def __callBackend(self, backend: LLMBackend, fnCall: Callable[[LLMModel], Any]):
+        if self.requestTimeoutSecs is None:
+            try:
+                return fnCall(backend.model)
+            finally:
+                self.__release(backend)
+        else:
+            # Blocking requests can't be interrupted so a timed out request
+            # still counts as outstanding until it actually finishes
+            future = self.__getExecutor().submit(fnCall, backend.model)
+            future.add_done_callback(lambda _: self.__release(backend))
+            try:
+                return future.result(timeout = self.requestTimeoutSecs)
+            except concurrent.futures.TimeoutError:
+                raise TimeoutError(f"LLM request timed out after {self.requestTimeoutSecs}s")
+
+    # Try backends in order until one succeeds. fnCall must raise on error.
+    def __route(self, fnCall: Callable[[LLMModel], Any], defaultAnswer, raiseOnError: bool):
+        answer = defaultAnswer
+        lastError: Optional[Exception] = None
+
+        try:
+            for backend in self.__rankBackends():
+                start = self.__begin(backend)
+                try:
+                    answer = self.__callBackend(backend, fnCall)
+                    self.__end(backend, start, None)
+                    lastError = None
+                    break
+                except Exception as e:
+                    self.__end(backend, start, e)
+                    lastError = e
+        except Exception as e:
+            lastError = e
+
+        if lastError is not None:
+            self.logger.error(LogLine("All LLM backends failed: ", lastError))
+            if raiseOnError:
+                raise lastError
+
+        return answer
+
+    async def __aroute(self, fnCall: Callable[[LLMModel], Awaitable[Any]], defaultAnswer, raiseOnError: bool):
+        answer = defaultAnswer
+        lastError: Optional[Exception] = None
+
+        try:
+            for backend in self.__rankBackends():
+                start = self.__begin(backend)
+                try:
+                    answer = await asyncio.wait_for(fnCall(backend.model), self.requestTimeoutSecs)
+                    self.__end(backend, start, None)
+                    lastError = None
+                    break
+                except Exception as e:
+                    self.__end(backend, start, e)
+                    lastError = e
+                finally:
+                    self.__release(backend)
+        except Exception as e:
+            lastError = e
+
+        if lastError is not None:
+            self.logger.error(LogLine("All LLM backends failed: ", lastError))
+            if raiseOnError:
+                raise lastError
+
+        return answer
+
+    def chat(self, 
+             messages: List[LLMMessage], 
+             outputFormat                   = None, 
+             raiseOnError: bool             = False,
+             priority: Priority             = Priority.P3_Medium,
+             deadlineSecs: Optional[float]  = None) -> str:
+        return self.__route(lambda model: model.chat(messages, outputFormat, True, priority, deadlineSecs),
+                            None if outputFormat is not None else "",
+                            raiseOnError)
+
+    async def achat(self, 
+                    messages: List[LLMMessage], 
+                    outputFormat                    = None, 
+                    raiseOnError: bool              = False,
+                    priority: Priority              = Priority.P3_Medium,
+                    deadlineSecs: Optional[float]   = None) -> str:
+        return await self.__aroute(lambda model: model.achat(messages, outputFormat, True, priority, deadlineSecs),
+                                   None if outputFormat is not None else "",
+                                   raiseOnError)
+
+    def chatStructured(self,
+                       messages: List[LLMMessage],
+                       outputFormat,
+                       onField: Optional[Callable[[str, Any], None]] = None,
+                       maxRepairAttempts: int = LLMModel.DEFAULT_MAX_REPAIR_ATTEMPTS,
+                       raiseOnError: bool = False,
+                       priority: Priority = Priority.P3_Medium,
+                       deadlineSecs: Optional[float] = None):
+        return self.__route(lambda model: model.chatStructured(messages, outputFormat, onField, maxRepairAttempts, True, 
+                                                               priority, deadlineSecs),
+                            None,
+                            raiseOnError)
+
+    async def achatStructured(self,
+                              messages: List[LLMMessage],
+                              outputFormat,
+                              onField: Optional[Callable[[str, Any], None]] = None,
+                              maxRepairAttempts: int = LLMModel.DEFAULT_MAX_REPAIR_ATTEMPTS,
+                              raiseOnError: bool = False,
+                              priority: Priority = Priority.P3_Medium,
+                              deadlineSecs: Optional[float] = None):
+        return await self.__aroute(lambda model: model.achatStructured(messages, outputFormat, onField, maxRepairAttempts, True,
+                                                                       priority, deadlineSecs),
+                                   None,
+                                   raiseOnError)
+
+    # Fails over only until the first delta arrives since the caller may already
+    # have used a partial answer. Timeouts aren't enforced while streaming.
+    def __streamRoute(self, fnStream: Callable[[LLMModel], Iterable[LLMStreamDelta]]) -> Iterator[LLMStreamDelta]:
+        lastError: Optional[Exception] = None
+
+        for backend in self.__rankBackends():
+            started = False
+            start = self.__begin(backend)
+            try:
+                for delta in fnStream(backend.model):
+                    started = True
+                    yield delta
+                self.__end(backend, start, None)
+                return
+            except Exception as e:
+                self.__end(backend, start, e)
+                if started:
+                    raise
+                lastError = e
+            finally:
+                self.__release(backend)
+
+        raise lastError if lastError is not None else Exception("No LLM backends available.")
+
+    async def __astreamRoute(self, fnStream: Callable[[LLMModel], AsyncIterable[LLMStreamDelta]]) -> AsyncIterator[LLMStreamDelta]:
+        lastError: Optional[Exception] = None
+
+        for backend in self.__rankBackends():
+            started = False
+            start = self.__begin(backend)
+            try:
+                async for delta in fnStream(backend.model):
+                    started = True
+                    yield delta
+                self.__end(backend, start, None)
+                return
+            except Exception as e:
+                self.__end(backend, start, e)
+                if started:
+                    raise
+                lastError = e
+            finally:
+                self.__release(backend)
+
+        raise lastError if lastError is not None else Exception("No LLM backends available.")
+
+    def chatStream(self, 
+                   messages: List[LLMMessage], 
+                   outputFormat                     = None,
+                   priority: Priority               = Priority.P3_Medium,
+                   deadlineSecs: Optional[float]    = None) -> LLMStream:
+        return LLMStream(lambda: self.__streamRoute(lambda model: model.chatStream(messages, outputFormat, priority, deadlineSecs)),
+                         lambda: self.__astreamRoute(lambda model: model.chatStream(messages, outputFormat, priority, deadlineSecs)))
+
+    # Token counts are close enough across backends so use the first
+    def countTokens(self, contents: List[str]) -> List[int]:
+        if len(self.backends) == 0:
+            raise Exception("No LLM backends added to router.")
+
+        return self.backends[0].model.countTokens(contents)
+
+    def _countTokensBatch(self, contents: List[str]) -> List[int]:
+        return self.countTokens(contents)
+
+    # Requests are routed in chat, achat, chatStream and the structured variants.
+    # The raw hooks are routed too, each response carrying the backend that parses it.
+    def _parseResponse(self, response: dict) -> LLMResponse:
+        return response["model"]._parseResponse(response["response"])
+
+    def _doChat(self, messages: List[LLMMessage], responseFormatJson = None) -> dict:
+        return self.__route(lambda model: { "model": model, "response": model._doChat(messages, responseFormatJson) }, None, True)
+
+    async def _doChatAsync(self, messages: List[LLMMessage], responseFormatJson = None) -> dict:
+        async def fnCall(model: LLMModel) -> dict:
+            return { "model": model, "response": await model._doChatAsync(messages, responseFormatJson) }
+
+        return await self.__aroute(fnCall, None, True)
+
+    def _doChatStream(self, messages: List[LLMMessage], responseFormatJson = None) -> Iterator[LLMStreamDelta]:
+        return self.__streamRoute(lambda model: model._doChatStream(messages, responseFormatJson))
+
+    def _doChatStreamAsync(self, messages: List[LLMMessage], responseFormatJson = None) -> AsyncIterator[LLMStreamDelta]:
+        return self.__astreamRoute(lambda model: model._doChatStreamAsync(messages, responseFormatJson))
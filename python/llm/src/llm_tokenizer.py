@@ -0,0 +1,87 @@
+from pathlib        import Path
+from threading      import Lock
+from typing         import cast, Dict, List, Optional
+
+import os
+import tiktoken
+
+from transformers   import AutoTokenizer
+
+# Local packages
+from core           import cache
+from my_secrets     import secrets_mgr
+
+# Tokenizers are large and slow to load so each one is loaded once per
+# process, on first use, and shared by every model instance.
+class TokenizerRegistry:
+    DefaultTiktokenEncoding = "o200k_base" # For models tiktoken doesn't know about
+
+    # Cache list of tokenizers
+    HFLookup: Dict[str, object]                     = {}
+    TiktokenLookup: Dict[str, tiktoken.Encoding]    = {}
+    lock: Lock = Lock()
+
+    @staticmethod
+    def GetHFTokenizer(tokenizerName: str, hfToken: Optional[secrets_mgr.Secret], cacheDir: Path):
+        with TokenizerRegistry.lock:
+            if not tokenizerName in TokenizerRegistry.HFLookup:
+                # Fast tokenizers are backed by Rust and can encode batches in parallel
+                if not cacheDir.is_dir():
+                    tokenizer = AutoTokenizer.from_pretrained(tokenizerName,
+                                                              token = hfToken.expose() if hfToken is not None else None,
+                                                              use_fast = True)
+                    tokenizer.save_pretrained(str(cacheDir))
+                else:
+                    tokenizer = AutoTokenizer.from_pretrained(str(cacheDir), use_fast = True)
+
+                TokenizerRegistry.HFLookup[tokenizerName] = tokenizer
+
+            return TokenizerRegistry.HFLookup[tokenizerName]
+
+    @staticmethod
+    def GetTiktokenEncoding(modelName: str) -> tiktoken.Encoding:
+        with TokenizerRegistry.lock:
+            if not modelName in TokenizerRegistry.TiktokenLookup:
+                try:
+                    encoding = tiktoken.encoding_for_model(modelName)
+                except KeyError:
+                    encoding = tiktoken.get_encoding(TokenizerRegistry.DefaultTiktokenEncoding)
+
+                TokenizerRegistry.TiktokenLookup[modelName] = encoding
+
+            return TokenizerRegistry.TiktokenLookup[modelName]
+
+    @staticmethod
+    def GetDefaultCacheDir(modelName: str) -> Path:
+        return Path(os.path.expanduser(f"~/models/{modelName}-tokenizer"))
+
+# Remembers token counts for content seen recently, e.g. the context
+# messages resent with every turn of a conversation. Thread safe.
+class TokenCountCache:
+    DEFAULT_MAX_ENTRIES = 4096
+
+    def __init__(self, maxEntries: int = DEFAULT_MAX_ENTRIES):
+        self._counts    = cache.LRUDict[str, int](maxEntries)
+        self._lock      = Lock()
+
+    # Returns counts for contents in order, using countFn for a single batch of misses.
+    def count(self, contents: List[str], countFn) -> List[int]:
+        counts: List[Optional[int]] = [None] * len(contents)
+
+        with self._lock:
+            for idx, content in enumerate(contents):
+                counts[idx] = self._counts.get(content)
+
+        # Each distinct miss is only counted once
+        misses = list(dict.fromkeys(contents[idx] for idx, count in enumerate(counts) if count is None))
+        if len(misses) > 0:
+            missCounts = dict(zip(misses, countFn(misses)))
+            with self._lock:
+                for content, count in missCounts.items():
+                    if self._counts.get(content) is None:
+                        self._counts.put(content, count)
+                        self._counts.prune()
+
+            counts = [count if count is not None else missCounts[content] for content, count in zip(contents, counts)]
+
+        return cast(List[int], counts)
@@ -0,0 +1,111 @@
+import copy
+import math
+
+from collections    import deque
+from threading      import Lock
+from typing         import Deque, Dict, List
+
+# This package
+from .llm_define    import LLMUsage
+
+# Running totals for one model plus a window of recent requests for percentiles
+class LLMUsageStats:
+    def __init__(self, model: str, windowSize: int):
+        self.model              = model
+        self.numRequests        = 0
+        self.numCached          = 0
+        self.promptTokens       = 0
+        self.completionTokens   = 0
+        self.generationSecs     = 0.0   # Time spent generating completion tokens
+        self.recent: Deque[LLMUsage] = deque(maxlen = windowSize)
+
+    def record(self, usage: LLMUsage):
+        self.numRequests += 1
+        if usage.cached:
+            self.numCached += 1
+        else:
+            self.promptTokens       += usage.promptTokens
+            self.completionTokens   += usage.completionTokens
+            if usage.tokensPerSec > 0:
+                self.generationSecs += usage.completionTokens / usage.tokensPerSec
+            self.recent.append(usage)
+
+    @property
+    def tokensPerSec(self) -> float:
+        return self.completionTokens / self.generationSecs if self.generationSecs > 0 else 0.0
+
+    # Nearest rank over the recent window. 0 if nothing recorded yet. Set skipZero
+    # for timings only some requests have, e.g. time to first token when streaming.
+    def getPercentile(self, attribute: str, percent: float, skipZero: bool = False) -> float:
+        values = sorted(value for value in (getattr(usage, attribute) for usage in self.recent)
+                        if not skipZero or value > 0)
+        if len(values) == 0:
+            return 0.0
+
+        rank = max(1, math.ceil(percent / 100.0 * len(values)))
+        return values[rank - 1]
+
+# Aggregates LLMUsage by model across every request made through the models it's
+# set on. Thread safe since requests complete on worker threads and event loops.
+class LLMUsageTracker:
+    DEFAULT_WINDOW_SIZE     = 1024
+    PERCENTILES             = (50, 95, 99)
+    TIMINGS                 = ("elapsedSecs", "firstTokenSecs", "queueSecs", "loadSecs", "promptEvalSecs", "evalSecs")
+    STREAMING_TIMINGS       = ("firstTokenSecs",)
+    METRIC_PREFIX           = "llm_"
+
+    def __init__(self, windowSize: int = DEFAULT_WINDOW_SIZE):
+        self.windowSize = windowSize
+        self._stats: Dict[str, LLMUsageStats] = {}
+        self._lock = Lock()
+
+    def record(self, usage: LLMUsage):
+        with self._lock:
+            if not usage.model in self._stats:
+                self._stats[usage.model] = LLMUsageStats(usage.model, self.windowSize)
+            self._stats[usage.model].record(usage)
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    # Snapshot by model
+    def getStats(self) -> Dict[str, LLMUsageStats]:
+        with self._lock:
+            snapshot: Dict[str, LLMUsageStats] = {}
+            for model, stats in self._stats.items():
+                statsCopy = copy.copy(stats)
+                statsCopy.recent = deque(stats.recent, maxlen = self.windowSize)
+                snapshot[model] = statsCopy
+
+            return snapshot
+
+    # Flat metric name to value with the model as a label, e.g.
+    # llm_queue_secs{model="gemma3",quantile="0.95"}, ready for a metrics exporter.
+    def exportMetrics(self) -> Dict[str, float]:
+        metrics: Dict[str, float] = {}
+
+        for model, stats in self.getStats().items():
+            label = f'model="{model}"'
+            metrics[f"{LLMUsageTracker.METRIC_PREFIX}requests_total{{{label}}}"]           = stats.numRequests
+            metrics[f"{LLMUsageTracker.METRIC_PREFIX}cached_requests_total{{{label}}}"]    = stats.numCached
+            metrics[f"{LLMUsageTracker.METRIC_PREFIX}prompt_tokens_total{{{label}}}"]      = stats.promptTokens
+            metrics[f"{LLMUsageTracker.METRIC_PREFIX}completion_tokens_total{{{label}}}"]  = stats.completionTokens
+            metrics[f"{LLMUsageTracker.METRIC_PREFIX}tokens_per_sec{{{label}}}"]           = stats.tokensPerSec
+
+            for timing in LLMUsageTracker.TIMINGS:
+                name = LLMUsageTracker.__toSnakeCase(timing)
+                for percent in LLMUsageTracker.PERCENTILES:
+                    metrics[f'{LLMUsageTracker.METRIC_PREFIX}{name}{{{label},quantile="{percent / 100}"}}'] = \
+                        stats.getPercentile(timing, percent, timing in LLMUsageTracker.STREAMING_TIMINGS)
+
+        return metrics
+
+    # Prometheus text exposition format
+    def formatMetrics(self) -> str:
+        lines: List[str] = [f"{name} {value}" for name, value in self.exportMetrics().items()]
+        return "\n".join(lines) + "\n" if len(lines) > 0 else ""
+
+    @staticmethod
+    def __toSnakeCase(name: str) -> str:
+        return "".join("_" + char.lower() if char.isupper() else char for char in name)
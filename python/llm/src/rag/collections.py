@@ -1,11 +1,14 @@
+from contextlib                             import contextmanager
 from dataclasses                            import dataclass
+from datetime                               import datetime, timezone
 from enum                                   import Enum
 from langchain_chroma                       import Chroma
 from langchain_core.documents               import Document
 from langchain_community.vectorstores.utils import filter_complex_metadata
 
+from itertools                              import batched
 from pathlib                                import Path
-from typing                                 import Dict, Generic, Iterator, List, Optional, TypeVar
+from typing                                 import Dict, Generic, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar
 
 import json
 import shutil
@@ -14,9 +17,13 @@ import shutil
 from core                                   import cache
 
 # Local files
-from .embeddings                            import Embeddings
+from .embeddings                            import Embeddings, RAGCachedEmbeddings
+from .indexing                              import RAGIngestParams, RAGIngestPipeline, RAGIngestStats, RAGSyncReport
 from .meta                                  import RAGMetadata, RAGMetadataEncoder
+from .metastore                             import RAGMetadataStore
+from .retrieval                             import FuseRankings, RAGHybridParams, RAGLexicalIndex, RAGReranker
 from .sources                               import RAGSource
+from .transformer                           import RAGTransformer
 
 # Defines
 RAGSourceType       = TypeVar("RAGSourceType",  bound = RAGSource)
@@ -25,30 +32,143 @@ class RAGQueryMatchCondition(Enum):
     Match_Any   = 1,
     Match_All   = 2
 
+class RAGDateField(Enum):
+    Created     = "created"
+    Updated     = "updated"
+    Indexed     = "indexed"
+
+# Sources whose date is in [start, end). Either end can be left open. Source dates
+# are timezone aware so the bounds must be too.
+@dataclass
+class RAGDateRange:
+    field:  RAGDateField
+    start:  Optional[datetime] = None
+    end:    Optional[datetime] = None
+
+    def __post_init__(self):
+        for bound in [self.start, self.end]:
+            if bound is not None and bound.tzinfo is None:
+                raise ValueError(f"Date range for {self.field.value} needs timezone aware dates, got {bound}.")
+
+    def contains(self, metadata: RAGMetadata) -> bool:
+        value: datetime = getattr(metadata, self.field.value)
+        return ((self.start is None or value >= self.start)
+                and (self.end is None or value < self.end))
+
 ALL_RESULTS = -1
 
+# Tags, source IDs and date ranges select which sources are searched. Tags are
+# matched against each source's tags plus the collection's own.
 @dataclass
 class RAGQueryParams:
     maxResults:         int
     minThreshold:       float
     tags:               List[str]
     matchingCondition:  RAGQueryMatchCondition
+    sourceIDs:          List[str]
+    dateRanges:         List[RAGDateRange]
 
     def __init__(self,
                  minThreshold: float = 0.5, 
                  maxResults: int = 5, 
                  matchingTags: List[str] = [], 
-                 matchCondition: RAGQueryMatchCondition = RAGQueryMatchCondition.Match_Any):
+                 matchCondition: RAGQueryMatchCondition = RAGQueryMatchCondition.Match_Any,
+                 sourceIDs: List[str] = [],
+                 dateRanges: List[RAGDateRange] = []):
         
         self.maxResults         = maxResults
         self.minThreshold       = minThreshold
         self.matchingTags       = matchingTags
         self.matchingCondition  = matchCondition
+        self.sourceIDs          = sourceIDs
+        self.dateRanges         = dateRanges
+
+    def hasSourceFilter(self) -> bool:
+        return len(self.matchingTags) + len(self.sourceIDs) + len(self.dateRanges) > 0
+
+# Pages through query results best first without loading the whole collection. Only
+# IDs and distances are ranked, growing the number of neighbours asked for as pages
+# are consumed, and documents are fetched a page at a time. Stops at maxResults, at
+# the first result under the threshold or when the matching fragments run out.
+class RAGQueryCursor:
+    DEFAULT_PAGE_SIZE   = 100
+    GROWTH_FACTOR       = 2
+
+    def __init__(self, collection: "RAGCollection", queryStr: str, queryParams: RAGQueryParams, pageSize: int = DEFAULT_PAGE_SIZE):
+        self.collection     = collection
+        self.queryParams    = queryParams
+        self.pageSize       = pageSize
+
+        self.sourceIDs      = collection._getQuerySources(queryParams)
+        self.numCandidates  = collection.count(queryParams)
+        if queryParams.maxResults != ALL_RESULTS:
+            self.numCandidates = min(self.numCandidates, queryParams.maxResults)
+
+        self._queryStr                      = queryStr
+        self._queryEmbedding: Optional[List[float]] = None
+        self._ranked: List[Tuple[str, float]]   = []    # Best first
+        self._numRequested                  = 0         # Neighbours asked of the store so far
+        self._exhausted                     = self.numCandidates == 0
+        self._returned: Set[str]            = set()
+        self.numReturned                    = 0
+
+    def hasMore(self) -> bool:
+        return not self._exhausted or any(not id in self._returned for id, _ in self._ranked)
+
+    # Ask for more neighbours. The store returns the best k each time so the ranking is replaced.
+    def __rank(self):
+        if self._queryEmbedding is None:
+            self._queryEmbedding = self.collection.embeddings.embed_query(self._queryStr)
+
+        numRequested = min(self.numCandidates, 
+                           max(self.pageSize, self._numRequested * RAGQueryCursor.GROWTH_FACTOR, self.numReturned + self.pageSize))
+        ranked = self.collection._rankByVector(self._queryEmbedding, numRequested, self.sourceIDs)
+        self._numRequested = numRequested
+
+        self._ranked = []
+        for id, score in ranked:
+            if score < self.queryParams.minThreshold:
+                self._exhausted = True
+                break
+            self._ranked.append((id, score))
+
+        if len(ranked) < numRequested or numRequested >= self.numCandidates:
+            self._exhausted = True
+
+    def fetch(self, numResults: int) -> List[Tuple[Document, float]]:
+        page: List[Tuple[str, float]] = []
+
+        while len(page) < numResults:
+            pending = [(id, score) for id, score in self._ranked if not id in self._returned]
+            if len(pending) < numResults - len(page) and not self._exhausted:
+                self.__rank()
+                continue
+
+            for id, score in pending[:numResults - len(page)]:
+                self._returned.add(id)
+                page.append((id, score))
+            break
+
+        fragments = self.collection._getFragments([id for id, _ in page])
+        results = [(fragments[id], score) for id, score in page if id in fragments]
+
+        self.numReturned += len(results)
+        return results
+
+    def __iter__(self) -> Iterator[Tuple[Document, float]]:
+        while self.hasMore():
+            page = self.fetch(self.pageSize)
+            if len(page) == 0:
+                break
+            yield from page
 
 class RAGCollection(Generic[RAGSourceType]):
     MetadataFile: str   = "meta.json"
-    SourcesMeta: str    = "sources.json"
+    SourcesMeta: str    = "sources.json" # Replaced by SourcesStore, migrated on load
+    SourcesStore: str   = "sources.db"
+    LexicalIndex: str   = "lexical.db"
     DBFilename: str     = "chroma_langchain_db" # TODO: revisit naming convention
+    DELETE_BATCH_SIZE   = 4096 # Stay under the vector store's max batch size
 
     def __init__(self, saveDir: Path, metadata: RAGMetadata, embeddings: Embeddings):
         self.collectionDir      = Path(saveDir, metadata.id)
@@ -56,6 +176,13 @@ class RAGCollection(Generic[RAGSourceType]):
         self.embeddings         = embeddings
 
         self.sourcesMetadata: Dict[str, RAGMetadata] = {}
+        self.tagIndex: Dict[str, Set[str]]           = {} # Tag to IDs of sources with it
+        self.__indexedTags: Dict[str, List[str]]     = {} # Tags each source was indexed with
+        self.sourcesStore       = RAGMetadataStore(Path(self.collectionDir, RAGCollection.SourcesStore))
+        self.lexicalIndex       = RAGLexicalIndex(Path(self.collectionDir, RAGCollection.LexicalIndex))
+        self.lastIngestStats: Optional[RAGIngestStats] = None
+        self.lastSyncReport: Optional[RAGSyncReport]   = None
+        self._batchDepth        = 0 # Source changes are only flushed once outside all batches
 
         self.dbStore: Optional[Chroma] = None # TODO: consider making this generic as in VectorStore
 
@@ -70,8 +197,15 @@ class RAGCollection(Generic[RAGSourceType]):
             del self.dbStore
             self.dbStore = None
 
+        self.sourcesStore.close()
+        self.lexicalIndex.close()
+
         # Delete metadata, dbstore and collections dir
         Path(self.collectionDir, RAGCollection.MetadataFile).unlink()
+        for suffix in ["", "-wal", "-shm"]:
+            Path(self.collectionDir, RAGCollection.SourcesStore + suffix).unlink(missing_ok = True)
+            Path(self.collectionDir, RAGCollection.LexicalIndex + suffix).unlink(missing_ok = True)
+        Path(self.collectionDir, RAGCollection.SourcesMeta).unlink(missing_ok = True)
         shutil.rmtree(Path(self.collectionDir, RAGCollection.DBFilename))
         Path(self.collectionDir).rmdir()
 
@@ -96,16 +230,87 @@ class RAGCollection(Generic[RAGSourceType]):
         )
             
     def readSourceMetadata(self):
-        with open(Path(self.collectionDir, RAGCollection.SourcesMeta)) as f:
+        sourcesMetaPath = Path(self.collectionDir, RAGCollection.SourcesMeta)
+        if not self.sourcesStore.exists() and sourcesMetaPath.is_file():
+            self.__migrateSourceMetadata(sourcesMetaPath)
+
+        self.sourcesMetadata = self.sourcesStore.readAll()
+
+        self.tagIndex = {}
+        self.__indexedTags = {}
+        for sourceMeta in self.sourcesMetadata.values():
+            self.__indexTags(sourceMeta)
+
+    # Collections saved before the store kept their sources in a single JSON file
+    def __migrateSourceMetadata(self, sourcesMetaPath: Path):
+        with open(sourcesMetaPath) as f:
             sourcesJSON = json.load(f, object_hook = RAGMetadata.field_hook)
             for item in sourcesJSON:
-                sourceMeta = RAGMetadata(**item)
-                self.sourcesMetadata[sourceMeta.id] = sourceMeta
-
+                self.sourcesStore.put(RAGMetadata(**item))
+
+        self.sourcesStore.flush()
+        sourcesMetaPath.unlink()
+
+    def __indexTags(self, sourceMeta: RAGMetadata):
+        self.__indexedTags[sourceMeta.id] = list(sourceMeta.lsTags)
+        for tag in sourceMeta.lsTags:
+            self.tagIndex.setdefault(tag, set()).add(sourceMeta.id)
+
+    # Uses the tags as indexed since the metadata may have been changed in place
+    def __unindexTags(self, sourceID: str):
+        for tag in self.__indexedTags.pop(sourceID, []):
+            if tag in self.tagIndex:
+                self.tagIndex[tag].discard(sourceID)
+                if len(self.tagIndex[tag]) == 0:
+                    del self.tagIndex[tag]
+
+    # Keeps the sources, their store and the tag index in step
+    def _setSource(self, sourceMeta: RAGMetadata):
+        self.__unindexTags(sourceMeta.id)
+
+        self.sourcesMetadata[sourceMeta.id] = sourceMeta
+        self.__indexTags(sourceMeta)
+        self.sourcesStore.put(sourceMeta)
+
+    def _removeSource(self, sourceID: str):
+        self.__unindexTags(sourceID)
+        del self.sourcesMetadata[sourceID]
+        self.sourcesStore.delete(sourceID)
+
+    # Source changes are written behind, this writes any still pending
     def writeSourceMetadata(self):
-         with open(Path(self.collectionDir, RAGCollection.SourcesMeta), "w") as f:
-            lsSourceMeta: List[RAGMetadata] = list(self.sourcesMetadata.values())
-            json.dump(lsSourceMeta, f, cls = RAGMetadataEncoder)
+        self.sourcesStore.flush()
+
+    # Each change to the sources is written once done so it survives the process
+    # exiting. Bulk callers can batch many changes into one write instead.
+    @contextmanager
+    def batchSourceChanges(self) -> Iterator["RAGCollection"]:
+        self._batchDepth += 1
+        try:
+            yield self
+        finally:
+            self._batchDepth -= 1
+            self.__onSourcesChanged()
+
+    def __onSourcesChanged(self):
+        if self._batchDepth == 0:
+            self.writeSourceMetadata()
+
+    def close(self):
+        self.sourcesStore.close()
+        self.lexicalIndex.close()
+
+    def _deleteFragments(self, fragmentsID: Iterable[str]) -> int:
+        if self.dbStore is None:
+            raise ValueError("Please initialize dbStore.")
+
+        numDeleted = 0
+        for batch in batched(fragmentsID, RAGCollection.DELETE_BATCH_SIZE):
+            self.dbStore.delete(ids = list(batch))
+            self.lexicalIndex.delete(batch)
+            numDeleted += len(batch)
+
+        return numDeleted
 
     def doLoad(self):
         success = False
@@ -122,7 +327,10 @@ class RAGCollection(Generic[RAGSourceType]):
         if self.doLoad() and self.dbStore is not None:
             self.dbStore.reset_collection()
             self.sourcesMetadata = {}
-            self.writeSourceMetadata()
+            self.tagIndex = {}
+            self.__indexedTags = {}
+            self.sourcesStore.clear()
+            self.lexicalIndex.clear()
         else:
             raise ValueError("Please initialize dbStore.")
    
@@ -138,20 +346,83 @@ class RAGCollection(Generic[RAGSourceType]):
         # Write the sources if there are any
         self.writeSourceMetadata()
 
+    # Vectors are computed by the ingest pipeline so they're written directly
+    def _upsert(self, ids: List[str], vectors: List[List[float]], documents: List[Document]):
+        if self.dbStore is None:
+            raise ValueError("Please initialize dbStore.")
+
+        documents = filter_complex_metadata(documents)
+        self.dbStore._collection.upsert(
+            ids         = ids,
+            embeddings  = vectors,
+            metadatas   = [document.metadata for document in documents],
+            documents   = [document.page_content for document in documents]
+        )
+        self.lexicalIndex.upsert(ids, documents)
+
+    # Fill the lexical index from the vector store, e.g. for collections created before it
+    def rebuildLexicalIndex(self):
+        if not self.doLoad():
+            raise LookupError(f"Unable to load vector store for collection {self.metadata.id}")
+
+        self.lexicalIndex.clear()
+        dbCollection = self._getDBCollection()
+        offset = 0
+        while True:
+            response = dbCollection.get(limit = RAGCollection.DELETE_BATCH_SIZE, offset = offset, include = ["documents", "metadatas"])
+            if len(response["ids"]) == 0:
+                break
+
+            self.lexicalIndex.upsert(response["ids"], [Document(page_content = content, metadata = metadata or {})
+                                                       for content, metadata in zip(response["documents"], response["metadatas"])])
+            offset += len(response["ids"])
+
+    # Tag fragments indexed before they carried their source ID with it. Source, tag
+    # and date filters select fragments by that ID so untagged ones would be missed.
+    # Returns the number of fragments tagged.
+    def backfillSourceIDs(self) -> int:
+        if not self.doLoad():
+            raise LookupError(f"Unable to load vector store for collection {self.metadata.id}")
+
+        dbCollection = self._getDBCollection()
+        numTagged = 0
+        for sourceID, sourceMeta in self.sourcesMetadata.items():
+            for batch in batched(sorted(RAGSource.GetTOCFragmentsID(sourceMeta.toc)), RAGCollection.DELETE_BATCH_SIZE):
+                response = dbCollection.get(ids = list(batch), include = ["documents", "metadatas"])
+
+                ids: List[str]              = []
+                documents: List[Document]   = []
+                for id, content, metadata in zip(response["ids"], response["documents"], response["metadatas"]):
+                    metadata = metadata or {}
+                    if metadata.get(RAGSource.SOURCE_ID_KEY) != sourceID:
+                        metadata[RAGSource.SOURCE_ID_KEY] = sourceID
+                        ids.append(id)
+                        documents.append(Document(page_content = content, metadata = metadata))
+
+                if len(ids) > 0:
+                    dbCollection.update(ids = ids, metadatas = [document.metadata for document in documents])
+                    self.lexicalIndex.upsert(ids, documents)
+                    numTagged += len(ids)
+
+        return numTagged
+
+    # Streams the source's documents through the transformer into the vector store.
+    # Sources already loaded and transformed can be added without a transformer.
     # TODO: not thread safe yet
-    def addSource(self, source: RAGSourceType) -> bool:
+    def addSource(self, 
+                  source: RAGSourceType, 
+                  transformer: Optional[RAGTransformer] = None,
+                  ingestParams: RAGIngestParams         = RAGIngestParams()) -> bool:
         success = False
 
         if self.doLoad() and self.dbStore is not None:
-            docList = list(source.getRawDocs())
-            docListMetaFiltered = filter_complex_metadata(docList)    
-            self.dbStore.add_documents(documents = docListMetaFiltered)
+            pipeline = RAGIngestPipeline(source, transformer, self.embeddings, self._upsert, ingestParams)
+            self.lastIngestStats = pipeline.run()
 
             # Update meta for this source
-            self.sourcesMetadata[source.metadata.id] = source.metadata
-
-            # TODO: optimize to avoid writing meta source over and over
-            self.writeSourceMetadata()
+            source.metadata.indexed = datetime.now(timezone.utc)
+            self._setSource(source.metadata)
+            self.__onSourcesChanged()
 
             success = True
         else:
@@ -160,26 +431,92 @@ class RAGCollection(Generic[RAGSourceType]):
         return success # Assume OK if not exception generated
 
     def delSource(self, sourceID: str) -> bool:
+        success = False
+
         # Delete all fragments from documents in source ID
         if self.doLoad() and self.dbStore is not None:
+            if not sourceID in self.sourcesMetadata:
+                raise LookupError(f"Unable to find source {sourceID} in collection {self.metadata.id}")
+
             currSource = self.sourcesMetadata[sourceID]
-            for entry in currSource.toc:
-                self.dbStore.delete(entry.value)
+            self._deleteFragments(RAGSource.GetTOCFragmentsID(currSource.toc))
+
             # Delete from hash
-            del self.sourcesMetadata[sourceID]
+            self._removeSource(sourceID)
+            self.__onSourcesChanged()
 
-            # TODO: optimize to avoid writing meta source over and over
-            self.writeSourceMetadata()
+            success = True
         else:
             raise LookupError(f"Unable to load vector store for collection {self.metadata.id}") 
         
-        return False
+        return success
     
     def delDocument(self, sourceID: str, docID: str) -> bool:
-        return False
+        success = False
+
+        if self.doLoad() and self.dbStore is not None:
+            if not sourceID in self.sourcesMetadata:
+                raise LookupError(f"Unable to find source {sourceID} in collection {self.metadata.id}")
+
+            toc = self.sourcesMetadata[sourceID].toc
+            if docID in toc:
+                self._deleteFragments(RAGSource.GetTOCFragmentsID({ docID: toc[docID] }))
+                del toc[docID]
+
+                self.sourcesStore.put(self.sourcesMetadata[sourceID])
+                self.__onSourcesChanged()
+                success = True
+        else:
+            raise LookupError(f"Unable to load vector store for collection {self.metadata.id}")
+
+        return success
+
+    # Re-index only what changed since the source was last added or updated. Documents
+    # found unchanged by the source, e.g. by file fingerprint, are not loaded again.
+    # Fragment IDs follow from their content so within changed documents only new
+    # fragments are embedded and only ones no longer produced are deleted. What
+    # changed is left in lastSyncReport.
+    def updateSource(self, 
+                     source: RAGSourceType, 
+                     transformer: Optional[RAGTransformer] = None,
+                     ingestParams: RAGIngestParams         = RAGIngestParams()) -> bool:
+        success = False
+
+        if self.doLoad() and self.dbStore is not None:
+            previous = self.sourcesMetadata.get(source.metadata.id)
+            baseline = previous.toc if previous is not None else {}
+            source.setBaseline(baseline)
+            source.metadata.toc = {}
+
+            pipeline = RAGIngestPipeline(source, transformer, self.embeddings, self._upsert, ingestParams)
+            self.lastIngestStats = pipeline.run()
+
+            # Remove fragments no longer part of any document
+            staleIDs = RAGSource.GetTOCFragmentsID(baseline) - RAGSource.GetTOCFragmentsID(source.metadata.toc)
+            self._deleteFragments(staleIDs)
+
+            report = RAGSyncReport(
+                removedDocs             = [docID for docID in baseline if not docID in source.metadata.toc],
+                unchangedDocs           = list(source.unchangedDocs),
+                numFragmentsUpserted    = self.lastIngestStats.numUpserted,
+                numFragmentsDeleted     = len(staleIDs)
+            )
+            for doc in source.docs.values():
+                if doc.id in baseline:
+                    report.changedDocs.append(doc.id)
+                else:
+                    report.addedDocs.append(doc.id)
+            self.lastSyncReport = report
+
+            source.metadata.indexed = datetime.now(timezone.utc)
+            self._setSource(source.metadata)
+            self.__onSourcesChanged()
 
-    def updateSource(self, sourceID: str) -> bool:
-        return False
+            success = True
+        else:
+            raise LookupError(f"Unable to load vector store for collection {self.metadata.id}")
+
+        return success
     
     # Iterate over the source metadata.
     def __iter__(self) -> Iterator[RAGMetadata]:
@@ -188,21 +525,172 @@ class RAGCollection(Generic[RAGSourceType]):
         else:
             raise LookupError(f"Unable to get sources for collection {self.metadata.id}")
     
+    # Fuses vector and BM25 keyword rankings so exact terms such as names and codes are
+    # found even when embeddings miss them. Scores are the fused score or the reranker's
+    # if given, which rescores the top rerankTopN fused results. The threshold applies
+    # to vector candidates only since keyword scores aren't on the same scale.
+    def queryHybrid(self, 
+                    queryStr: str, 
+                    queryParams: RAGQueryParams         = RAGQueryParams(), 
+                    hybridParams: RAGHybridParams       = RAGHybridParams(),
+                    reranker: Optional[RAGReranker]     = None) -> List[Tuple[Document, float]]:
+        result: List[Tuple[Document, float]] = []
+
+        if self.doLoad():
+            if self.dbStore is not None:
+                sourceIDs = self._getQuerySources(queryParams)
+                if sourceIDs is not None and len(sourceIDs) == 0:
+                    return result # Nothing can match
+
+                numCandidates = self.count(queryParams)
+                if queryParams.maxResults != ALL_RESULTS:
+                    numCandidates = min(numCandidates, queryParams.maxResults * hybridParams.candidatesPerResult)
+                if numCandidates == 0:
+                    return result
+
+                vectorRanking = [id for id, score in self._rankByVector(self.embeddings.embed_query(queryStr), numCandidates, sourceIDs)
+                                 if score >= queryParams.minThreshold]
+                lexicalRanking = [id for id, _ in self.lexicalIndex.search(queryStr, numCandidates, sourceIDs)]
+
+                fused = FuseRankings([(vectorRanking, hybridParams.vectorWeight), 
+                                      (lexicalRanking, hybridParams.lexicalWeight)], 
+                                     hybridParams.rrfK)
+                maxResults = queryParams.maxResults if queryParams.maxResults != ALL_RESULTS else len(fused)
+
+                if reranker is not None:
+                    top = fused[:max(maxResults, hybridParams.rerankTopN)]
+                    fragments = self._getFragments([id for id, _ in top])
+                    documents = [fragments[id] for id, _ in top if id in fragments]
+                    scores = reranker.score(queryStr, documents)
+                    result = sorted(zip(documents, scores), key = lambda item: item[1], reverse = True)[:maxResults]
+                else:
+                    top = fused[:maxResults]
+                    fragments = self._getFragments([id for id, _ in top])
+                    result = [(fragments[id], score) for id, score in top if id in fragments]
+            else:
+                raise ValueError(f"Unable to load vector db for similarity search for collection {self.metadata.id}.")
+        else:
+            raise LookupError(f"Unable to get sources for collection {self.metadata.id}")
+
+        return result
+
+    def getSourcesByTags(self, tags: List[str], matchCondition: RAGQueryMatchCondition) -> Set[str]:
+        sourceIDs: Optional[Set[str]] = None
+
+        for tag in tags:
+            # A collection tag applies to all its sources
+            if tag in self.metadata.lsTags:
+                tagSources = set(self.sourcesMetadata.keys())
+            else:
+                tagSources = self.tagIndex.get(tag, set())
+
+            if sourceIDs is None:
+                sourceIDs = set(tagSources)
+            elif matchCondition == RAGQueryMatchCondition.Match_All:
+                sourceIDs &= tagSources
+            else:
+                sourceIDs |= tagSources
+
+        return sourceIDs if sourceIDs is not None else set()
+
+    # IDs of the sources to search or None to search all of them
+    def _getQuerySources(self, queryParams: RAGQueryParams) -> Optional[Set[str]]:
+        if not queryParams.hasSourceFilter():
+            return None
+
+        sourceIDs = set(self.sourcesMetadata.keys())
+        if len(queryParams.matchingTags) > 0:
+            sourceIDs &= self.getSourcesByTags(queryParams.matchingTags, queryParams.matchingCondition)
+        if len(queryParams.sourceIDs) > 0:
+            sourceIDs &= set(queryParams.sourceIDs)
+        if len(queryParams.dateRanges) > 0:
+            sourceIDs = {sourceID for sourceID in sourceIDs 
+                         if all(dateRange.contains(self.sourcesMetadata[sourceID]) for dateRange in queryParams.dateRanges)}
+
+        # No need to filter if every source matched
+        return sourceIDs if len(sourceIDs) < len(self.sourcesMetadata) else None
+
+    # The store's relevance for cosine distance, same as langchain's
+    @staticmethod
+    def _GetRelevanceScore(distance: float) -> float:
+        return 1.0 - distance
+
+    def _getDBCollection(self):
+        if self.dbStore is None:
+            raise ValueError("Please initialize dbStore.")
+
+        return self.dbStore._collection
+
+    # Best first fragment IDs and relevance of the nearest fragments to the embedding
+    def _rankByVector(self, queryEmbedding: List[float], numResults: int, sourceIDs: Optional[Set[str]]) -> List[Tuple[str, float]]:
+        response = self._getDBCollection().query(
+            query_embeddings    = [queryEmbedding],
+            n_results           = numResults,
+            where               = RAGCollection._getQueryFilter(sourceIDs),
+            include             = ["distances"]
+        )
+
+        return [(id, RAGCollection._GetRelevanceScore(distance)) for id, distance in zip(response["ids"][0], response["distances"][0])]
+
+    def _getFragments(self, fragmentsID: List[str]) -> Dict[str, Document]:
+        if len(fragmentsID) == 0:
+            return {}
+
+        response = self._getDBCollection().get(ids = fragmentsID, include = ["documents", "metadatas"])
+        return { id: Document(page_content = content, metadata = metadata or {}, id = id)
+                 for id, content, metadata in zip(response["ids"], response["documents"], response["metadatas"]) }
+
+    # Number of fragments the query's filters select. Counted from the sources' TOC
+    # when filtered so nothing is fetched from the store.
+    def count(self, queryParams: RAGQueryParams = RAGQueryParams()) -> int:
+        if not self.doLoad():
+            raise LookupError(f"Unable to get sources for collection {self.metadata.id}")
+
+        sourceIDs = self._getQuerySources(queryParams)
+        if sourceIDs is None:
+            return self._getDBCollection().count()
+        else:
+            return sum(len(RAGSource.GetTOCFragmentsID(self.sourcesMetadata[sourceID].toc)) for sourceID in sourceIDs)
+
+    def cursor(self, queryStr: str, queryParams: RAGQueryParams = RAGQueryParams(), pageSize: int = RAGQueryCursor.DEFAULT_PAGE_SIZE) -> RAGQueryCursor:
+        if not self.doLoad():
+            raise LookupError(f"Unable to get sources for collection {self.metadata.id}")
+
+        return RAGQueryCursor(self, queryStr, queryParams, pageSize)
+
+    # Vector store filter on the source each fragment came from. Collections indexed
+    # before fragments were tagged with it need backfillSourceIDs first.
+    @staticmethod
+    def _getQueryFilter(sourceIDs: Optional[Set[str]]) -> Optional[dict]:
+        if sourceIDs is None:
+            return None
+        elif len(sourceIDs) == 1:
+            return { RAGSource.SOURCE_ID_KEY: next(iter(sourceIDs)) }
+        else:
+            return { RAGSource.SOURCE_ID_KEY: { "$in": sorted(sourceIDs) } }
+
+    # Filters are resolved to sources here then applied by the vector store so only
+    # matching fragments are searched. Chroma has no distance cutoff so the threshold
+    # is applied to the nearest results it returns rather than to extra candidates.
+    # ALL_RESULTS returns everything above the threshold, paged through a cursor.
     def query(self, queryStr: str, queryParams: RAGQueryParams = RAGQueryParams()) -> List[tuple[Document, float]]:
         result: List[tuple[Document, float]] = []
 
-        # TODO: Add filtering of collection and source by tags
         if self.doLoad():
             if self.dbStore is not None:
+                sourceIDs = self._getQuerySources(queryParams)
+                if sourceIDs is not None and len(sourceIDs) == 0:
+                    return result # Nothing can match
+
                 if queryParams.maxResults == ALL_RESULTS:
-                    dbCollection = self.dbStore.get()
-                    queryParams.maxResults = len(dbCollection["documents"])
-
-                result = self.dbStore.similarity_search_with_relevance_scores(
-                    queryStr, 
-                    k = queryParams.maxResults,
-                    filter = None
-                )
+                    result = list(self.cursor(queryStr, queryParams))
+                else:
+                    result = self.dbStore.similarity_search_with_relevance_scores(
+                        queryStr, 
+                        k               = queryParams.maxResults,
+                        filter          = RAGCollection._getQueryFilter(sourceIDs),
+                        score_threshold = queryParams.minThreshold
+                    )
             else:
                 raise ValueError(f"Unable to load vector db for similarity search for collection {self.metadata.id}.")
         else:
@@ -229,7 +717,17 @@ class CollectionMgr:
             value.persist()
 
     # Class Members
-    def __init__(self, saveDir: Path, embeddings: Embeddings):
+    # Document embeddings are batched and cached for all collections. Keep embeddingCacheDir
+    # outside saveDir since every directory in saveDir is taken to be a collection.
+    def __init__(self, 
+                 saveDir: Path, 
+                 embeddings: Embeddings,
+                 embeddingCacheDir: Optional[Path]  = None,
+                 embeddingBatchSize: int            = RAGCachedEmbeddings.DEFAULT_BATCH_SIZE,
+                 embeddingConcurrency: int          = RAGCachedEmbeddings.DEFAULT_MAX_CONCURRENCY):
+        if not isinstance(embeddings, RAGCachedEmbeddings):
+            embeddings = RAGCachedEmbeddings(embeddings, embeddingCacheDir, embeddingBatchSize, embeddingConcurrency)
+
         self.saveDir    = saveDir
         self.embeddings = embeddings
 
@@ -268,6 +766,16 @@ class CollectionMgr:
         if collection is not None:
             collection.delete()
 
+    # Write what's pending in the collections in memory, e.g. before exiting
+    def close(self):
+        collections = self.cache.acquireDict()
+        try:
+            if collections is not None:
+                for _, collection in collections.items():
+                    collection.close()
+        finally:
+            self.cache.releaseDict()
+
 
 
 
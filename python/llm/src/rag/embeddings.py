@@ -1,3 +1,5 @@
+from concurrent.futures             import ThreadPoolExecutor
+from dataclasses                    import dataclass
 from enum                           import Enum
 from langchain_huggingface          import HuggingFaceEmbeddings
 from langchain_core.embeddings      import Embeddings
@@ -6,7 +8,16 @@ from langchain_ollama               import OllamaEmbeddings
 from pathlib                        import Path
 from pydantic                       import SecretStr
 from threading                      import Lock
-from typing                         import Dict
+from typing                         import Dict, List, Optional
+
+import hashlib
+import numpy as np
+import os
+import re
+import tempfile
+
+# User packages
+from core                           import cache
 
 class EmbeddingsProvider(Enum):
     Ollama = "Ollama",
@@ -72,4 +83,153 @@ class RAGEmbeddings:
                 else:
                     raise Exception(f"Unknown provider {provider}")
                 
-            return RAGEmbeddings.Lookup[provider] 
\ No newline at end of file
+            return RAGEmbeddings.Lookup[provider]
+
+    # Name of the model behind an embeddings provider, used to key cached vectors
+    @staticmethod
+    def GetModelName(embeddings: Embeddings) -> str:
+        for attribute in ("model_name", "model"):
+            modelName = getattr(embeddings, attribute, None)
+            if isinstance(modelName, str) and modelName != "":
+                return modelName
+
+        return type(embeddings).__name__
+
+@dataclass
+class RAGEmbeddingCacheStats:
+    memoryHits: int = 0
+    diskHits:   int = 0
+    misses:     int = 0
+
+    @property
+    def hitRate(self) -> float:
+        lookups = self.memoryHits + self.diskHits + self.misses
+        return (self.memoryHits + self.diskHits) / lookups if lookups > 0 else 0.0
+
+# Wraps an embeddings provider so documents are embedded in batches of batchSize with
+# up to maxConcurrency batches in flight. Vectors are cached by content hash per model,
+# in memory and optionally on disk as float16 .npy files, so re-ingesting a mostly
+# unchanged corpus only embeds the new chunks. Every vector goes through float16 so
+# the same text gets the same vector whether or not it was cached. Queries aren't cached.
+class RAGCachedEmbeddings(Embeddings):
+    DEFAULT_BATCH_SIZE      = 64
+    DEFAULT_MAX_CONCURRENCY = 4
+    DEFAULT_MAX_ENTRIES     = 16384
+    VECTOR_DTYPE            = np.float16
+
+    def __init__(self,
+                 embeddings: Embeddings,
+                 cacheDir: Optional[Path]   = None,
+                 batchSize: int             = DEFAULT_BATCH_SIZE,
+                 maxConcurrency: int        = DEFAULT_MAX_CONCURRENCY,
+                 maxEntries: int            = DEFAULT_MAX_ENTRIES):
+
+        self.embeddings     = embeddings
+        self.modelName      = RAGEmbeddings.GetModelName(embeddings)
+        self.batchSize      = max(1, batchSize)
+        self.maxConcurrency = max(1, maxConcurrency)
+        self.stats          = RAGEmbeddingCacheStats()
+
+        # One directory per model so a model's vectors can be dropped on their own
+        self.cacheDir: Optional[Path] = None
+        if cacheDir is not None:
+            self.cacheDir = Path(cacheDir, re.sub(r"[^A-Za-z0-9._-]", "_", self.modelName))
+            self.cacheDir.mkdir(mode = 0o700, parents = True, exist_ok = True)
+
+        self._memory    = cache.LRUDict[str, np.ndarray](maxEntries)
+        self._lock      = Lock()
+
+    def getKey(self, text: str) -> str:
+        return hashlib.sha256(f"{self.modelName}\0{text}".encode("utf-8")).hexdigest()
+
+    # Sharded by hash prefix to keep directories small
+    def __getFilepath(self, key: str) -> Path:
+        return Path(self.cacheDir, key[:2], key + ".npy") if self.cacheDir is not None else Path()
+
+    def __get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self.stats.memoryHits += 1
+                return vector
+
+        if self.cacheDir is not None:
+            try:
+                vector = np.load(self.__getFilepath(key), allow_pickle = False)
+            except (FileNotFoundError, ValueError, OSError):
+                vector = None # Missing or partially written
+
+            if vector is not None:
+                with self._lock:
+                    self.stats.diskHits += 1
+                    self.__putMemory(key, vector)
+                return vector
+
+        with self._lock:
+            self.stats.misses += 1
+
+        return None
+
+    # Lock must be held
+    def __putMemory(self, key: str, vector: np.ndarray):
+        if self._memory.get(key) is None:
+            self._memory.put(key, vector)
+            self._memory.prune()
+
+    def __put(self, key: str, vector: np.ndarray):
+        with self._lock:
+            self.__putMemory(key, vector)
+
+        # Write to a temp file and rename so readers never see a partial vector
+        if self.cacheDir is not None:
+            filepath = self.__getFilepath(key)
+            filepath.parent.mkdir(mode = 0o700, exist_ok = True)
+            fd, tempPath = tempfile.mkstemp(dir = filepath.parent, suffix = ".tmp")
+            try:
+                with os.fdopen(fd, "wb") as tempFile:
+                    np.save(tempFile, vector, allow_pickle = False)
+                os.replace(tempPath, filepath)
+            except Exception:
+                Path(tempPath).unlink(missing_ok = True)
+                raise
+
+    def __embedBatch(self, texts: List[str]) -> List[np.ndarray]:
+        vectors = self.embeddings.embed_documents(texts)
+        return [np.asarray(vector, dtype = RAGCachedEmbeddings.VECTOR_DTYPE) for vector in vectors]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.getKey(text) for text in texts]
+        vectors: List[Optional[np.ndarray]] = [self.__get(key) for key in keys]
+
+        # Embed each distinct missing text once
+        missing: Dict[str, str] = {}
+        for key, text, vector in zip(keys, texts, vectors):
+            if vector is None:
+                missing[key] = text
+
+        if len(missing) > 0:
+            missingKeys = list(missing.keys())
+            batches = [missingKeys[idx:idx + self.batchSize] for idx in range(0, len(missingKeys), self.batchSize)]
+
+            def fnEmbed(batchKeys: List[str]) -> List[np.ndarray]:
+                batchVectors = self.__embedBatch([missing[key] for key in batchKeys])
+                for key, vector in zip(batchKeys, batchVectors):
+                    self.__put(key, vector)
+                return batchVectors
+
+            computed: Dict[str, np.ndarray] = {}
+            if len(batches) == 1 or self.maxConcurrency == 1:
+                for batchKeys in batches:
+                    computed.update(zip(batchKeys, fnEmbed(batchKeys)))
+            else:
+                with ThreadPoolExecutor(max_workers = min(self.maxConcurrency, len(batches)),
+                                        thread_name_prefix = "RAGEmbeddings") as executor:
+                    for batchKeys, batchVectors in zip(batches, executor.map(fnEmbed, batches)):
+                        computed.update(zip(batchKeys, batchVectors))
+
+            vectors = [vector if vector is not None else computed[key] for key, vector in zip(keys, vectors)]
+
+        return [vector.astype(np.float32).tolist() for vector in vectors if vector is not None]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
@@ -0,0 +1,222 @@
+from dataclasses                import dataclass, field
+from langchain_core.documents   import Document
+from langchain_core.embeddings  import Embeddings
+from queue                      import Empty, Full, Queue
+from threading                  import Event, Thread
+from typing                     import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import time
+
+# Local files
+from .embeddings                import RAGCachedEmbeddings
+from .sources                   import RAGDoc, RAGSource
+from .transformer               import RAGTransformer
+
+# Upserts a batch of fragments given their IDs, vectors and documents
+RAGUpsertHandler = Callable[[List[str], List[List[float]], List[Document]], None]
+
+@dataclass
+class RAGIngestParams:
+    embedBatchSize:     int = 0     # Fragments embedded and upserted together, 0 to size from the embeddings
+    maxPendingDocs:     int = 4     # Loaded documents waiting to be split
+    maxPendingChunks:   int = 1024  # Fragments waiting to be embedded
+    maxPendingBatches:  int = 2     # Embedded batches waiting to be upserted
+
+@dataclass
+class RAGIngestStats:
+    numDocs:            int     = 0
+    numFragments:       int     = 0
+    numUpserted:        int     = 0
+    numSkipped:         int     = 0     # Fragments already indexed with the same content
+    elapsedSecs:        float   = 0.0
+    firstUpsertSecs:    float   = 0.0   # Time until the first vectors were written
+    stageBusySecs: Dict[str, float] = field(default_factory = dict)  # Time each stage spent working
+
+# What a sync changed, by document ID
+@dataclass
+class RAGSyncReport:
+    addedDocs:              List[str]   = field(default_factory = list)
+    changedDocs:            List[str]   = field(default_factory = list)
+    removedDocs:            List[str]   = field(default_factory = list)
+    unchangedDocs:          List[str]   = field(default_factory = list)
+    numFragmentsUpserted:   int         = 0
+    numFragmentsDeleted:    int         = 0
+
+    def hasChanges(self) -> bool:
+        return len(self.addedDocs) + len(self.changedDocs) + len(self.removedDocs) > 0
+
+# Error raised in a stage's thread, re-raised where the stage is consumed
+class _StageError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+# Streams a source into a vector store: discover -> load -> split -> embed -> upsert.
+# Each stage runs on its own thread connected to the next by a bounded queue so a
+# slow stage holds back the ones before it. Memory stays bounded by the queue sizes
+# whatever the size of the source, and vectors are written as soon as the first
+# batch is embedded. Upsert runs on the calling thread.
+class RAGIngestPipeline:
+    STOP_CHECK_SECS             = 0.1   # How often blocked stages check whether the pipeline stopped
+    DEFAULT_EMBED_BATCH_SIZE    = 64
+
+    def __init__(self,
+                 source: RAGSource,
+                 transformer: Optional[RAGTransformer],
+                 embeddings: Embeddings,
+                 fnUpsert: RAGUpsertHandler,
+                 params: RAGIngestParams = RAGIngestParams()):
+        self.source         = source
+        self.transformer    = transformer
+        self.embeddings     = embeddings
+        self.fnUpsert       = fnUpsert
+        self.params         = params
+        self.stats          = RAGIngestStats()
+        self.embedBatchSize = self.__getEmbedBatchSize()
+
+        self._stop          = Event()
+        self._threads: List[Thread] = []
+
+    # RAGCachedEmbeddings only embeds batches concurrently when one call holds several
+    # of them, so give each call enough fragments to keep all its workers busy.
+    def __getEmbedBatchSize(self) -> int:
+        if self.params.embedBatchSize > 0:
+            return self.params.embedBatchSize
+
+        if isinstance(self.embeddings, RAGCachedEmbeddings):
+            return self.embeddings.batchSize * self.embeddings.maxConcurrency
+
+        return RAGIngestPipeline.DEFAULT_EMBED_BATCH_SIZE
+
+    # Run the iterable on a thread, yielding its items through a queue of maxSize
+    def __stage(self, name: str, iterable: Iterable, maxSize: int) -> Iterator:
+        stageQueue: Queue = Queue(maxsize = max(1, maxSize))
+        done = object()
+
+        def fnPut(item) -> bool:
+            while not self._stop.is_set():
+                try:
+                    stageQueue.put(item, timeout = RAGIngestPipeline.STOP_CHECK_SECS)
+                    return True
+                except Full:
+                    pass
+            return False
+
+        def fnRun():
+            try:
+                for item in iterable:
+                    if not fnPut(item):
+                        return
+                fnPut(done)
+            except BaseException as e:
+                fnPut(_StageError(e))
+            finally:
+                if hasattr(iterable, "close"):
+                    iterable.close()
+
+        thread = Thread(target = fnRun, name = f"RAGIngest-{name}", daemon = True)
+        thread.start()
+        self._threads.append(thread)
+
+        finished = False
+        try:
+            while True:
+                try:
+                    item = stageQueue.get(timeout = RAGIngestPipeline.STOP_CHECK_SECS)
+                except Empty:
+                    if self._stop.is_set():
+                        return
+                    continue
+
+                if item is done:
+                    finished = True
+                    return
+                elif isinstance(item, _StageError):
+                    raise item.error
+                yield item
+        finally:
+            # Stop upstream stages if this one failed or was abandoned
+            if not finished:
+                self._stop.set()
+            thread.join()
+
+    def __addBusy(self, name: str, start: float):
+        self.stats.stageBusySecs[name] = self.stats.stageBusySecs.get(name, 0.0) + time.monotonic() - start
+
+    # Discover documents and read them in full so parsing overlaps splitting
+    def __load(self) -> Iterator[RAGDoc]:
+        docs = self.source.iterDocs()
+        while True:
+            start = time.monotonic()
+            doc = next(docs, None)
+            if doc is None:
+                break
+            if doc.rawDoc is not None:
+                doc.rawDoc = iter(list(doc.rawDoc))
+            self.__addBusy("load", start)
+
+            self.stats.numDocs += 1
+            yield doc
+
+    def __split(self, docs: Iterable[RAGDoc]) -> Iterator[Tuple[str, Document]]:
+        for doc in docs:
+            fragments = self.source.iterFragments(doc, self.transformer)
+            while True:
+                start = time.monotonic()
+                fragment = next(fragments, None)
+                self.__addBusy("split", start)
+                if fragment is None:
+                    break
+
+                self.stats.numFragments += 1
+                if self.source.isFragmentIndexed(doc.id, fragment[0]):
+                    self.stats.numSkipped += 1
+                else:
+                    yield fragment
+
+    def __batch(self, fragments: Iterable[Tuple[str, Document]]) -> Iterator[List[Tuple[str, Document]]]:
+        batch: List[Tuple[str, Document]] = []
+        for fragment in fragments:
+            batch.append(fragment)
+            if len(batch) >= self.embedBatchSize:
+                yield batch
+                batch = []
+
+        if len(batch) > 0:
+            yield batch
+
+    def __embed(self, batches: Iterable[List[Tuple[str, Document]]]) -> Iterator[Tuple[List[str], List[List[float]], List[Document]]]:
+        for batch in batches:
+            start = time.monotonic()
+            ids         = [fragmentID for fragmentID, _ in batch]
+            documents   = [document for _, document in batch]
+            vectors     = self.embeddings.embed_documents([document.page_content for document in documents])
+            self.__addBusy("embed", start)
+
+            yield ids, vectors, documents
+
+    def run(self) -> RAGIngestStats:
+        start = time.monotonic()
+        self._stop.clear()
+
+        docs        = self.__stage("load", self.__load(), self.params.maxPendingDocs)
+        fragments   = self.__stage("split", self.__split(docs), self.params.maxPendingChunks)
+        batches     = self.__stage("embed", self.__embed(self.__batch(fragments)), self.params.maxPendingBatches)
+
+        try:
+            for ids, vectors, documents in batches:
+                upsertStart = time.monotonic()
+                self.fnUpsert(ids, vectors, documents)
+                self.__addBusy("upsert", upsertStart)
+
+                if self.stats.numUpserted == 0:
+                    self.stats.firstUpsertSecs = time.monotonic() - start
+                self.stats.numUpserted += len(ids)
+        finally:
+            self._stop.set()
+            batches.close()
+            for thread in self._threads:
+                thread.join()
+            self._threads = []
+            self.stats.elapsedSecs = time.monotonic() - start
+
+        return self.stats
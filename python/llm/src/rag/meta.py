@@ -1,6 +1,6 @@
 from ast import Str
 from datetime                   import date, datetime, timezone
-from typing                     import List
+from typing                     import List, Optional
 
 import json
 import uuid
@@ -13,15 +13,16 @@ class RAGMetadata:
     
     DT_FORMAT_STR               = "%Y-%m-%d %H:%M:%S.%f%z"
 
-    def __init__(self, name: str = "", description: str = "", lsTags: List[str] = [], id: str = "", toc = {},
+    # Tags and TOC default to new containers so sources never share them
+    def __init__(self, name: str = "", description: str = "", lsTags: Optional[List[str]] = None, id: str = "", toc: Optional[dict] = None,
                  created = INVALID_RAG_METADATA_DATE, 
                  updated = INVALID_RAG_METADATA_DATE,
                  indexed = INVALID_RAG_METADATA_DATE):
         self.name:          str         = name
         self.description:   str         = description
-        self.lsTags:        List[str]   = lsTags
+        self.lsTags:        List[str]   = lsTags if lsTags is not None else []
         self.id:            str         = id # ID is of type str for greater flexibility
-        self.toc:           dict        = toc # Source, document or other TOC
+        self.toc:           dict        = toc if toc is not None else {} # Source, document or other TOC
 
         if created == INVALID_RAG_METADATA_DATE:
             self.created = datetime.now(timezone.utc) # Assume it's newly created and timestamp is "now"
@@ -33,7 +34,7 @@ class RAGMetadata:
         else:
             self.updated = updated # Assume same as created if it's a new record
 
-        #TODO: this needs to be updated during indexing
+        # Set by the collection whenever the source is indexed
         self.indexed = indexed 
 
         # Auto assign an ID
@@ -52,7 +53,7 @@ class RAGMetadata:
             dict["indexed"] = datetime.strptime(dict["indexed"], RAGMetadata.DT_FORMAT_STR)
         if "lsTags" in dict:
             lsTagsStr = dict["lsTags"]
-            dict["lsTags"] = lsTagsStr.split(",") if lsTagsStr != ""  else []
+            dict["lsTags"] = [tag.strip() for tag in lsTagsStr.split(",")] if lsTagsStr != ""  else []
 
         return dict
     
@@ -0,0 +1,123 @@
+from pathlib                    import Path
+from threading                  import Lock, Timer
+from typing                     import Dict, Optional, Set
+
+import json
+import sqlite3
+import time
+
+# Local files
+from .meta                      import RAGMetadata, RAGMetadataEncoder
+
+# Write-behind store for the metadata of a collection's sources. Each source is a row
+# so a change only rewrites that source. Changes are kept in memory and written in
+# one transaction once maxPending have built up, flushSecs after the first pending
+# change, or when flush is called, e.g. by the collection once a change is done.
+class RAGMetadataStore:
+    DEFAULT_MAX_PENDING     = 256
+    DEFAULT_FLUSH_SECS      = 5.0
+
+    def __init__(self,
+                 dbPath: Path,
+                 maxPending: int    = DEFAULT_MAX_PENDING,
+                 flushSecs: float   = DEFAULT_FLUSH_SECS):
+        self.dbPath     = dbPath
+        self.maxPending = maxPending
+        self.flushSecs  = flushSecs
+
+        self._dirty: Dict[str, RAGMetadata]     = {}
+        self._deleted: Set[str]                 = set()
+        self._timer: Optional[Timer]            = None
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock                              = Lock()
+
+        self.numFlushes     = 0
+        self.lastFlushTime  = 0.0
+
+    def __connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(str(self.dbPath), check_same_thread = False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS sources (id TEXT PRIMARY KEY, meta TEXT NOT NULL)")
+            self._connection.commit()
+
+        return self._connection
+
+    def exists(self) -> bool:
+        return self.dbPath.is_file()
+
+    def readAll(self) -> Dict[str, RAGMetadata]:
+        with self._lock:
+            sources: Dict[str, RAGMetadata] = {}
+            for _, metaJSON in self.__connect().execute("SELECT id, meta FROM sources"):
+                sourceMeta = RAGMetadata(**json.loads(metaJSON, object_hook = RAGMetadata.field_hook))
+                sources[sourceMeta.id] = sourceMeta
+
+            # Pending changes are newer than what's on disk
+            for id in self._deleted:
+                sources.pop(id, None)
+            sources.update(self._dirty)
+
+            return sources
+
+    # The metadata is serialized when flushed so later changes to it are picked up
+    def put(self, metadata: RAGMetadata):
+        with self._lock:
+            self._deleted.discard(metadata.id)
+            self._dirty[metadata.id] = metadata
+            self.__onChange()
+
+    def delete(self, id: str):
+        with self._lock:
+            self._dirty.pop(id, None)
+            self._deleted.add(id)
+            self.__onChange()
+
+    def clear(self):
+        with self._lock:
+            self._dirty     = {}
+            self._deleted   = set()
+            connection = self.__connect()
+            connection.execute("DELETE FROM sources")
+            connection.commit()
+
+    def numPending(self) -> int:
+        return len(self._dirty) + len(self._deleted)
+
+    # Called with the lock held
+    def __onChange(self):
+        if self.numPending() >= self.maxPending:
+            self.__flush()
+        elif self._timer is None:
+            self._timer = Timer(self.flushSecs, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def __flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if self.numPending() > 0:
+            rows = [(id, json.dumps(metadata, cls = RAGMetadataEncoder)) for id, metadata in self._dirty.items()]
+
+            connection = self.__connect()
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO sources (id, meta) VALUES (?, ?)", rows)
+                connection.executemany("DELETE FROM sources WHERE id = ?", [(id,) for id in self._deleted])
+
+            self._dirty     = {}
+            self._deleted   = set()
+            self.numFlushes += 1
+            self.lastFlushTime = time.time()
+
+    def flush(self):
+        with self._lock:
+            self.__flush()
+
+    def close(self):
+        with self._lock:
+            self.__flush()
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,157 @@
+from abc                                    import ABC, abstractmethod
+from dataclasses                            import dataclass
+from langchain_community.cross_encoders     import HuggingFaceCrossEncoder
+from langchain_core.documents               import Document
+from pathlib                                import Path
+from threading                              import Lock
+from typing                                 import Dict, Iterable, List, Optional, Set, Tuple
+
+import re
+import sqlite3
+
+# Local files
+from .sources                               import RAGSource
+
+# BM25 ranked keyword search over a collection's fragments, kept alongside its vector
+# store. Backed by SQLite FTS5 which maintains the inverted index and BM25 scoring.
+# Fragments are keyed by the same IDs as in the vector store.
+class RAGLexicalIndex:
+    TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+    def __init__(self, dbPath: Path):
+        self.dbPath = dbPath
+
+        self._connection: Optional[sqlite3.Connection] = None
+        self._lock = Lock()
+
+    def __connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(str(self.dbPath), check_same_thread = False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # FTS5 rows are looked up by rowid so fragment IDs are mapped to one
+            self._connection.execute("CREATE TABLE IF NOT EXISTS fragments (rowid INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, sourceID TEXT)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS fragments_source ON fragments (sourceID)")
+            self._connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS fragments_fts USING fts5(content, tokenize = 'unicode61')")
+            self._connection.commit()
+
+        return self._connection
+
+    # Terms OR'ed together and quoted so query text can't be taken as FTS5 syntax
+    @staticmethod
+    def GetMatchExpression(queryStr: str) -> str:
+        terms = dict.fromkeys(term.lower() for term in RAGLexicalIndex.TOKEN_PATTERN.findall(queryStr))
+        return " OR ".join(f'"{term}"' for term in terms)
+
+    def __delete(self, connection: sqlite3.Connection, ids: List[str]):
+        placeholders = ",".join("?" * len(ids))
+        rowids = [(rowid,) for (rowid,) in connection.execute(f"SELECT rowid FROM fragments WHERE id IN ({placeholders})", ids)]
+        connection.executemany("DELETE FROM fragments_fts WHERE rowid = ?", rowids)
+        connection.executemany("DELETE FROM fragments WHERE rowid = ?", rowids)
+
+    def upsert(self, ids: List[str], documents: List[Document]):
+        with self._lock:
+            connection = self.__connect()
+            with connection:
+                self.__delete(connection, ids)
+                for id, document in zip(ids, documents):
+                    cursor = connection.execute("INSERT INTO fragments (id, sourceID) VALUES (?, ?)",
+                                                (id, document.metadata.get(RAGSource.SOURCE_ID_KEY)))
+                    connection.execute("INSERT INTO fragments_fts (rowid, content) VALUES (?, ?)",
+                                       (cursor.lastrowid, document.page_content))
+
+    def delete(self, ids: Iterable[str]):
+        ids = list(ids)
+        if len(ids) > 0:
+            with self._lock:
+                connection = self.__connect()
+                with connection:
+                    self.__delete(connection, ids)
+
+    def clear(self):
+        with self._lock:
+            connection = self.__connect()
+            with connection:
+                connection.execute("DELETE FROM fragments_fts")
+                connection.execute("DELETE FROM fragments")
+
+    def count(self) -> int:
+        with self._lock:
+            return self.__connect().execute("SELECT COUNT(*) FROM fragments").fetchone()[0]
+
+    # Best first fragment IDs with their BM25 score, higher is better. Limited to
+    # the given sources unless None.
+    def search(self, queryStr: str, maxResults: int, sourceIDs: Optional[Set[str]] = None) -> List[Tuple[str, float]]:
+        matchExpression = RAGLexicalIndex.GetMatchExpression(queryStr)
+        if matchExpression == "" or (sourceIDs is not None and len(sourceIDs) == 0):
+            return []
+
+        sql = ("SELECT fragments.id, bm25(fragments_fts) AS score FROM fragments_fts "
+               "JOIN fragments ON fragments.rowid = fragments_fts.rowid "
+               "WHERE fragments_fts MATCH ?")
+        args: list = [matchExpression]
+        if sourceIDs is not None:
+            sql += f" AND fragments.sourceID IN ({','.join('?' * len(sourceIDs))})"
+            args.extend(sorted(sourceIDs))
+        sql += " ORDER BY score LIMIT ?"
+        args.append(maxResults)
+
+        with self._lock:
+            # FTS5's bm25 is lower for better matches
+            return [(id, -score) for id, score in self.__connect().execute(sql, args)]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+# Scores how well each document answers the query, higher is better
+class RAGReranker(ABC):
+    @abstractmethod
+    def score(self, queryStr: str, documents: List[Document]) -> List[float]:
+        pass
+
+# Local cross-encoder reading query and fragment together. Slower than comparing
+# embeddings so only applied to the top fused results.
+class RAGCrossEncoderReranker(RAGReranker):
+    DEFAULT_MODEL = "BAAI/bge-reranker-base"
+
+    # Models are large so load each once per process
+    Lookup: Dict[str, HuggingFaceCrossEncoder] = {}
+    lock: Lock = Lock()
+
+    def __init__(self, model: str = DEFAULT_MODEL):
+        self.model = model
+
+    @staticmethod
+    def GetShared(model: str) -> HuggingFaceCrossEncoder:
+        with RAGCrossEncoderReranker.lock:
+            if not model in RAGCrossEncoderReranker.Lookup:
+                RAGCrossEncoderReranker.Lookup[model] = HuggingFaceCrossEncoder(model_name = model)
+
+            return RAGCrossEncoderReranker.Lookup[model]
+
+    def score(self, queryStr: str, documents: List[Document]) -> List[float]:
+        if len(documents) == 0:
+            return []
+
+        crossEncoder = RAGCrossEncoderReranker.GetShared(self.model)
+        return [float(score) for score in crossEncoder.score([(queryStr, document.page_content) for document in documents])]
+
+@dataclass
+class RAGHybridParams:
+    candidatesPerResult:    int     = 4     # Candidates taken from each retriever per result wanted
+    rrfK:                   int     = 60    # Damps the weight of top ranks in reciprocal rank fusion
+    vectorWeight:           float   = 1.0
+    lexicalWeight:          float   = 1.0
+    rerankTopN:             int     = 20    # Fused results passed to the reranker if any
+
+# Reciprocal rank fusion: each list adds weight / (k + rank) for the IDs it ranks.
+# Uses ranks only so scores from different retrievers needn't be comparable.
+def FuseRankings(rankings: List[Tuple[List[str], float]], rrfK: int) -> List[Tuple[str, float]]:
+    fused: Dict[str, float] = {}
+    for ids, weight in rankings:
+        for rank, id in enumerate(ids, start = 1):
+            fused[id] = fused.get(id, 0.0) + weight / (rrfK + rank)
+
+    return sorted(fused.items(), key = lambda item: item[1], reverse = True)
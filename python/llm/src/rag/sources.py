@@ -1,16 +1,22 @@
 from abc                        import ABC, abstractmethod
-from dataclasses                import dataclass
+from concurrent.futures         import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses                import dataclass, field
 from enum                       import Enum
 from itertools                  import chain
 from pathlib                    import Path
-from typing                     import Dict, Iterator, Iterable, List, Optional
+from typing                     import Dict, Iterator, Iterable, List, Optional, Set, Tuple
 
 from langchain_core.documents   import Document
 
 from langchain_community.document_loaders.parsers   import TesseractBlobParser
 
+import hashlib
+import json
+import multiprocessing
 import os
-import uuid
+import signal
+import time
 
 # Local files
 from .meta                      import RAGMetadata
@@ -59,10 +65,15 @@ class SmartPDFLoader(UnstructuredPDFLoader):
         OCROnly = "ocr_only"    # Use optical character recognition to extract text from images
         VLM     = "vlm"         # Vision language models to extract text from image files
 
-    def __init__(self, file):
+    def __init__(self, file, strategy: Strategy = Strategy.HiRes):
         super().__init__(file, 
                          mode = SmartPDFLoader.Mode.Elements.value,
-                         strategy = SmartPDFLoader.Strategy.HiRes.value)
+                         strategy = strategy.value)
+
+# Text layer only. Much cheaper than hi_res but finds little in scanned documents.
+class FastPDFLoader(SmartPDFLoader):
+    def __init__(self, file):
+        super().__init__(file, strategy = SmartPDFLoader.Strategy.Fast)
 
 ALL_RESULTS:int = -1
 
@@ -72,7 +83,7 @@ FILETYPE_LOADERS = {
     # '*.html':   UnstructuredHTMLLoader,
     # '*.json':   JSONLoader,
     # '*.md':     UnstructuredMarkdownLoader,
-    '*.pdf':    SmartPDFLoader,
+    '*.pdf':    FastPDFLoader,
     # '*.pptx':   UnstructuredPowerPointLoader,
     # '*.ppt':    UnstructuredPowerPointLoader,
     # '*.txt':    TextLoader,
@@ -80,12 +91,19 @@ FILETYPE_LOADERS = {
     # '*.xlsx':   UnstructuredExcelLoader,
 }
 
+# Used instead when the loader above extracts too little text per page, e.g. scanned
+# PDFs that need layout models and OCR.
+FILETYPE_FALLBACK_LOADERS = {
+    '*.pdf':    SmartPDFLoader,
+}
+
 @dataclass
 class RAGDoc:
     rawDoc:         Optional[Iterator[Document]] # Lazy load docs
     source:         str
     id:             str
     fragmentsID:    List[str]
+    fingerprint:    Dict = field(default_factory = dict) # What the doc was built from, e.g. file mtime, size and hash
 
     # Try to free up memory if data is no longer needed
     def purge(self):
@@ -100,19 +118,108 @@ class RAGDoc:
         return {
             "source":       self.source,
             "id":           self.id,
-            "fragmentsID":  self.fragmentsID
+            "fragmentsID":  self.fragmentsID,
+            "fingerprint":  self.fingerprint
         }
 
 class RAGSource(ABC):
+    # Added to each fragment's metadata so vectors can be traced back to their document
+    SOURCE_ID_KEY   = "sourceID"
+    DOC_ID_KEY      = "docID"
+
     def __init__(self, metadata: RAGMetadata):
         self.metadata                   = metadata
         self.docs: Dict[str, RAGDoc]    = {}
+
+        # TOC from when the source was last indexed. Documents and fragments found
+        # unchanged against it are kept rather than indexed again.
+        self.baseline: Dict[str, dict]          = {}
+        self.unchangedDocs: List[str]           = []
+        self._baselineFragments: Dict[str, Set[str]] = {}
         
     # Load from disk or remote location
     @abstractmethod
     def load(self) -> bool:
         pass
 
+    # Fragment IDs are derived from the document, the fragment's content and metadata
+    # so the same fragment gets the same ID each time a document is split. Occurrence
+    # tells apart identical fragments within a document.
+    @staticmethod
+    def GetFragmentID(docID: str, fragmentHash: str, occurrence: int) -> str:
+        return hashlib.sha256(f"{docID}\0{occurrence}\0{fragmentHash}".encode()).hexdigest()
+
+    @staticmethod
+    def GetFragmentHash(fragment: Document) -> str:
+        content = json.dumps([fragment.page_content, fragment.metadata], sort_keys = True, default = str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    # All fragment IDs listed in a TOC
+    @staticmethod
+    def GetTOCFragmentsID(toc: Dict[str, dict]) -> Set[str]:
+        fragmentsID: Set[str] = set()
+        for rec in toc.values():
+            fragmentsID.update(rec.get("fragmentsID", []))
+
+        return fragmentsID
+
+    def setBaseline(self, toc: Dict[str, dict]):
+        self.baseline           = dict(toc)
+        self.unchangedDocs      = []
+        self._baselineFragments = {}
+
+    # Whether the fragment was already indexed for this document
+    def isFragmentIndexed(self, docID: str, fragmentID: str) -> bool:
+        if not docID in self.baseline:
+            return False
+
+        if not docID in self._baselineFragments:
+            self._baselineFragments[docID] = set(self.baseline[docID].get("fragmentsID", []))
+
+        return fragmentID in self._baselineFragments[docID]
+
+    # Carry over the document's record from the baseline, e.g. when it's unchanged
+    def _keepPrevious(self, docID: str, fingerprint: Optional[dict] = None):
+        rec = dict(self.baseline[docID])
+        if fingerprint is not None:
+            rec["fingerprint"] = fingerprint
+        self.metadata.toc[docID] = rec
+
+    # Documents not yet split into fragments. Sources that can discover documents
+    # lazily should override this so they don't have to be loaded up front.
+    def iterDocs(self) -> Iterator[RAGDoc]:
+        if self.docs is None:
+            raise LookupError(f"Unable to get source with id {self.metadata.id}")
+
+        for doc in list(self.docs.values()):
+            if not doc.isDecomposed():
+                yield doc
+
+    # Split one document yielding each fragment with its new ID as it's produced.
+    # Without a transformer the document's pages are the fragments. The document
+    # is purged and its TOC record updated once all fragments have been yielded.
+    def iterFragments(self, doc: RAGDoc, transformer: Optional[RAGTransformer]) -> Iterator[Tuple[str, Document]]:
+        if doc.rawDoc is None:
+            raise ValueError(f"Document associated with source {doc.source} already purged from memory.")
+
+        occurrences: Dict[str, int] = {}
+
+        fragments = transformer.transform(doc.rawDoc) if transformer is not None else doc.rawDoc
+        for fragment in fragments:
+            fragment.metadata[RAGSource.SOURCE_ID_KEY]  = self.metadata.id
+            fragment.metadata[RAGSource.DOC_ID_KEY]     = doc.id
+
+            fragmentHash = RAGSource.GetFragmentHash(fragment)
+            occurrence = occurrences.get(fragmentHash, 0)
+            occurrences[fragmentHash] = occurrence + 1
+
+            fragmentID = RAGSource.GetFragmentID(doc.id, fragmentHash, occurrence)
+            doc.fragmentsID.append(fragmentID)
+            yield fragmentID, fragment
+
+        doc.purge() # Free up memory from original doc
+        self.metadata.toc[doc.id] = doc.getTOCRec()
+
     # Extract text from tables or other complex structure
     def transform(self, transformer: RAGTransformer):
         success = False
@@ -120,26 +227,16 @@ class RAGSource(ABC):
         if self.docs is not None:
             newDocs: List[RAGDoc] = []
 
-            for doc in self.docs.values():
-                if not doc.isDecomposed():
-                    if doc.rawDoc is not None:
-                        docFragments = transformer.transform(doc.rawDoc)
-                        doc.purge() # Free up memory from original doc
-                        # Add each fragment as its own document
-                        for fragment in docFragments:
-                            fragmentID = str(uuid.uuid4())
-                            # Collect new docs in temp list ...
-                            newDocs.append(RAGDoc(
-                                rawDoc      = iter([fragment]),
-                                source      = doc.source,
-                                id          = str(fragmentID),
-                                fragmentsID = []
-                            ))
-                            doc.fragmentsID.append(fragmentID)
-                        # Update TOC with new fragments
-                        self.metadata.toc[doc.id] = doc.getTOCRec()
-                    else:
-                        raise ValueError(f"Document associated with source {doc.source} already purged from memory.")
+            for doc in list(self.iterDocs()):
+                # Add each fragment as its own document
+                for fragmentID, fragment in self.iterFragments(doc, transformer):
+                    # Collect new docs in temp list ...
+                    newDocs.append(RAGDoc(
+                        rawDoc      = iter([fragment]),
+                        source      = doc.source,
+                        id          = fragmentID,
+                        fragmentsID = []
+                    ))
             
             # Add all new docs to source
             for newDoc in newDocs:
@@ -191,12 +288,41 @@ class RAGSource(ABC):
             raise LookupError("Unable to remove doc from toc or associated fragments")
 
 
+# Files can be parsed in worker processes since the heavier loaders are CPU bound.
+# A file that fails or takes longer than fileTimeoutSecs in a worker is skipped and
+# recorded in failedFiles so one bad file doesn't stop the rest of the source. Workers
+# stuck where their alarm can't interrupt them, e.g. in native code, are caught by the
+# parent which replaces the pool. So are workers that die, e.g. crash or are killed
+# for memory, after which the files they may have been parsing are retried one at a
+# time to find the one responsible.
 class LocalFilesSource(RAGSource):
-    def __init__(self, sourcePath: Path, metadata: RAGMetadata, recursiveLoad: bool = True):
+    SEQUENTIAL                  = 0     # Parse on the calling thread as documents are iterated
+    DEFAULT_FILE_TIMEOUT_SECS   = 600.0
+    DEFAULT_MIN_CHARS_PER_PAGE  = 200   # Less text than this and the fallback loader is tried
+    FILES_QUEUED_PER_WORKER     = 2     # Keeps workers busy without discovery running far ahead
+    PAGE_NUMBER_KEY             = "page_number"
+    HASH_BLOCK_SIZE             = 1 << 20
+    MP_CONTEXT                  = "spawn" # Forking is unsafe with the pipeline's threads running
+    PARENT_TIMEOUT_FACTOR       = 2.0   # A queued file can look started while the one before it finishes
+    TIMEOUT_CHECK_SECS          = 1.0   # How often the parent looks for overdue files
+    MAX_POOL_BREAKS_PER_FILE    = 1     # Times a file is requeued after a worker died before it's retried alone
+
+    def __init__(self, 
+                 sourcePath: Path, 
+                 metadata: RAGMetadata, 
+                 recursiveLoad: bool        = True,
+                 numWorkers: int            = SEQUENTIAL,
+                 fileTimeoutSecs: float     = DEFAULT_FILE_TIMEOUT_SECS,
+                 minCharsPerPage: int       = DEFAULT_MIN_CHARS_PER_PAGE):
         super().__init__(metadata)
 
-        self.sourcePath     = sourcePath
-        self.recursiveLoad  = recursiveLoad
+        self.sourcePath         = sourcePath
+        self.recursiveLoad      = recursiveLoad
+        self.numWorkers         = numWorkers
+        self.fileTimeoutSecs    = fileTimeoutSecs
+        self.minCharsPerPage    = minCharsPerPage
+
+        self.failedFiles: Dict[str, str] = {} # Path to error
 
         # If the unique ID is not set create one from the filepath
         if metadata.id == "":
@@ -211,40 +337,284 @@ class LocalFilesSource(RAGSource):
         
         return newID
 
-    def _loadDir(self, dirPath) -> bool:
-        for entry in dirPath.iterdir():
+    # Only hashes the file if its mtime or size changed since the previous fingerprint
+    @staticmethod
+    def GetFingerprint(filepath: Path, previous: Optional[dict] = None) -> dict:
+        stat = filepath.stat()
+        if (previous is not None 
+            and previous.get("mtime") == stat.st_mtime 
+            and previous.get("size") == stat.st_size):
+            return previous
+
+        fileHash = hashlib.sha256()
+        with open(filepath, "rb") as f:
+            for block in iter(lambda: f.read(LocalFilesSource.HASH_BLOCK_SIZE), b""):
+                fileHash.update(block)
+
+        return {
+            "mtime":    stat.st_mtime,
+            "size":     stat.st_size,
+            "hash":     fileHash.hexdigest()
+        }
+
+    # The file's new fingerprint or None if its content is the same as in the baseline,
+    # in which case its previous record is kept.
+    def _getChangedFingerprint(self, filepath: Path, docID: str) -> Optional[dict]:
+        previous = self.baseline.get(docID, {}).get("fingerprint") or None
+        fingerprint = LocalFilesSource.GetFingerprint(filepath, previous)
+
+        if previous is not None and fingerprint["hash"] == previous.get("hash"):
+            self._keepPrevious(docID, fingerprint)
+            self.unchangedDocs.append(docID)
+            return None
+
+        return fingerprint
+
+    # Pages are counted up to the last one with text so blank scanned pages still count
+    @staticmethod
+    def GetCharsPerPage(docs: List[Document]) -> float:
+        numChars = sum(len(doc.page_content) for doc in docs)
+        numPages = max([doc.metadata.get(LocalFilesSource.PAGE_NUMBER_KEY) or 1 for doc in docs], default = 1)
+
+        return numChars / numPages
+
+    # Parse a whole file trying the fallback loader if there's too little text
+    @staticmethod
+    def ParseFile(filepath: Path, minCharsPerPage: int = DEFAULT_MIN_CHARS_PER_PAGE) -> List[Document]:
+        pattern = "*" + filepath.suffix
+        if not pattern in FILETYPE_LOADERS:
+            raise NotImplementedError(f"Unable to find loader for type '{filepath.suffix}'.")
+
+        docs = list(FILETYPE_LOADERS[pattern](filepath).lazy_load())
+        if pattern in FILETYPE_FALLBACK_LOADERS and LocalFilesSource.GetCharsPerPage(docs) < minCharsPerPage:
+            docs = list(FILETYPE_FALLBACK_LOADERS[pattern](filepath).lazy_load())
+
+        return docs
+
+    @staticmethod
+    def _OnFileTimeout(signum, frame):
+        raise TimeoutError("Timed out parsing file.")
+
+    # Runs in a worker process where the alarm can interrupt a parse that takes too long
+    @staticmethod
+    def _ParseFileInWorker(filepath: Path, minCharsPerPage: int, timeoutSecs: float) -> List[Document]:
+        useAlarm = timeoutSecs > 0 and hasattr(signal, "SIGALRM")
+        if useAlarm:
+            signal.signal(signal.SIGALRM, LocalFilesSource._OnFileTimeout)
+            signal.setitimer(signal.ITIMER_REAL, timeoutSecs)
+
+        try:
+            return LocalFilesSource.ParseFile(filepath, minCharsPerPage)
+        finally:
+            if useAlarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+
+    def _iterFile(self, filepath: Path) -> Iterator[Document]:
+        yield from LocalFilesSource.ParseFile(filepath, self.minCharsPerPage)
+
+    # Documents in the order files finish parsing
+    def __createPool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers  = self.numWorkers,
+                                   mp_context   = multiprocessing.get_context(LocalFilesSource.MP_CONTEXT))
+
+    def __submit(self, executor: ProcessPoolExecutor, filepath: Path) -> Future:
+        return executor.submit(LocalFilesSource._ParseFileInWorker, filepath, self.minCharsPerPage, self.fileTimeoutSecs)
+
+    # Stuck workers can't be shut down cleanly so they're killed along with the pool
+    @staticmethod
+    def _TerminatePool(executor: ProcessPoolExecutor):
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait = False, cancel_futures = True)
+
+    def __onFileFailed(self, filepath: Path, error: Exception):
+        self.failedFiles[str(filepath)] = repr(error)
+
+        # Keep what was indexed before rather than losing the file
+        docID = LocalFilesSource.GetIDFromPath(filepath)
+        if docID in self.baseline:
+            self._keepPrevious(docID)
+
+    # Files started longer ago than the parent's timeout. Also notes when files start
+    # running so those that may have killed a worker are known.
+    def __getOverdue(self, startTimes: Dict[Future, float], notDone: Iterable[Future]) -> List[Future]:
+        overdue: List[Future] = []
+        now = time.monotonic()
+        for future in notDone:
+            if future.running():
+                startTime = startTimes.setdefault(future, now)
+                if self.fileTimeoutSecs > 0 and now - startTime > self.fileTimeoutSecs * LocalFilesSource.PARENT_TIMEOUT_FACTOR:
+                    overdue.append(future)
+
+        return overdue
+
+    def _iterDocsParallel(self) -> Iterator[RAGDoc]:
+        executor = self.__createPool()
+        try:
+            filepaths = self.discover()
+            maxPending = self.numWorkers * LocalFilesSource.FILES_QUEUED_PER_WORKER
+            queued: List[Tuple[Path, dict]]             = [] # Discovered files waiting to be submitted
+            pending: Dict[Future, Tuple[Path, dict]]    = {}
+            startTimes: Dict[Future, float]             = {} # When the parent first saw each file running
+            suspects: List[Tuple[Path, dict]]           = [] # Files that may have killed a worker, retried alone
+            poolBreaks: Dict[Path, int]                 = {}
+            isolated: Optional[Future]                  = None
+            discovering = True
+
+            while discovering or len(queued) + len(pending) + len(suspects) > 0:
+                while discovering and len(queued) + len(pending) < maxPending:
+                    filepath = next(filepaths, None)
+                    if filepath is None:
+                        discovering = False
+                    else:
+                        filepath = filepath.resolve() # Make sure it's an absolute path
+                        fingerprint = self._getChangedFingerprint(filepath, LocalFilesSource.GetIDFromPath(filepath))
+                        if fingerprint is not None:
+                            queued.append((filepath, fingerprint))
+
+                brokenPool = False # A worker died
+                overdue: List[Future] = []
+                try:
+                    if len(suspects) > 0:
+                        if len(pending) == 0:
+                            isolated = self.__submit(executor, suspects[0][0])
+                            pending[isolated] = suspects.pop(0)
+                    else:
+                        while len(queued) > 0 and len(pending) < maxPending:
+                            pending[self.__submit(executor, queued[0][0])] = queued[0]
+                            queued.pop(0)
+                except BrokenProcessPool:
+                    brokenPool = True
+
+                if len(pending) > 0 and not brokenPool:
+                    done, notDone = wait(pending, timeout = LocalFilesSource.TIMEOUT_CHECK_SECS, return_when = FIRST_COMPLETED)
+                    for future in done:
+                        # Left pending to be retried with the rest
+                        if isinstance(future.exception(), BrokenProcessPool):
+                            brokenPool = True
+                            continue
+
+                        filepath, fingerprint = pending.pop(future)
+                        startTimes.pop(future, None)
+                        try:
+                            docs = future.result()
+                        except Exception as e:
+                            self.__onFileFailed(filepath, e)
+                            continue
+
+                        doc = RAGDoc(
+                            rawDoc      = iter(docs),
+                            source      = str(filepath),
+                            id          = LocalFilesSource.GetIDFromPath(filepath),
+                            fragmentsID = [],
+                            fingerprint = fingerprint
+                        )
+                        self._add(doc)
+                        yield doc
+
+                    if not brokenPool:
+                        overdue = self.__getOverdue(startTimes, notDone)
+                    for future in overdue:
+                        filepath, _ = pending.pop(future)
+                        self.__onFileFailed(filepath, TimeoutError("Timed out parsing file, worker didn't respond."))
+
+                    # Stuck workers are killed so the rest are parsed again in a new pool
+                    if len(overdue) > 0:
+                        queued = list(pending.values()) + queued
+
+                if brokenPool:
+                    # A worker died. Files that weren't running are parsed again in a new pool,
+                    # ones that might have been are retried alone unless they already were.
+                    requeued: List[Tuple[Path, dict]] = []
+                    for future, (filepath, fingerprint) in pending.items():
+                        if future is isolated:
+                            self.__onFileFailed(filepath, BrokenProcessPool("Worker died parsing file."))
+                        elif future in startTimes or poolBreaks.get(filepath, 0) >= LocalFilesSource.MAX_POOL_BREAKS_PER_FILE:
+                            suspects.append((filepath, fingerprint))
+                        else:
+                            poolBreaks[filepath] = poolBreaks.get(filepath, 0) + 1
+                            requeued.append((filepath, fingerprint))
+                    queued = requeued + queued
+
+                if brokenPool or len(overdue) > 0:
+                    LocalFilesSource._TerminatePool(executor)
+                    executor = self.__createPool()
+                    pending     = {}
+                    startTimes  = {}
+                    isolated    = None
+        finally:
+            executor.shutdown(wait = False, cancel_futures = True)
+
+    # Supported files under a directory, found as the walk proceeds rather than up front
+    def _walkDir(self, dirPath: Path) -> Iterator[Path]:
+        for entry in sorted(dirPath.iterdir()):
             if entry.is_dir() and self.recursiveLoad:
-                self._loadDir(entry)
+                yield from self._walkDir(entry)
             elif entry.is_file():
                 # Is this format supported
                 pattern = "*" + entry.suffix
                 if pattern in FILETYPE_LOADERS:
-                    self._loadFile(entry)
+                    yield entry
+
+    def discover(self) -> Iterator[Path]:
+        if self.sourcePath.is_dir():
+            yield from self._walkDir(self.sourcePath)
+        elif self.sourcePath.is_file():
+            yield self.sourcePath
+        else:
+            raise NotImplementedError(f"'{self.sourcePath}' is neither a directory or file")
+
+    # Files are discovered and their loaders created one at a time unless already loaded.
+    # Files unchanged since the baseline are skipped.
+    def iterDocs(self) -> Iterator[RAGDoc]:
+        if len(self.docs) > 0:
+            yield from super().iterDocs()
+        elif self.numWorkers > LocalFilesSource.SEQUENTIAL:
+            yield from self._iterDocsParallel()
+        else:
+            for filepath in self.discover():
+                filepath = filepath.resolve()
+                fingerprint = self._getChangedFingerprint(filepath, LocalFilesSource.GetIDFromPath(filepath))
+                if fingerprint is not None:
+                    doc = self._createDoc(filepath, fingerprint)
+                    self._add(doc)
+                    yield doc
+
+    def _loadDir(self, dirPath) -> bool:
+        for filepath in self._walkDir(dirPath):
+            self._loadFile(filepath)
         
-        return not self.docs is not None
+        return self.docs is not None
 
-    def _loadFile(self, filepath: Path) -> bool:
+    # Loader is lazy so nothing is read until the document is iterated
+    def _createDoc(self, filepath: Path, fingerprint: Optional[dict] = None) -> RAGDoc:
         filepath = filepath.resolve() # Make sure it's an absolute path
         
         pattern = "*" + filepath.suffix # Look for a loader like *.pdf or *.txt
         if pattern in FILETYPE_LOADERS:
-            loaderCls = FILETYPE_LOADERS[pattern]
-            loader = loaderCls(filepath)
-            self._add(RAGDoc(
-                rawDoc      = loader.lazy_load(),
+            return RAGDoc(
+                rawDoc      = self._iterFile(filepath),
                 source      = str(filepath),
                 id          = LocalFilesSource.GetIDFromPath(filepath), # Assume path is absolute and unique
-                fragmentsID = [] # No children as yet
-            ))
+                fragmentsID = [], # No children as yet
+                fingerprint = fingerprint if fingerprint is not None else LocalFilesSource.GetFingerprint(filepath)
+            )
         else:
             raise NotImplementedError(f"Unable to find loader for type '{filepath.suffix}'.")
 
+    def _loadFile(self, filepath: Path) -> bool:
+        self._add(self._createDoc(filepath))
+
         return self.docs is not None
 
     def load(self):
         success = False
 
-        if self.sourcePath.is_dir():
+        if self.numWorkers > LocalFilesSource.SEQUENTIAL:
+            for _ in self._iterDocsParallel():
+                pass
+            success = self.docs is not None
+        elif self.sourcePath.is_dir():
             success = self._loadDir(self.sourcePath)
         elif self.sourcePath.is_file():
             success = self._loadFile(self.sourcePath)
@@ -0,0 +1,136 @@
+import statistics
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses        import dataclass
+from pathlib            import Path
+from typing             import List, Optional
+
+from core               import logs
+from my_secrets         import secrets_mgr
+
+from llm.src.llm_define         import LLMInfo, LLMMessage
+from llm.src.llm_mock_server    import MockLLMParams, MockLLMServer
+from llm.src.llm_model          import LLMModel
+from llm.src.llm_ollama         import OllamaModel
+from llm.src.llm_openai         import OpenAIModel
+from llm.src.llm_tokenizer      import TokenizerRegistry
+
+# Drives the real clients against a local mock server so numbers don't depend on a
+# live model. Client overhead is the time spent beyond what the server is known to
+# take for the same number of tokens.
+
+# Ollama's tokenizer for gemma3 is gated on Hugging Face so count with tiktoken's
+# fallback encoding instead. Keeps the benchmark free of downloads and tokens.
+class BenchmarkOllamaModel(OllamaModel):
+    def _countTokensBatch(self, contents: List[str]) -> List[int]:
+        encoding = TokenizerRegistry.GetTiktokenEncoding(self.info.name)
+        return [len(tokens) for tokens in encoding.encode_ordinary_batch(contents)]
+
+@dataclass
+class BenchmarkSample:
+    ttftSecs:       float               = 0.0
+    elapsedSecs:    float               = 0.0
+    numTokens:      int                 = 0
+    error:          Optional[Exception] = None
+
+def fnCreateSecrets(server: MockLLMServer, envDir: Path) -> secrets_mgr.SecretsMgr:
+    envFilepath = envDir / ".env"
+    with open(envFilepath, "w") as envFile:
+        envFile.write(f"OLLAMA_API_HOST={server.getURL().rsplit(':', 1)[0]}\n")
+        envFile.write(f"OLLAMA_API_PORT={server.port}\n")
+        envFile.write("OLLAMA_API_KEY=\n")
+        envFile.write("HUGGING_FACE_TOKEN=\n") # Only the tiktoken fallback is used
+        envFile.write("OPENAI_API_KEY=mock\n")
+
+    secretsMgr = secrets_mgr.SecretsMgr("benchmark")
+    if not secretsMgr.loadFromEnv(envFilepath):
+        raise Exception("Unable to load benchmark secrets.")
+
+    return secretsMgr
+
+# Mock server streams one token per delta
+def fnStreamOnce(model: LLMModel, messages: List[LLMMessage]) -> BenchmarkSample:
+    sample = BenchmarkSample()
+    start = time.perf_counter()
+
+    try:
+        for delta in model.chatStream(messages):
+            if delta.content != "":
+                if sample.numTokens == 0:
+                    sample.ttftSecs = time.perf_counter() - start
+                sample.numTokens += 1
+    except Exception as e:
+        sample.error = e
+
+    sample.elapsedSecs = time.perf_counter() - start
+    return sample
+
+def fnRunBenchmark(model: LLMModel, messages: List[LLMMessage], numRequests: int, concurrency: int) -> List[BenchmarkSample]:
+    # Warm up so tokenizer loads and connection setup aren't counted
+    fnStreamOnce(model, messages)
+
+    with ThreadPoolExecutor(max_workers = concurrency) as executor:
+        return list(executor.map(lambda _: fnStreamOnce(model, messages), range(numRequests)))
+
+def fnPercentile(values: List[float], percent: int) -> float:
+    return statistics.quantiles(values, n = 100)[percent - 1] if len(values) > 1 else (values[0] if values else 0.0)
+
+def fnPrintReport(name: str, samples: List[BenchmarkSample], params: MockLLMParams, wallSecs: float):
+    succeeded = [sample for sample in samples if sample.error is None]
+    ttfts     = [sample.ttftSecs * 1000 for sample in succeeded]
+    rates     = [sample.numTokens / (sample.elapsedSecs - sample.ttftSecs)
+                 for sample in succeeded if sample.elapsedSecs > sample.ttftSecs]
+    overheads = [(sample.elapsedSecs - params.getExpectedDurationSecs(sample.numTokens)) * 1000 for sample in succeeded]
+
+    print(f"Info: {name}: {len(succeeded)}/{len(samples)} succeeded in {wallSecs:.2f}s, " +
+          f"{sum(sample.numTokens for sample in succeeded) / wallSecs:.1f} tokens/s overall")
+    if len(succeeded) > 0:
+        print(f"Info:   TTFT ms              p50 {fnPercentile(ttfts, 50):8.2f}   p95 {fnPercentile(ttfts, 95):8.2f}")
+        print(f"Info:   Tokens/s per request p50 {fnPercentile(rates, 50):8.2f}   p5  {fnPercentile(rates, 5):8.2f} (slowest)")
+        print(f"Info:   Client overhead ms   p50 {fnPercentile(overheads, 50):8.2f}   p95 {fnPercentile(overheads, 95):8.2f}")
+    for sample in samples:
+        if sample.error is not None:
+            print(f"Info:   Error: {sample.error}")
+            break
+
+def fnBenchmarkLLMModels(numRequests: int = 32,
+                         concurrency: int = 4,
+                         params: MockLLMParams = MockLLMParams(tokensPerSec = 200, firstTokenLatencySecs = 0.05, responseTokens = 128)):
+    logger = logs.ConfigureConsoleOnlyLogging("LLMBenchmarkLogger").getSysLogger()
+    server = MockLLMServer(params)
+    if not server.start():
+        print("Error: unable to start mock LLM server")
+        return
+
+    try:
+        messages = [LLMMessage("system", "You are a helpful assistant."),
+                    LLMMessage("user", "Write a short story about a lighthouse keeper.")]
+
+        with tempfile.TemporaryDirectory() as envDir:
+            secretsMgr = fnCreateSecrets(server, Path(envDir))
+
+            defaults = { info.name: info for info in LLMInfo.GetDefaultsLLMInfo() }
+            models: List[tuple] = [
+                ("Ollama", BenchmarkOllamaModel(defaults["gemma3"], logger, "")),
+                ("OpenAI", OpenAIModel(defaults["gpt-oss"], logger, baseURL = f"{server.getURL()}/v1"))
+            ]
+
+            for name, model in models:
+                if not model.connectToClient(secretsMgr):
+                    print(f"Error: unable to connect {name} model to mock server")
+                    continue
+
+                start = time.perf_counter()
+                samples = fnRunBenchmark(model, messages, numRequests, concurrency)
+                fnPrintReport(name, samples, params, time.perf_counter() - start)
+    finally:
+        server.stop()
+
+# Main Function: run benchmarks
+def main():
+    fnBenchmarkLLMModels()
+
+if __name__=="__main__":
+    main()
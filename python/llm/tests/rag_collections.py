@@ -0,0 +1,87 @@
+import tempfile
+
+from langchain_core.documents   import Document
+from langchain_core.embeddings  import DeterministicFakeEmbedding
+from pathlib                    import Path
+from typing                     import Dict, List
+
+from llm.src.rag.collections    import RAGCollection
+from llm.src.rag.meta           import RAGMetadata
+from llm.src.rag.sources        import RAGDoc, RAGSource
+
+# Source held in memory so the test doesn't depend on which file loaders are enabled
+class MemorySource(RAGSource):
+    def __init__(self, metadata: RAGMetadata, pages: Dict[str, List[str]]):
+        super().__init__(metadata)
+        self.pages = pages
+
+    def load(self) -> bool:
+        for docID, texts in self.pages.items():
+            self.docs[docID] = RAGDoc(
+                rawDoc      = iter([Document(page_content = text, metadata = {"page": i}) for i, text in enumerate(texts)]),
+                source      = docID,
+                id          = docID,
+                fragmentsID = []
+            )
+
+        return True
+
+def fnCreateSource(id: str, numDocs: int) -> MemorySource:
+    pages = { f"{id}.doc{i}": [f"Page {j} of document {i} in source {id}." for j in range(2)] for i in range(numDocs) }
+    source = MemorySource(RAGMetadata(name = id.upper(), id = id), pages)
+    source.load()
+
+    return source
+
+# Two sources created without an explicit TOC must each keep their own, otherwise
+# syncing one removes the other's documents.
+def fnTestTwoSourcesUpdateDelete() -> bool:
+    success = False
+
+    try:
+        with tempfile.TemporaryDirectory() as tempDir:
+            collection = RAGCollection(Path(tempDir), RAGMetadata(name = "Test", id = "test"), DeterministicFakeEmbedding(size = 16))
+            collection.persist()
+
+            sourceA = fnCreateSource("a", 3)
+            sourceB = fnCreateSource("b", 2)
+            success = sourceA.metadata.toc is not sourceB.metadata.toc
+
+            collection.updateSource(sourceA)
+            collection.updateSource(sourceB)
+            success = success and len(collection.lastSyncReport.removedDocs) == 0
+            success = success and len(collection.sourcesMetadata["a"].toc) == 3 and len(collection.sourcesMetadata["b"].toc) == 2
+            success = success and collection.count() == 10
+
+            # Re-syncing a source with the same content writes and removes nothing
+            collection.updateSource(fnCreateSource("a", 3))
+            report = collection.lastSyncReport
+            success = (success and len(report.removedDocs) == 0
+                       and report.numFragmentsUpserted == 0 and report.numFragmentsDeleted == 0)
+
+            # Deleting one source keeps all of the other's fragments
+            fragmentsB = RAGSource.GetTOCFragmentsID(collection.sourcesMetadata["b"].toc)
+            collection.delSource("a")
+            remaining = collection.dbStore.get(ids = list(fragmentsB))["ids"]
+            success = (success and collection.count() == len(fragmentsB) == 4
+                       and set(remaining) == fragmentsB and len(collection.sourcesMetadata["b"].toc) == 2)
+
+    except Exception as e:
+        print()
+        print("Error: encountered exception while running RAGCollection tests")
+        print(e)
+        success = False
+
+    return success
+
+def fnTestRAGCollections():
+    if fnTestTwoSourcesUpdateDelete():
+        print("Info: two sources update/delete test passed")
+    else:
+        print("Error: two sources update/delete test failed")
+
+def main():
+    fnTestRAGCollections()
+
+if __name__=="__main__":
+    main()
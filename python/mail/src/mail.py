@@ -39,12 +39,10 @@ class Mail:
 
     def isValid(self) -> bool:
         # From, to must be valid and there must be a subject and body.
-        return (validators.Validator.IsValidEmailList(self.From, False) 
-                and validators.Validator.IsValidEmailList(self.to, False)
-                and validators.Validator.IsValidEmailList(self.cc, True)
-                and validators.Validator.IsValidEmailList(self.bcc, True)
-                and validators.Validator.IsValidEmailList(self.replyTo, True)
-                and self.subject != "" and (self.bodyText != "" or self.bodyHTML != ""))
+        # Cheap checks first so the address lists are only validated when needed.
+        return (self.subject != "" and (self.bodyText != "" or self.bodyHTML != "")
+                and all(validators.Validator.ValidateEmailLists([self.From, self.to], False))
+                and all(validators.Validator.ValidateEmailLists([self.cc, self.bcc, self.replyTo], True)))
 
 # TODO: generalize in the future to abstract IMAP specific implementation
 class MailFilter:
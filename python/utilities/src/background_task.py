@@ -1,8 +1,17 @@
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import random
 import time
 
-from abc            import ABC, abstractmethod
-from threading      import Event, Lock, Thread
-from typing         import Generic, Optional, TypeVar
+from abc                import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib         import suppress
+from dataclasses        import dataclass
+from enum               import Enum
+from threading          import Condition, Event, Lock, Thread
+from typing             import Generic, List, Optional, Tuple, TypeVar
 
 class BackgroundTask(ABC):
     # Override this method to do some work in subclass.
@@ -17,6 +26,21 @@ class BackgroundTask(ABC):
 
 T = TypeVar('T', bound=BackgroundTask)
 
+# Coroutine flavour of BackgroundTask for work that should run on an
+# event loop, e.g. async persistence or health checks in a service.
+class AsyncBackgroundTask(ABC):
+    # Override this coroutine to do some work in subclass.
+    @abstractmethod
+    async def doTask(self):
+        pass
+
+    # Override this method to handle unexpected exceptions.
+    @abstractmethod
+    def onTaskException(self, exception: Exception):
+        pass
+
+AT = TypeVar('AT', bound=AsyncBackgroundTask)
+
 # A simple class for running background tasks on an interval. 
 # By default it runs as a daemon so calling code must
 # stop it explicitly.
@@ -28,20 +52,24 @@ class BackgroundRunner(Generic[T]):
                  runIntervalSecs: int   = DEFAULT_RUN_INTERVAL,
                  runTaskOnStop: bool    = True,
                  threadName: str        = "",
-                 runAsDaemon: bool      = True):                        
+                 runAsDaemon: bool      = True,
+                 scheduler: Optional["BackgroundScheduler"] = None):                        
         
-        # Thread created and started in start function
+        # Thread created and started in start function unless a shared
+        # scheduler is passed in, in which case the task is registered with it.
         self.__task             = task
         self.__runIntervalSecs  = runIntervalSecs
         self.__runTaskOnStop    = runTaskOnStop
         self.__threadName       = threadName
         self.__runAsDaemon      = runAsDaemon
+        self.__scheduler        = scheduler
 
         if self.__threadName == "":
             taskCls = type(task)
             self.__threadName = f"{taskCls.__qualname__}_Thread"
 
-        self.__thread: Optional[Thread] = None
+        self.__thread: Optional[Thread]         = None
+        self.__scheduled: Optional[ScheduledTask] = None
         self.__lock         = Lock()
         self.__stopEvent    = Event()
 
@@ -49,7 +77,7 @@ class BackgroundRunner(Generic[T]):
         self.stop()
 
     def __isRunning(self) -> bool:
-        return self.__thread is not None
+        return self.__thread is not None or self.__scheduled is not None
     
     def isRunning(self) -> bool:
         with self.__lock:
@@ -59,7 +87,12 @@ class BackgroundRunner(Generic[T]):
         success = False
 
         with self.__lock:
-            if not self.__isRunning():
+            if not self.__isRunning() and self.__scheduler is not None:
+                self.__scheduled = self.__scheduler.schedule(self.__task, 
+                                                             self.__runIntervalSecs, 
+                                                             name = self.__threadName)
+                success = True
+            elif not self.__isRunning():
                 self.__thread = Thread(name = self.__threadName, target = self.__doRun, daemon = self.__runAsDaemon) 
                 if self.__thread is not None:
                     self.__stopEvent.clear()
@@ -79,12 +112,21 @@ class BackgroundRunner(Generic[T]):
                     success = not self.__thread.is_alive()
                     del self.__thread
                     self.__thread = None
+                elif self.__scheduled is not None and self.__scheduler is not None:
+                    # Wait for an in-flight run to complete before running one last time
+                    success = self.__scheduler.cancel(self.__scheduled, wait = True, timeout = timeout)
+                    self.__scheduled = None
 
                 # Run one last time in case stopped between cycles
                 if self.__runTaskOnStop:
                     self.__task.doTask()
 
         return success
+
+    # Only available when registered with a scheduler
+    def getMetrics(self) -> Optional["TaskMetrics"]:
+        with self.__lock:
+            return self.__scheduled.metrics if self.__scheduled is not None else None
                 
     def __doRun(self):
         while not self.__stopEvent.is_set():
@@ -100,7 +142,394 @@ class BackgroundRunner(Generic[T]):
             if remainingTime < self.__runIntervalSecs:
                 self.__stopEvent.wait(self.__runIntervalSecs - remainingTime)
 
+class ScheduleMode(Enum):
+    FixedRate   = "fixed_rate"  # Runs are anchored to a fixed cadence regardless of how long each takes
+    FixedDelay  = "fixed_delay" # Wait the full interval after the previous run completes
+
+# What to do when a run comes due while the previous one is still in flight.
+class OverrunPolicy(Enum):
+    Skip        = "skip"        # Drop the run and wait for the next slot
+    Coalesce    = "coalesce"    # Run once as soon as the current run completes
+    Concurrent  = "concurrent"  # Allow overlapping runs on separate workers
+
+@dataclass
+class TaskMetrics:
+    runs:               int     = 0
+    failures:           int     = 0
+    overruns:           int     = 0
+    lastDurationSecs:   float   = 0.0
+    maxDurationSecs:    float   = 0.0
+    totalDurationSecs:  float   = 0.0
+
+    @property
+    def avgDurationSecs(self) -> float:
+        return self.totalDurationSecs / self.runs if self.runs > 0 else 0.0
+
+# Handle returned when a task is registered with the scheduler.
+# State is guarded by the scheduler's lock.
+class ScheduledTask:
+    def __init__(self, 
+                 task: BackgroundTask, 
+                 intervalSecs: float, 
+                 mode: ScheduleMode, 
+                 jitterSecs: float, 
+                 overrunPolicy: OverrunPolicy, 
+                 name: str):
+        
+        self.task           = task
+        self.intervalSecs   = intervalSecs
+        self.mode           = mode
+        self.jitterSecs     = jitterSecs
+        self.overrunPolicy  = overrunPolicy
+        self.name           = name if name != "" else type(task).__qualname__
+
+        self.metrics        = TaskMetrics()
+        self.isCanceled     = False
+        self.activeRuns     = 0
+        self.pendingRun     = False
+        self.anchorTime     = 0.0   # Un-jittered due time of the last slot for fixed rate
+
+        # Set whenever no run is in flight so callers can wait on cancel
+        self.idle           = Event()
+        self.idle.set()
+
+# Runs many periodic tasks on a bounded pool of workers instead of
+# dedicating a sleeping thread to each one. A single dispatcher thread
+# pops due tasks off a heap ordered by due time and hands them to the pool.
+class BackgroundScheduler:
+    DEFAULT_MAX_WORKERS = 4
+
+    __shared: Optional["BackgroundScheduler"]   = None
+    __sharedLock                                = Lock()
+
+    def __init__(self, 
+                 maxWorkers: int    = DEFAULT_MAX_WORKERS, 
+                 threadName: str    = "BackgroundScheduler_Thread", 
+                 runAsDaemon: bool  = True):
+        
+        if maxWorkers <= 0:
+            raise ValueError("Scheduler needs at least one worker.")
+
+        self.__maxWorkers   = maxWorkers
+        self.__threadName   = threadName
+        self.__runAsDaemon  = runAsDaemon
+
+        self.__heap: List[Tuple[float, int, ScheduledTask]] = []
+        self.__seq          = itertools.count() # Tie-breaker so entries never get compared
+        self.__cond         = Condition()
+        self.__isStopping   = False
+
+        self.__thread: Optional[Thread]                 = None
+        self.__executor: Optional[ThreadPoolExecutor]   = None
+
+    def __del__(self):
+        self.stop()
+
+    # Process-wide scheduler shared by modules that only need light periodic work.
+    @staticmethod
+    def GetShared() -> "BackgroundScheduler":
+        with BackgroundScheduler.__sharedLock:
+            if BackgroundScheduler.__shared is None:
+                BackgroundScheduler.__shared = BackgroundScheduler()
+                BackgroundScheduler.__shared.start()
+
+            return BackgroundScheduler.__shared
+
+    def isRunning(self) -> bool:
+        with self.__cond:
+            return self.__thread is not None
+
+    def start(self) -> bool:
+        success = False
+
+        with self.__cond:
+            if self.__thread is None:
+                self.__isStopping = False
+                self.__executor = ThreadPoolExecutor(max_workers = self.__maxWorkers, 
+                                                     thread_name_prefix = f"{self.__threadName}_Worker")
+                self.__thread = Thread(name = self.__threadName, target = self.__doRun, daemon = self.__runAsDaemon)
+                self.__thread.start()
+                success = True
+
+        return success
+
+    def stop(self, timeout: float | None = None) -> bool:
+        success = False
+
+        with self.__cond:
+            thread          = self.__thread
+            executor        = self.__executor
+            self.__thread   = None
+            self.__executor = None
+            self.__isStopping = True
+            self.__cond.notify_all()
+
+        if thread is not None:
+            thread.join(timeout)
+            success = not thread.is_alive()
+        if executor is not None:
+            # Let in-flight runs finish but drop anything not yet started.
+            # Dropped runs are accounted for in __onRunDone.
+            executor.shutdown(wait = True, cancel_futures = True)
+
+        return success
+
+    def schedule(self, 
+                 task: BackgroundTask, 
+                 intervalSecs: float, 
+                 mode: ScheduleMode             = ScheduleMode.FixedRate,
+                 jitterSecs: float              = 0.0,
+                 overrunPolicy: OverrunPolicy   = OverrunPolicy.Skip,
+                 initialDelaySecs: float        = 0.0,
+                 name: str                      = "") -> ScheduledTask:
+        
+        if intervalSecs <= 0:
+            raise ValueError(f"Interval for task {name} must be greater than 0.")
+        if jitterSecs < 0 or initialDelaySecs < 0:
+            raise ValueError(f"Jitter and initial delay for task {name} can't be negative.")
+
+        entry = ScheduledTask(task, intervalSecs, mode, jitterSecs, overrunPolicy, name)
+        with self.__cond:
+            entry.anchorTime = time.monotonic() + initialDelaySecs
+            self.__push(entry, entry.anchorTime)
+
+        return entry
+
+    # Canceled entries are dropped lazily when they reach the top of the heap.
+    def cancel(self, entry: ScheduledTask, wait: bool = False, timeout: float | None = None) -> bool:
+        with self.__cond:
+            entry.isCanceled = True
+            entry.pendingRun = False
+            self.__cond.notify_all()
+
+            # Nothing is dispatched once stopped and stop waits for in-flight runs itself
+            if self.__isStopping:
+                return True
+
+        return entry.idle.wait(timeout) if wait else True
+
+    def __push(self, entry: ScheduledTask, dueTime: float):
+        if entry.jitterSecs > 0:
+            dueTime += random.uniform(0, entry.jitterSecs)
+        heapq.heappush(self.__heap, (dueTime, next(self.__seq), entry))
+        self.__cond.notify()
+
+    # Next slot on the fixed cadence, skipping any that were missed entirely.
+    def __pushNextSlot(self, entry: ScheduledTask, now: float):
+        entry.anchorTime += entry.intervalSecs
+        if entry.anchorTime <= now:
+            missed = int((now - entry.anchorTime) / entry.intervalSecs) + 1
+            entry.anchorTime += missed * entry.intervalSecs
+        self.__push(entry, entry.anchorTime)
+
+    def __doRun(self):
+        with self.__cond:
+            while not self.__isStopping:
+                if len(self.__heap) == 0:
+                    self.__cond.wait()
+                    continue
+
+                dueTime, _, entry = self.__heap[0]
+                now = time.monotonic()
+                if dueTime > now:
+                    self.__cond.wait(dueTime - now)
+                    continue
+
+                heapq.heappop(self.__heap)
+                if not entry.isCanceled:
+                    self.__dispatch(entry, now)
+
+    # Called with the lock held
+    def __dispatch(self, entry: ScheduledTask, now: float):
+        isOverrun = entry.activeRuns > 0 and entry.overrunPolicy != OverrunPolicy.Concurrent
+
+        # Fixed delay tasks get rescheduled once the run completes
+        if entry.mode == ScheduleMode.FixedRate:
+            self.__pushNextSlot(entry, now)
+
+        if isOverrun:
+            entry.metrics.overruns += 1
+            if entry.overrunPolicy == OverrunPolicy.Coalesce:
+                entry.pendingRun = True
+        elif self.__executor is not None:
+            entry.activeRuns += 1
+            entry.idle.clear()
+            future = self.__executor.submit(self.__runTask, entry)
+            future.add_done_callback(lambda future: self.__onRunDone(entry, future))
+
+    # Runs dropped by stop never reach __runTask so undo their dispatch here
+    def __onRunDone(self, entry: ScheduledTask, future: concurrent.futures.Future):
+        if future.cancelled():
+            with self.__cond:
+                entry.activeRuns -= 1
+                if entry.activeRuns == 0:
+                    entry.idle.set()
+
+    def __runTask(self, entry: ScheduledTask):
+        failed = False
+        startTime = time.monotonic()
+        try:
+            entry.task.doTask()
+        except Exception as e:
+            failed = True
+            entry.task.onTaskException(e)
+        finally:
+            endTime = time.monotonic()
+            duration = endTime - startTime
+
+            with self.__cond:
+                metrics = entry.metrics
+                metrics.runs += 1
+                metrics.failures += 1 if failed else 0
+                metrics.lastDurationSecs = duration
+                metrics.maxDurationSecs = max(metrics.maxDurationSecs, duration)
+                metrics.totalDurationSecs += duration
+
+                entry.activeRuns -= 1
+                if not entry.isCanceled and not self.__isStopping:
+                    if entry.mode == ScheduleMode.FixedDelay:
+                        self.__push(entry, endTime + entry.intervalSecs)
+                    elif entry.pendingRun:
+                        entry.pendingRun = False
+                        self.__push(entry, endTime)
+
+                if entry.activeRuns == 0:
+                    entry.idle.set()
+
+# Runs a coroutine task on an interval on a given event loop rather than
+# on a dedicated thread. Consecutive failures back off exponentially up
+# to maxBackoffSecs. Stopping lets an in-flight run drain before cancelling.
+class AsyncBackgroundRunner(Generic[AT]):
+    DEFAULT_RUN_INTERVAL        = 60
+    DEFAULT_MAX_BACKOFF_SECS    = 15 * 60
+    DEFAULT_DRAIN_TIMEOUT_SECS  = 30
+    MAX_BACKOFF_EXPONENT        = 16    # Avoid overflow on long failure streaks
+
+    def __init__(self,
+                 task: AT,
+                 runIntervalSecs: float                         = DEFAULT_RUN_INTERVAL,
+                 runTaskOnStop: bool                            = True,
+                 taskName: str                                  = "",
+                 loop: Optional[asyncio.AbstractEventLoop]      = None,
+                 maxBackoffSecs: float                          = DEFAULT_MAX_BACKOFF_SECS):
+        
+        if runIntervalSecs <= 0:
+            raise ValueError("Run interval must be greater than 0.")
+
+        self.__task             = task
+        self.__runIntervalSecs  = runIntervalSecs
+        self.__runTaskOnStop    = runTaskOnStop
+        self.__taskName         = taskName
+        self.__loop             = loop
+        self.__maxBackoffSecs   = max(maxBackoffSecs, runIntervalSecs)
+
+        if self.__taskName == "":
+            taskCls = type(task)
+            self.__taskName = f"{taskCls.__qualname__}_AsyncTask"
+
+        # Either an asyncio task if started on the loop or a concurrent future if started from another thread
+        self.__future: Optional[asyncio.Future | concurrent.futures.Future] = None
+        self.__stopEvent: Optional[asyncio.Event]   = None
+        self.__lock                                 = Lock()
+        self.__consecutiveFailures                  = 0
+
+    @property
+    def consecutiveFailures(self) -> int:
+        return self.__consecutiveFailures
+
+    def isRunning(self) -> bool:
+        with self.__lock:
+            return self.__future is not None
+
+    # Can be called from the loop itself or from any other thread. If no loop
+    # was given at construction the currently running loop is used.
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> bool:
+        success = False
+
+        with self.__lock:
+            if self.__future is None:
+                if loop is not None:
+                    self.__loop = loop
+                elif self.__loop is None:
+                    self.__loop = asyncio.get_running_loop()
+
+                currentLoop: Optional[asyncio.AbstractEventLoop] = None
+                with suppress(RuntimeError):
+                    currentLoop = asyncio.get_running_loop()
+
+                self.__stopEvent = asyncio.Event()
+                if currentLoop is self.__loop:
+                    self.__future = self.__loop.create_task(self.__doRun(), name = self.__taskName)
+                else:
+                    self.__future = asyncio.run_coroutine_threadsafe(self.__doRun(), self.__loop)
+                success = True
+
+        return success
+
+    # Must be awaited on the runner's loop.
+    async def stop(self, timeout: float | None = DEFAULT_DRAIN_TIMEOUT_SECS) -> bool:
+        success = False
+
+        with self.__lock:
+            future          = self.__future
+            stopEvent       = self.__stopEvent
+            self.__future   = None
+
+        if future is not None and stopEvent is not None:
+            stopEvent.set()
+
+            waitable = asyncio.wrap_future(future) if isinstance(future, concurrent.futures.Future) else future
+            try:
+                # Shield so a timeout doesn't cancel the run before we decide to
+                await asyncio.wait_for(asyncio.shield(waitable), timeout)
+                success = True
+            except asyncio.TimeoutError:
+                waitable.cancel()
+                with suppress(asyncio.CancelledError):
+                    await waitable
+
+            # Run one last time in case stopped between cycles
+            if self.__runTaskOnStop:
+                try:
+                    await self.__task.doTask()
+                except Exception as e:
+                    self.__task.onTaskException(e)
+
+        return success
     
+    # Blocking stop for callers that are not on the runner's loop.
+    def stopFromThread(self, timeout: float | None = DEFAULT_DRAIN_TIMEOUT_SECS) -> bool:
+        success = False
+
+        if self.__loop is not None and self.__loop.is_running():
+            success = asyncio.run_coroutine_threadsafe(self.stop(timeout), self.__loop).result()
+
+        return success
 
+    def __getWaitSecs(self) -> float:
+        waitSecs = self.__runIntervalSecs
+        if self.__consecutiveFailures > 0:
+            exponent = min(self.__consecutiveFailures, AsyncBackgroundRunner.MAX_BACKOFF_EXPONENT)
+            waitSecs = min(self.__maxBackoffSecs, self.__runIntervalSecs * (2 ** exponent))
+
+        return waitSecs
+
+    async def __doRun(self):
+        loop = asyncio.get_running_loop()
+        stopEvent = self.__stopEvent
+        if stopEvent is None:
+            raise RuntimeError(f"{self.__taskName} started without a stop event.")
+
+        while not stopEvent.is_set():
+            startTime = loop.time()
+            try:
+                await self.__task.doTask()
+                self.__consecutiveFailures = 0
+            except Exception as e:
+                self.__consecutiveFailures += 1
+                self.__task.onTaskException(e)
 
- 
\ No newline at end of file
+            remainingTime = self.__getWaitSecs() - (loop.time() - startTime)
+            if remainingTime > 0:
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(stopEvent.wait(), remainingTime)
@@ -1,15 +1,27 @@
 import math
+import multiprocessing
 import sys
 import time
 
-from ipywidgets         import FloatProgress, Label, HBox
+from threading          import Lock
+from typing             import List
+
+from ipywidgets         import FloatProgress, Label, HBox, VBox
 from IPython.display    import display
 
 # This package
+from .background_task   import BackgroundRunner, BackgroundTask
 from .filters           import MovingAverage
 
 class ProgressTracker:
-    def __init__(self, minVal = 0, maxVal = 100, description = "Progress"):
+    DEFAULT_REFRESH_RATE_HZ = 10    # Rendering more often than this isn't perceptible
+    UNTHROTTLED             = 0     # Render on every update
+    DEFAULT_BATCH_SIZE      = 1     # Check whether to render on every increment
+
+    def __init__(self, minVal = 0, maxVal = 100, description = "Progress", 
+                 refreshRateHz = DEFAULT_REFRESH_RATE_HZ, batchSize = DEFAULT_BATCH_SIZE):
+        self.set_refresh_rate(refreshRateHz)
+        self.set_batch_size(batchSize)
         self.set_description(description)
         self.set_range(minVal, maxVal)
         self.reset()
@@ -22,10 +34,24 @@ class ProgressTracker:
         self.maxVal      = maxVal
         if self.maxVal <= self.minVal:
             raise Exception(f"Invalid ProgressTracker range: {self.minVal} - {self.maxVal}")
+
+        # Precompute tolerances checked on every increment
+        self.lowerBound     = self.minVal - sys.float_info.epsilon
+        self.upperBound     = self.maxVal + sys.float_info.epsilon
+        self.completeBound  = self.maxVal - sys.float_info.epsilon
         self.reset()
 
     def set_description(self, description):
         self.description = description
+
+    # Limit how often the bar is redrawn and the ETA recomputed. Values are always
+    # tracked but rendering at most refreshRateHz times a second keeps tight loops cheap.
+    def set_refresh_rate(self, refreshRateHz):
+        self.minRefreshSecs = (1.0 / refreshRateHz) if refreshRateHz > 0 else 0
+
+    # Number of increments accumulated before even checking the clock.
+    def set_batch_size(self, batchSize):
+        self.batchSize = max(1, int(batchSize))
         
     def reset(self):
         # Time calc
@@ -35,6 +61,10 @@ class ProgressTracker:
         self.showTime = False
         self.totalTime = 0
         self.movAvg = MovingAverage(10) # Use 10 samples to smooth out estimate
+
+        # Throttling
+        self.lastRenderTime = 0
+        self.pendingIncrements = 0
         
         self.value = self.minVal
         self._init_bar()
@@ -45,17 +75,25 @@ class ProgressTracker:
             raise Exception(f"Value of {value} is out of ProgressTracker range: {self.minVal} - {self.maxVal}")
         else:
             self.value = value
-            self._update_progress()
+            self._throttled_update_progress()
 
+    # Hot path for tight loops so avoid the clock unless a batch is complete.
     def increment_value(self, delta):
-        self.set_value(self.value + delta)
+        value = self.value + delta
+        if value > self.upperBound or value < self.lowerBound:
+            raise Exception(f"Value of {value} is out of ProgressTracker range: {self.minVal} - {self.maxVal}")
+        
+        self.value = value
+        self.pendingIncrements += 1
+        if self.pendingIncrements >= self.batchSize or value > self.completeBound:
+            self._throttled_update_progress()
 
     def set_percent(self, percent):
         if percent > (100 + sys.float_info.epsilon) or percent < (-sys.float_info.epsilon):
             raise Exception(f"ProgressTracker percent value of {percent}  must be in range of 0 - 100.0")
         else:
             self.value = ((percent/100.0) * (self.maxVal-self.minVal)) + self.minVal;
-            self._update_progress()
+            self._throttled_update_progress()
 
     def increment_percent(self, delta):
         curr = (self.maxVal-self.minVal) / float(self.minVal)
@@ -71,10 +109,20 @@ class ProgressTracker:
     def _init_bar(self):
         raise Exception("ProgressTracker _init_bar function must be implemented in child class.")
 
-    def _update_progress(self):
+    # Always render the final value so the bar doesn't stall just short of done.
+    def _throttled_update_progress(self):
+        self.pendingIncrements = 0
+        newTime = time.monotonic()
+        if (newTime - self.lastRenderTime) >= self.minRefreshSecs or self.value > self.completeBound:
+            self._update_progress(newTime)
+
+    def _update_progress(self, newTime = None):
+        if newTime is None:
+            newTime = time.monotonic()
+        self.lastRenderTime = newTime
+
         # Don't start tracking time until we're progress
         if self.value > 0:
-            newTime = time.time()
             if self.currTime > 0:
                 # Rough inst. calculation 
                 deltaTime = newTime - self.currTime
@@ -122,11 +170,12 @@ class ProgressTracker:
 
 
 class ProgressTrackerGUI(ProgressTracker):
-    def __init__(self, minVal = 0, maxVal = 100, description = "Progress", numDecimals = 1, progressBarLen = 80):
+    def __init__(self, minVal = 0, maxVal = 100, description = "Progress", numDecimals = 1, progressBarLen = 80,
+                 refreshRateHz = ProgressTracker.DEFAULT_REFRESH_RATE_HZ, batchSize = ProgressTracker.DEFAULT_BATCH_SIZE):
         self.numDecimals    = numDecimals
         self.progressBarLen = progressBarLen
 
-        super().__init__(minVal, maxVal, description)
+        super().__init__(minVal, maxVal, description, refreshRateHz, batchSize)
     
     def __del__(self):
         del self.progressBar
@@ -167,11 +216,17 @@ class ProgressTrackerGUI(ProgressTracker):
                 self.progressBarVisible = True
 
 class ProgressTrackerCLI(ProgressTracker):
-    def __init__(self, minVal = 0, maxVal = 100, description = "Progress", numDecimals = 1, progressBarLen = 80):
+    def __init__(self, minVal = 0, maxVal = 100, description = "Progress", numDecimals = 1, progressBarLen = 80,
+                 refreshRateHz = ProgressTracker.DEFAULT_REFRESH_RATE_HZ, batchSize = ProgressTracker.DEFAULT_BATCH_SIZE):
         self.numDecimals    = numDecimals
         self.progressBarLen = progressBarLen
         
-        super().__init__(minVal, maxVal, description)
+        super().__init__(minVal, maxVal, description, refreshRateHz, batchSize)
+
+    @staticmethod
+    def FormatBar(progress, progressBarLen):
+        fillLen = math.ceil(progressBarLen * progress)
+        return fillLen * '█' + '-' * (progressBarLen - fillLen)
 
     def _init_bar(self):
         self._update_progress()
@@ -183,11 +238,224 @@ class ProgressTrackerCLI(ProgressTracker):
             progress = (self.value - self.minVal) / float(self.maxVal - self.minVal)
             percent = ("{0:." + str(self.numDecimals) + "f}").format(100 * progress)
             
-            fillLen = math.ceil(self.progressBarLen * progress)
-            progressBar = fillLen * '█' + '-' * (self.progressBarLen - fillLen)
+            progressBar = ProgressTrackerCLI.FormatBar(progress, self.progressBarLen)
 
             estTimeLabel = self.get_time_estimate()
             print(f"\r{self.description}: |{progressBar}| {percent}% | {estTimeLabel}", end = "\r")
             # Show completion with newline if close enough to done.
             if self.value > (self.maxVal - sys.float_info.epsilon):
-                print() 
\ No newline at end of file
+                print()
+
+# Tracks values and ETA without rendering anything. Useful for services
+# or background jobs where there is no terminal or notebook to draw to.
+class ProgressTrackerHeadless(ProgressTracker):
+    def _init_bar(self):
+        pass
+
+    def _do_update_progress(self):
+        pass
+
+# Thread-safe front end for a tracker updated by multiple workers. 
+# Increments are accumulated under a lock and forwarded in batches.
+class ProgressCounter:
+    def __init__(self, progressTracker: ProgressTracker, batchSize = ProgressTracker.DEFAULT_BATCH_SIZE):
+        self.progressTracker    = progressTracker
+        self.batchSize          = max(1, int(batchSize))
+        self.pending            = 0
+        self._lock              = Lock()
+
+    def increment(self, delta = 1):
+        with self._lock:
+            self.pending += delta
+            if self.pending >= self.batchSize:
+                self.progressTracker.increment_value(self.pending)
+                self.pending = 0
+
+    # Forward anything still pending, e.g. once workers are done.
+    def flush(self):
+        with self._lock:
+            if self.pending != 0:
+                self.progressTracker.increment_value(self.pending)
+                self.pending = 0
+
+# Per-worker progress values in shared memory so they can be updated from 
+# threads or processes. Each worker only writes its own slot so no lock is needed.
+# Like any multiprocessing shared object it must be passed to child processes on 
+# creation, i.e. as Process args or as a pool initializer argument.
+class SharedProgressCounters:
+    def __init__(self, numWorkers):
+        if numWorkers <= 0:
+            raise Exception(f"Invalid number of workers for SharedProgressCounters: {numWorkers}")
+        self.values = multiprocessing.RawArray('d', numWorkers)
+
+    def __len__(self):
+        return len(self.values)
+
+    def total(self):
+        return sum(self.values)
+
+# Handed to each worker. Mirrors the ProgressTracker update API so code that
+# reports progress doesn't need to know if it's running in a group.
+class WorkerProgress:
+    def __init__(self, counters: SharedProgressCounters, workerIdx):
+        self.counters   = counters
+        self.workerIdx  = workerIdx
+
+    def set_value(self, value):
+        self.counters.values[self.workerIdx] = value
+
+    def increment_value(self, delta = 1):
+        self.counters.values[self.workerIdx] += delta
+
+    def get_value(self):
+        return self.counters.values[self.workerIdx]
+
+# Aggregates per-worker progress into a combined bar with overall throughput and ETA.
+# Workers write to shared counters and a background runner periodically polls them
+# and renders, so workers never pay for rendering.
+class ProgressGroup(BackgroundTask):
+    DEFAULT_REFRESH_INTERVAL_SECS = 0.2
+
+    def __init__(self, workerRanges: List[float], description = "Progress", 
+                 refreshIntervalSecs = DEFAULT_REFRESH_INTERVAL_SECS):
+        self.description    = description
+        self.workerRanges   = list(workerRanges)
+        self.counters       = SharedProgressCounters(len(self.workerRanges))
+
+        # Headless trackers do the ETA bookkeeping, subclasses only render
+        self.workers = [ProgressTrackerHeadless(0, maxVal, f"{description} [{idx}]", ProgressTracker.UNTHROTTLED)
+                        for idx, maxVal in enumerate(self.workerRanges)]
+        self.total   = ProgressTrackerHeadless(0, sum(self.workerRanges), description, ProgressTracker.UNTHROTTLED)
+        
+        self.startTime  = 0
+        self._lock      = Lock()
+        self._runner    = BackgroundRunner(self, refreshIntervalSecs, threadName = "ProgressGroup_Thread")
+
+        self._init_bars()
+
+    def __del__(self):
+        self.stop()
+
+    def get_worker(self, workerIdx) -> WorkerProgress:
+        return WorkerProgress(self.counters, workerIdx)
+
+    def start(self) -> bool:
+        self.startTime = time.monotonic()
+        return self._runner.start()
+
+    # Stopping refreshes one last time so the final state is rendered
+    def stop(self) -> bool:
+        return self._runner.stop()
+
+    def is_complete(self):
+        return self.total.is_complete()
+
+    # Units completed per second across all workers since start
+    def get_throughput(self):
+        elapsed = time.monotonic() - self.startTime if self.startTime > 0 else 0
+        return self.total.value / elapsed if elapsed > 0 else 0
+
+    def refresh(self):
+        with self._lock:
+            totalValue = 0
+            for idx, tracker in enumerate(self.workers):
+                # Clamp as workers may overshoot and trackers reject out of range values
+                value = min(max(self.counters.values[idx], tracker.minVal), tracker.maxVal)
+                if value != tracker.value:
+                    tracker.set_value(value)
+                totalValue += value
+
+            if totalValue != self.total.value:
+                self.total.set_value(min(totalValue, self.total.maxVal))
+
+            self._do_update_progress()
+
+    def doTask(self):
+        self.refresh()
+
+    def onTaskException(self, exception: Exception):
+        print()
+        print(f"Error: unable to refresh progress for {self.description}: {exception}")
+
+    def _init_bars(self):
+        raise Exception("ProgressGroup _init_bars function must be implemented in child class.")
+
+    def _do_update_progress(self):
+        raise Exception("ProgressGroup _do_update_progress function must be implemented in child class.")
+
+# Redraws the total and one line per worker in place using ANSI cursor movement.
+class ProgressGroupCLI(ProgressGroup):
+    def __init__(self, workerRanges: List[float], description = "Progress", numDecimals = 1, progressBarLen = 40,
+                 refreshIntervalSecs = ProgressGroup.DEFAULT_REFRESH_INTERVAL_SECS):
+        self.numDecimals    = numDecimals
+        self.progressBarLen = progressBarLen
+        self.numLinesDrawn  = 0
+
+        super().__init__(workerRanges, description, refreshIntervalSecs)
+
+    def _init_bars(self):
+        self.numLinesDrawn = 0
+
+    def _format_line(self, label, tracker: ProgressTracker, suffix = ""):
+        progress = (tracker.value - tracker.minVal) / float(tracker.maxVal - tracker.minVal)
+        percent = ("{0:." + str(self.numDecimals) + "f}").format(100 * progress)
+        progressBar = ProgressTrackerCLI.FormatBar(progress, self.progressBarLen)
+        return f"{label}: |{progressBar}| {percent}%{suffix}"
+
+    def _do_update_progress(self):
+        # Delay showing progress bars until we've started processing something
+        if self.total.value > self.total.minVal:
+            suffix = " | {0:.1f}/s".format(self.get_throughput())
+            estTimeLabel = self.total.get_time_estimate()
+            if estTimeLabel != "":
+                suffix = suffix + " | " + estTimeLabel
+
+            lines = [self._format_line(self.description, self.total, suffix)]
+            for idx, tracker in enumerate(self.workers):
+                lines.append(self._format_line(f"  [{idx}]", tracker))
+
+            # Move back to the first line drawn and overwrite
+            if self.numLinesDrawn > 0:
+                print(f"\x1b[{self.numLinesDrawn}F", end = "")
+            for line in lines:
+                print(f"\x1b[2K{line}")
+            self.numLinesDrawn = len(lines)
+
+class ProgressGroupGUI(ProgressGroup):
+    def __init__(self, workerRanges: List[float], description = "Progress", numDecimals = 1,
+                 refreshIntervalSecs = ProgressGroup.DEFAULT_REFRESH_INTERVAL_SECS):
+        self.numDecimals = numDecimals
+
+        super().__init__(workerRanges, description, refreshIntervalSecs)
+
+    def _create_bar(self, tracker: ProgressTracker, description):
+        suffix = Label("")
+        progressBar = FloatProgress(min = tracker.minVal, max = tracker.maxVal, description = description)
+        return progressBar, suffix, HBox([progressBar, suffix])
+
+    def _init_bars(self):
+        self.bars = [self._create_bar(self.total, self.description)]
+        for idx, tracker in enumerate(self.workers):
+            self.bars.append(self._create_bar(tracker, f"[{idx}]"))
+
+        self.groupBox = VBox([bar[2] for bar in self.bars])
+        self.groupBoxVisible = False
+
+    def _do_update_progress(self):
+        trackers = [self.total] + self.workers
+        for (progressBar, suffix, _), tracker in zip(self.bars, trackers):
+            progress = (tracker.value - tracker.minVal) / float(tracker.maxVal - tracker.minVal)
+            suffix.value = ("{0:." + str(self.numDecimals) + "f}%").format(100 * progress)
+            progressBar.value = tracker.value
+
+        # Total shows throughput and ETA
+        totalSuffix = self.bars[0][1]
+        totalSuffix.value += " | {0:.1f}/s".format(self.get_throughput())
+        estTimeLabel = self.total.get_time_estimate()
+        if estTimeLabel != "":
+            totalSuffix.value += " | " + estTimeLabel
+
+        # Delay showing progress bars until we've started processing something
+        if self.total.value > self.total.minVal and not self.groupBoxVisible:
+            display(self.groupBox)
+            self.groupBoxVisible = True
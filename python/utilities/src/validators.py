@@ -1,11 +1,22 @@
 import re
 
+from typing import Iterable, List, Optional, Tuple
+
 class Validator:
     ValidEmailRegex = r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,7}"
 
+    # Compile once. The list pattern validates a comma separated list in a single
+    # pass instead of splitting and matching each address.
+    ValidEmailPattern       = re.compile(ValidEmailRegex)
+    ValidEmailListPattern   = re.compile(rf"{ValidEmailRegex}(?:,{ValidEmailRegex})*")
+
+    # Used by the batch API which also accepts surrounding whitespace and the
+    # display name form, i.e. "Jane Doe <jane@example.com>"
+    ParseEmailPattern       = re.compile(rf"\s*(?:[^<>,]*<(?P<bracketed>{ValidEmailRegex})>|(?P<bare>{ValidEmailRegex}))\s*")
+
     @staticmethod
     def IsValidEmailAddress(emailAddressStr: str) -> bool:
-        return re.fullmatch(Validator.ValidEmailRegex, emailAddressStr) is not None
+        return Validator.ValidEmailPattern.fullmatch(emailAddressStr) is not None
 
     @staticmethod
     def IsValidEmailList(emailListStr: str, allowEmpty: bool = False) -> bool:
@@ -13,17 +24,42 @@ class Validator:
 
         try:
             if emailListStr != "":
-                lsEmails = emailListStr.split(",")
-
-                invalidEmail = False
-                for email in lsEmails:
-                    if not Validator.IsValidEmailAddress(email):
-                        invalidEmail = True
-                        break
-
-                success = not invalidEmail
+                success = Validator.ValidEmailListPattern.fullmatch(emailListStr) is not None
             else:
                 success = allowEmpty
         finally:
             return success
-            
+
+    # Domains are case insensitive so lower case them. The local part is
+    # left alone since servers are allowed to treat it as case sensitive.
+    @staticmethod
+    def NormalizeEmailAddress(emailAddressStr: str) -> str:
+        localPart, _, domain = emailAddressStr.rpartition("@")
+        return f"{localPart}@{domain.lower()}"
+
+    # Validate many addresses in one call. Returns a mask of which entries are valid
+    # and the normalized address for each valid entry or None otherwise.
+    @staticmethod
+    def ValidateEmailAddresses(emailAddresses: Iterable[str]) -> Tuple[List[bool], List[Optional[str]]]:
+        mask: List[bool]                = []
+        normalized: List[Optional[str]] = []
+
+        fullmatch = Validator.ParseEmailPattern.fullmatch
+        normalize = Validator.NormalizeEmailAddress
+        for emailAddressStr in emailAddresses:
+            match = fullmatch(emailAddressStr) if isinstance(emailAddressStr, str) else None
+            if match is not None:
+                mask.append(True)
+                normalized.append(normalize(match.group("bracketed") or match.group("bare")))
+            else:
+                mask.append(False)
+                normalized.append(None)
+
+        return mask, normalized
+
+    # Batch version of IsValidEmailList, e.g. for the recipients of many messages.
+    @staticmethod
+    def ValidateEmailLists(emailListStrs: Iterable[str], allowEmpty: bool = False) -> List[bool]:
+        fullmatch = Validator.ValidEmailListPattern.fullmatch
+        return [(fullmatch(emailListStr) is not None) if emailListStr != "" else allowEmpty
+                for emailListStr in emailListStrs]
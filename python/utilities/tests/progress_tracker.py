@@ -1,5 +1,8 @@
 import time
 
+from multiprocessing   import Process
+from threading         import Thread
+
 from .common           import *
 from .progress_tracker import *
 
@@ -31,8 +34,72 @@ def fnTestProgressTracker(progressTrackerClass, description, minVal, maxVal, ste
 
     return success
 
+# Several workers share one tracker through a counter. Total must add up exactly.
+def fnTestProgressCounter(numWorkers = 4, incrementsPerWorker = 10000):
+    progressTracker = ProgressTrackerHeadless(0, numWorkers * incrementsPerWorker, "Counter: ")
+    counter = ProgressCounter(progressTracker, batchSize = 64)
+
+    def fnWork():
+        for i in range(incrementsPerWorker):
+            counter.increment(1)
+
+    workers = [Thread(target = fnWork) for i in range(numWorkers)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    counter.flush()
+
+    return progressTracker.is_complete()
+
+def fnGroupWork(workerProgress, numSteps, delayInSecs):
+    for i in range(numSteps):
+        workerProgress.increment_value(1)
+        time.sleep(delayInSecs)
+
+# Mix of thread and process workers reporting into one group.
+def fnTestProgressGroup(progressGroupClass, numSteps = 20, delayInSecs = .02):
+    progressGroup = progressGroupClass([numSteps] * 4, "Group: ")
+    progressGroup.start()
+
+    workers = [Thread(target = fnGroupWork, args = (progressGroup.get_worker(0), numSteps, delayInSecs)),
+               Thread(target = fnGroupWork, args = (progressGroup.get_worker(1), numSteps, delayInSecs)),
+               Process(target = fnGroupWork, args = (progressGroup.get_worker(2), numSteps, delayInSecs)),
+               Process(target = fnGroupWork, args = (progressGroup.get_worker(3), numSteps, delayInSecs))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    progressGroup.stop()
+
+    return progressGroup.is_complete()
+
+# Average cost of a single increment_value call in nanoseconds.
+def fnBenchmarkProgressTracker(progressTrackerClass, numIncrements = 1000000, **kwargs):
+    progressTracker = progressTrackerClass(0, numIncrements, "Benchmark: ", **kwargs)
+
+    start = time.perf_counter()
+    for i in range(numIncrements):
+        progressTracker.increment_value(1)
+    elapsed = time.perf_counter() - start
+
+    return (elapsed / numIncrements) * 1e9
+
+def fnBenchmarkProgressTrackers(numIncrements = 1000000):
+    cases = [
+        ("Headless unthrottled",        ProgressTrackerHeadless, { "refreshRateHz": ProgressTracker.UNTHROTTLED }),
+        ("Headless throttled",          ProgressTrackerHeadless, {}),
+        ("Headless throttled batched",  ProgressTrackerHeadless, { "batchSize": 1000 }),
+        ("CLI throttled",               ProgressTrackerCLI,      {}),
+        ("CLI throttled batched",       ProgressTrackerCLI,      { "batchSize": 1000 }),
+    ]
+
+    for name, progressTrackerClass, kwargs in cases:
+        nsPerIncrement = fnBenchmarkProgressTracker(progressTrackerClass, numIncrements, **kwargs)
+        print(f"Info: {name}: {nsPerIncrement:.0f} ns per increment")
+
 # TODO: should be run from Jupyter notebook
-def fnTestProgressTrackers(testCLI = True, testGUI = False):
+def fnTestProgressTrackers(testCLI = True, testGUI = False, testCounter = True, testGroup = True, runBenchmark = False):
     if testCLI:
         progressTrackerClass = ProgressTrackerCLI
         if fnTestProgressTracker(progressTrackerClass, "Progress: ", 3, 30, 3, delayInSecs = .05):
@@ -48,6 +115,22 @@ def fnTestProgressTrackers(testCLI = True, testGUI = False):
         else:
             print("Info: ProgressTrackerCLI test failed")
 
+    if testCounter:
+        if fnTestProgressCounter():
+            print("Info: ProgressCounter test passed")
+        else:
+            print("Info: ProgressCounter test failed")
+
+    if testGroup:
+        progressGroupClass = ProgressGroupGUI if testGUI else ProgressGroupCLI
+        if fnTestProgressGroup(progressGroupClass):
+            print("Info: ProgressGroup test passed")
+        else:
+            print("Info: ProgressGroup test failed")
+
+    if runBenchmark:
+        fnBenchmarkProgressTrackers()
+
 # Main Function: run tests
 def main():
     fnTestProgressTrackers()
@@ -43,7 +43,8 @@ class Processor(background_task.BackgroundTask):
         self._isRunning.set()
 
         self._maintRunner   = background_task.BackgroundRunner(self, 
-                                                               Processor.DEFAULT_MAINTENANCE_INTERVAL_SECS)
+                                                               Processor.DEFAULT_MAINTENANCE_INTERVAL_SECS,
+                                                               scheduler = background_task.BackgroundScheduler.GetShared())
     
     # Throws exception if unable to load request
     def _load(self) -> bool:
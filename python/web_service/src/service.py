@@ -1,7 +1,8 @@
 from abc                import abstractmethod
+from contextlib         import asynccontextmanager
 from fastapi            import FastAPI
 from threading          import Thread
-from typing             import Optional
+from typing             import AsyncIterator, List, Optional
 
 import asyncio
 import httpx
@@ -12,6 +13,9 @@ import uuid
 # User module and logging
 from core import logs, user_module
 
+# User packages
+from utilities import background_task
+
 # Local files
 from    .context    import APIContext
 from    .params     import ServiceParams
@@ -32,11 +36,15 @@ class FastAPIService(user_module.UserModule):
         self._server: Optional[uvicorn.Server]  = None
         
         self.asyncClient    = httpx.AsyncClient()
-        self.app            = FastAPI()
+        self.app            = FastAPI(lifespan = self._lifespan)
         self.params         = params
 
         self.serviceID      = serviceID
 
+        # Periodic async jobs run on uvicorn's loop once the app starts up
+        self._asyncRunners: List[background_task.AsyncBackgroundRunner] = []
+        self._loop: Optional[asyncio.AbstractEventLoop]                 = None
+
     @abstractmethod
     def createProcessor(self) -> Processor:
         pass # Must define in subclass with desired processor subclass
@@ -79,6 +87,34 @@ class FastAPIService(user_module.UserModule):
     def registerRouters(self, router: ServiceRouter):
         router.addRouter(self.app)
 
+    # Runners added before the server starts are started with it. 
+    # Otherwise they are started right away on the server's loop.
+    def addAsyncRunner(self, runner: background_task.AsyncBackgroundRunner):
+        self._asyncRunners.append(runner)
+        if self._loop is not None and self._loop.is_running():
+            runner.start(self._loop)
+
+    # Runs around the app's lifetime on uvicorn's loop
+    @asynccontextmanager
+    async def _lifespan(self, app: FastAPI) -> AsyncIterator[None]:
+        await self._startAsyncRunners()
+        try:
+            yield
+        finally:
+            await self._stopAsyncRunners()
+
+    async def _startAsyncRunners(self):
+        self._loop = asyncio.get_running_loop()
+        for runner in self._asyncRunners:
+            if not runner.isRunning() and not runner.start(self._loop):
+                self.logger.error("Unable to start async background runner.")
+
+    async def _stopAsyncRunners(self):
+        for runner in self._asyncRunners:
+            if runner.isRunning() and not await runner.stop():
+                self.logger.warning("Async background runner didn't drain before timeout and was cancelled.")
+        self._loop = None
+
     def start(self):
         config = uvicorn.Config(self.app, 
                                 host = self.params.serverAddr, 